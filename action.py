@@ -1,12 +1,44 @@
-import ctypes, datetime, os, re, shutil, subprocess, struct, sys, winreg
-from urllib import request
+import contextlib, datetime, functools, itertools, os, re, struct, sys, threading, time
 
-import ssl
-from pip._vendor import certifi     # use pip certifi to fix (urllib.error.URLError: <urlopen error [SSL: CERTIFICATE_VERIFY_FAILED] certificate verify failed: unable to get local issuer certificate (_ssl.c:1123)>)
+# network, TLS, registry and process modules are imported on first use, to keep `from action import *` fast and portable
 
 
 scriptdir = os.path.dirname(os.path.abspath(__file__))
 downloadsdir = os.path.join(scriptdir, 'runtime', 'downloads')
+metadatadir = os.path.join(scriptdir, 'runtime', 'metadata')
+versionsfile = os.path.join(scriptdir, 'runtime', 'versions.json')
+toolcachedir = os.environ.get('RUNNER_TOOL_CACHE') or os.path.join(scriptdir, 'runtime', 'toolcache')
+compilecachedir = os.environ.get('NSIS_INSTALL_COMPILE_CACHE') or os.path.join(scriptdir, 'runtime', 'compile')
+
+nsis_version_timeout = 30   # seconds
+
+github_api_url = 'https://api.github.com'
+sourceforge_url = 'https://sourceforge.net'
+
+# release metadata younger than this (seconds) is reused without revalidation
+metadata_ttl = int(os.environ.get('NSIS_INSTALL_METADATA_TTL', '600'))
+
+# large downloads are split into HTTP Range requests of this size, fetched concurrently
+download_chunk_size = 1024 * 1024
+download_threads = 4
+
+# hedged downloads start the next candidate source when the running ones are this slow
+hedge_ttfb = 2   # seconds without a first byte
+hedge_throughput = 256 * 1024   # bytes/s
+
+# the download store in `downloadsdir` evicts least recently used files beyond this size
+downloads_cache_size = 1024 * 1024 * 1024
+
+# the tool cache in `toolcachedir` prunes least recently used NSIS installations beyond this size
+tool_cache_size = int(os.environ.get('NSIS_INSTALL_TOOL_CACHE_SIZE', str(512 * 1024 * 1024)))
+
+# `nsis_compile` stores makensis outputs in `compilecachedir`, evicting least recently used entries beyond this size
+compile_cache_size = int(os.environ.get('NSIS_INSTALL_COMPILE_CACHE_SIZE', str(256 * 1024 * 1024)))
+
+http_timeout = 60   # seconds
+# sent with every request, api.github.com rejects requests without a `User-Agent`
+http_user_agent = f'nsis-install/{os.environ.get("GITHUB_ACTION_REF") or "dev"}'
+broadcast_timeout = 5   # seconds
 
 
 # GitHub Actions sets RUNNER_DEBUG=1 when debug logging is enabled
@@ -16,96 +48,221 @@ if verbose := (os.environ.get("RUNNER_DEBUG", default="0") == "1"):
     print(f'Platform: os.name="{os.name}", sys.platform="{sys.platform}"')
 
 
-def broadcast_settings_change(param=None):
-    """ Broadcast `WM_SETTINGCHANGE` to all windows to notify them of environment changes. """
-    HWND_BROADCAST = 0xFFFF
-    WM_SETTINGCHANGE = 0x001A
+# phases are traced as nested spans, reported by `trace_report`
+trace_start = time.perf_counter()
+trace_spans = []    # completed spans: {'id', 'parent', 'name', 'thread', 'start', 'duration', 'attributes'}, times in seconds since `trace_start`
+_trace_ids = itertools.count(1)
+_trace_lock = threading.Lock()
+_trace_local = threading.local()
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """
+    Trace a phase: `with span('download', url=url) as attributes: ...`.
+    Spans nest per thread. Their `attributes` (e.g. `bytes`, `cache`) can be updated inside the block, or with `span_set`.
+    """
+    stack = _trace_local.__dict__.setdefault('stack', [])
+    record = {'id': next(_trace_ids), 'parent': stack[-1]['id'] if stack else None, 'name': name, 'thread': threading.get_ident(), 'start': time.perf_counter() - trace_start, 'attributes': attributes}
+    stack.append(record)
     try:
-        result = ctypes.windll.user32.SendMessageW(HWND_BROADCAST, WM_SETTINGCHANGE, 0, param)
-        if verbose: print(f'SendMessage(HWND_BROADCAST, WM_SETTINGCHANGE, {param}) = {result}')
-    except Exception as ex:
-        print(f"-- WM_SETTINGCHANGE broadcast: {ex}")
+        yield attributes
+    except BaseException as ex:
+        attributes['error'] = f'{type(ex).__name__}: {ex}'
+        raise
+    finally:
+        stack.pop()
+        record['duration'] = time.perf_counter() - trace_start - record['start']
+        with _trace_lock:
+            trace_spans.append(record)
 
 
-def path_add(pathlist, path, keep_existing=True, front=True):
-    """ Add a directory to a `PATH` string. """
-    path = os.path.normpath(path)
+def traced(name=None):
+    """ Decorator tracing every call of a function as a `span`. """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name or function.__name__):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
 
-    paths = []
-    for entry in pathlist.split(os.pathsep):
-        if os.path.normpath(os.path.expandvars(entry)).casefold() == path.casefold():
-            if keep_existing:
-                return (False, pathlist)   # already exists
-        else:
-            paths.append(entry)
 
-    pathlist = ''   # rebuild PATH
-    for entry in paths:
-        pathlist += (os.pathsep if pathlist != "" else "") + entry
+def span_set(**attributes):
+    """ Update the attributes of the current thread's innermost span, e.g. `span_set(bytes=1234, cache='hit')`. """
+    if stack := getattr(_trace_local, 'stack', None):
+        stack[-1]['attributes'].update(attributes)
 
-    if front:
-        pathlist = path + (os.pathsep if pathlist != "" else "") + pathlist
-    else:
-        pathlist = pathlist + (os.pathsep if pathlist != "" else "") + path
 
-    return (True, pathlist)
+def span_current():
+    """ The current thread's innermost span, to be passed to `span_inherit` in worker threads. """
+    return stack[-1] if (stack := getattr(_trace_local, 'stack', None)) else None
+
+
+def span_inherit(parent):
+    """ Nest the spans of the current (worker) thread under `parent`, a `span_current()` result of another thread. """
+    _trace_local.stack = [parent] if parent else []
+
+
+def trace_summary(title='NSIS install'):
+    """ Markdown table of the traced phases, in start order, nested by indentation. """
+    depths = {}
+    lines = [f'### {title}: {int((time.perf_counter() - trace_start) * 1000)} ms', '', '| Phase | Duration | Bytes | Cache | Details |', '|---|---:|---:|---|---|']
+    for record in sorted(trace_spans, key=lambda record: record['start']):
+        depths[record['id']] = depth = depths.get(record['parent'], -1) + 1
+        attributes = record['attributes']
+        details = ', '.join(f'{key}={value}' for key, value in attributes.items() if key not in ('bytes', 'cache'))
+        lines.append(f'| {"&nbsp;&nbsp;" * depth}{record["name"]} | {int(record["duration"] * 1000)} ms | {attributes.get("bytes", "")} | {attributes.get("cache", "")} | {details.replace("|", "&#124;")} |')
+    return '\n'.join(lines) + '\n'
 
-def path_remove(pathlist, path):
-    """ Remove directory (all occurrences) from `PATH` string. """
-    path = os.path.normpath(os.path.expandvars(path))
 
-    modified = False
-    paths = []
-    for entry in pathlist.split(os.pathsep):
-        if os.path.normpath(os.path.expandvars(entry)).casefold() == path.casefold():
-            modified = True
+def trace_report(trace_file=None, chrome=False, summary=False):
+    """
+    Write the traced spans to `trace_file` as JSON (`{"duration", "spans"}`, or Chrome's `chrome://tracing` format with `chrome`),
+    and append a `trace_summary` table to `GITHUB_STEP_SUMMARY` with `summary`.
+    Returns the total duration since `action` was imported, in milliseconds.
+    """
+    import json
+    duration = int((time.perf_counter() - trace_start) * 1000)
+    with _trace_lock:
+        spans = sorted(trace_spans, key=lambda record: record['start'])
+    if trace_file:
+        if chrome:
+            document = {'traceEvents': [{'name': record['name'], 'ph': 'X', 'ts': int(record['start'] * 1e6), 'dur': int(record['duration'] * 1e6), 'pid': os.getpid(), 'tid': record['thread'], 'args': record['attributes']} for record in spans]}
         else:
-            paths.append(entry)
+            document = {'duration': duration, 'spans': spans}
+        os.makedirs(os.path.dirname(os.path.abspath(trace_file)), exist_ok=True)
+        with open(trace_file, 'w', encoding='utf-8') as fo:
+            json.dump(document, fo, indent=1, default=str)
+        print(f'Trace {len(spans)} spans to "{trace_file}"')
+    if summary and (summary_file := os.getenv('GITHUB_STEP_SUMMARY')):
+        with open(summary_file, 'a', encoding='utf-8') as fo:
+            fo.write(trace_summary())
+    return duration
+
+
+def broadcast_settings_change(param=None, timeout=None):
+    """
+    Broadcast `WM_SETTINGCHANGE` to all windows to notify them of environment changes.
+    Hung windows are skipped (`SMTO_ABORTIFHUNG`) and the caller waits at most `timeout` seconds (default `broadcast_timeout`).
+    """
+    HWND_BROADCAST = 0xFFFF
+    WM_SETTINGCHANGE = 0x001A
+    SMTO_ABORTIFHUNG = 0x0002
+    timeout = broadcast_timeout if timeout is None else timeout
 
-    if modified:
-        pathlist = ''   # rebuild PATH
-        for entry in paths:
-            pathlist += (os.pathsep if pathlist != "" else "") + entry
+    def broadcast():
+        try:
+            import ctypes
+            result = ctypes.c_size_t(0)
+            status = ctypes.windll.user32.SendMessageTimeoutW(HWND_BROADCAST, WM_SETTINGCHANGE, 0, param, SMTO_ABORTIFHUNG, int(timeout * 1000), ctypes.byref(result))
+            if verbose: print(f'SendMessageTimeout(HWND_BROADCAST, WM_SETTINGCHANGE, {param}) = {status}')
+        except Exception as ex:
+            print(f"-- WM_SETTINGCHANGE broadcast: {ex}")
+
+    # the timeout applies to each window, the thread bounds the total
+    thread = threading.Thread(target=broadcast, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        print(f'-- WM_SETTINGCHANGE broadcast: no answer after {timeout} s, moving on')
+
+
+class PathList:
+    """
+    Ordered `PATH` entries, indexed by their normalized (expanded, case-folded) form.
+    Entries are normalized once and keep their original spelling, so `str()` returns the exact input until modified.
+    """
+
+    def __init__(self, pathlist=''):
+        self.entries = pathlist.split(os.pathsep) if pathlist else []
+        self._keys = [self.key(entry) for entry in self.entries]
+        self._reindex()
+
+    @staticmethod
+    def key(path):
+        return os.path.normpath(os.path.expandvars(path)).casefold()
+
+    def _reindex(self):
+        self._index = {}    # {key: number of occurrences}
+        for key in self._keys:
+            self._index[key] = self._index.get(key, 0) + 1
+
+    def _replace(self, entries, keys):
+        modified = (entries != self.entries)
+        self.entries, self._keys = entries, keys
+        self._reindex()
+        return modified
+
+    def __str__(self):
+        return os.pathsep.join(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __contains__(self, path):
+        return self.key(path) in self._index
+
+    def add(self, paths, keep_existing=True, front=True):
+        """ Add one or more directories in a single pass. Returns `True` if the list was modified. """
+        added = {}      # {key: entry}, in argument order
+        for path in ([paths] if isinstance(paths, str) else paths):
+            key = self.key(path)
+            if key not in added and not (keep_existing and key in self._index):
+                added[key] = os.path.normpath(path)
+        if not added:
+            return False
+        kept = [(entry, key) for entry, key in zip(self.entries, self._keys) if key not in added]
+        items = (list(zip(added.values(), added)) + kept) if front else (kept + list(zip(added.values(), added)))
+        return self._replace([entry for entry, key in items], [key for entry, key in items])
+
+    def remove(self, paths):
+        """ Remove one or more directories (all occurrences) in a single pass. Returns `True` if the list was modified. """
+        removed = {self.key(path) for path in ([paths] if isinstance(paths, str) else paths)}
+        if not any(key in self._index for key in removed):
+            return False
+        items = [(entry, key) for entry, key in zip(self.entries, self._keys) if key not in removed]
+        return self._replace([entry for entry, key in items], [key for entry, key in items])
+
+    def move_to_front(self, paths):
+        """ Move existing directories to the front, in argument order, keeping their original spelling. Returns `True` if the list was modified. """
+        moved = {self.key(path): None for path in ([paths] if isinstance(paths, str) else paths)}
+        moved = {key: None for key in moved if key in self._index}
+        if not moved:
+            return False
+        kept = []
+        for entry, key in zip(self.entries, self._keys):
+            if key not in moved:
+                kept.append((entry, key))
+            elif moved[key] is None:
+                moved[key] = entry  # first occurrence wins, duplicates are dropped
+        items = [(entry, key) for key, entry in moved.items()] + kept
+        return self._replace([entry for entry, key in items], [key for entry, key in items])
 
-    return (modified, pathlist)
+def path_add(pathlist, path, keep_existing=True, front=True):
+    """ Add a directory to a `PATH` string. """
+    paths = PathList(pathlist)
+    return (True, str(paths)) if paths.add(path, keep_existing, front) else (False, pathlist)
+
+def path_remove(pathlist, path):
+    """ Remove directory (all occurrences) from `PATH` string. """
+    paths = PathList(pathlist)
+    return (True, str(paths)) if paths.remove(path) else (False, pathlist)
 
 def registry_path_add(instdir, regroot, regpath, regvalue="Path", keep_existing=True, front=True):
     """ Add a directory to a `PATH` string stored in the registry. """
-    modified = False
-    path = None
-    try:
-        regtype = winreg.REG_EXPAND_SZ
-        with winreg.OpenKey(regroot, regpath, access=winreg.KEY_READ|winreg.KEY_WOW64_64KEY) as hkey:
-            path, regtype = winreg.QueryValueEx(hkey, regvalue)
-        modified, path = path_add(path, instdir, keep_existing, front)
-        if modified:
-            with winreg.OpenKey(regroot, regpath, access=winreg.KEY_WRITE|winreg.KEY_WOW64_64KEY) as hkey:
-                winreg.SetValueEx(hkey, regvalue, 0, regtype, path)
-                print(f'Added "{instdir}" to {"user" if regroot == winreg.HKEY_CURRENT_USER else "system"} PATH')
-                broadcast_settings_change('Environment')
-    except Exception as ex:
-        modified = False
-        print(f'-- registry_path_add("{instdir}", "{regpath}"): {ex}')
-    return (modified, path)
+    with EnvironmentUpdate() as environment:
+        environment.registry_path_add(instdir, regroot, regpath, regvalue, keep_existing, front)
+    return environment.registry_values.get((regroot, regpath, regvalue), (False, None))
 
 def registry_path_remove(instdir, regroot, regpath, regvalue="Path"):
     """ Remove directory (all occurrences) from a `PATH` string stored in the registry. """
-    modified = False
-    path = None
-    try:
-        regtype = winreg.REG_EXPAND_SZ
-        with winreg.OpenKey(regroot, regpath, access=winreg.KEY_READ|winreg.KEY_WOW64_64KEY) as hkey:
-            path, regtype = winreg.QueryValueEx(hkey, regvalue)
-        modified, path = path_remove(path, instdir)
-        if modified:
-            with winreg.OpenKey(regroot, regpath, access=winreg.KEY_WRITE|winreg.KEY_WOW64_64KEY) as hkey:
-                winreg.SetValueEx(hkey, regvalue, 0, regtype, path)
-                print(f'Removed "{instdir}" from {"user" if regroot == winreg.HKEY_CURRENT_USER else "system"} PATH')
-                broadcast_settings_change('Environment')
-    except Exception as ex:
-        modified = False
-        print(f'-- registry_path_remove("{instdir}", "{regpath}"): {ex}')
-    return (modified, path)
+    with EnvironmentUpdate() as environment:
+        environment.registry_path_remove(instdir, regroot, regpath, regvalue)
+    return environment.registry_values.get((regroot, regpath, regvalue), (False, None))
 
 def process_path_add(instdir, keep_existing=True, front=True):
     """ Add directory to `os.environ['PATH']`. """
@@ -135,182 +292,992 @@ def github_path_add(instdir):
     return False
 
 
-def download_github_asset(owner, repo, tag, name_regex, token, outdir):
+# same values as `winreg.HKEY_*`, usable without importing `winreg`
+HKEY_CURRENT_USER = 0x80000001
+HKEY_LOCAL_MACHINE = 0x80000002
+
+system_environment_key = r"SYSTEM\CurrentControlSet\Control\Session Manager\Environment"
+user_environment_key = r"Environment"
+nsis_uninstall_key = r"SOFTWARE\Microsoft\Windows\CurrentVersion\Uninstall\NSIS"
+nsis_software_key = r"SOFTWARE\NSIS"
+
+
+class WindowsRegistry:
+    """ `EnvironmentUpdate` registry backend, backed by `winreg` (64-bit registry view). """
+
+    def update(self, root, key, value, modify):
+        """ Read a value, pass it to `modify(data)` which returns `(modified, data)`, and write it back if modified. The key is opened once. """
+        import winreg
+        with winreg.OpenKey(root, key, access=winreg.KEY_READ|winreg.KEY_WRITE|winreg.KEY_WOW64_64KEY) as hkey:
+            data, regtype = winreg.QueryValueEx(hkey, value)
+            modified, data = modify(data)
+            if modified:
+                winreg.SetValueEx(hkey, value, 0, regtype, data)
+            return (modified, data)
+
+    def query(self, root, key, value, view=64):
+        """ Read a value from the 64-bit or 32-bit registry `view`. Returns `None` if the key or value doesn't exist. """
+        import winreg
+        try:
+            with winreg.OpenKey(root, key, access=winreg.KEY_READ|(winreg.KEY_WOW64_32KEY if view == 32 else winreg.KEY_WOW64_64KEY)) as hkey:
+                return winreg.QueryValueEx(hkey, value)[0]
+        except FileNotFoundError:
+            return None
+
+    def delete_key(self, root, key, view=64):
+        """ Delete a key without subkeys from the 64-bit or 32-bit registry `view`. Returns `False` if it doesn't exist. """
+        import winreg
+        try:
+            winreg.DeleteKeyEx(root, key, access=winreg.KEY_WOW64_32KEY if view == 32 else winreg.KEY_WOW64_64KEY)
+            return True
+        except FileNotFoundError:
+            return False
+
+
+class EnvironmentUpdate:
     """
-    Download a GitHub release asset matching the specified regex.
-    Returns the path to the downloaded file.
+    Environment update transaction.
+    Process `PATH`, `GITHUB_PATH` and registry `PATH` changes are queued and applied by `commit()`:
+    each registry value is read and written once, and `WM_SETTINGCHANGE` is broadcast once, if the registry changed.
+
+        with EnvironmentUpdate() as environment:
+            environment.process_path_add(instdir)
+            environment.registry_path_add(instdir, HKEY_LOCAL_MACHINE, system_environment_key)
+
+    `registry` is the registry backend (default `WindowsRegistry()`), `broadcast` the change notification (default `broadcast_settings_change`).
     """
-    if tag.lower() == 'latest':
-        url = f'https://api.github.com/repos/{owner}/{repo}/releases/latest'
+
+    def __init__(self, registry=None, broadcast=None):
+        self.registry = registry or WindowsRegistry()
+        self.broadcast = broadcast or broadcast_settings_change
+        self.process_changes = []
+        self.github_changes = []
+        self.registry_changes = {}      # {(root, key, value): [changes]}
+        self.registry_values = {}       # {(root, key, value): (modified, data)}, after commit
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+
+    def process_path_add(self, instdir, keep_existing=True, front=True):
+        self.process_changes.append(('add', instdir, keep_existing, front))
+
+    def process_path_remove(self, instdir):
+        self.process_changes.append(('remove', instdir))
+
+    def github_path_add(self, instdir):
+        self.github_changes.append(instdir)
+
+    def registry_path_add(self, instdir, regroot, regpath, regvalue="Path", keep_existing=True, front=True):
+        self.registry_changes.setdefault((regroot, regpath, regvalue), []).append(('add', instdir, keep_existing, front))
+
+    def registry_path_remove(self, instdir, regroot, regpath, regvalue="Path"):
+        self.registry_changes.setdefault((regroot, regpath, regvalue), []).append(('remove', instdir))
+
+    @staticmethod
+    def _apply(pathlist, changes, log):
+        paths = PathList(pathlist)
+        modified = False
+        for change in changes:
+            if change[0] == 'add':
+                changed = paths.add(change[1], *change[2:])
+            else:
+                changed = paths.remove(change[1])
+            if changed:
+                log.append(f'{"Added" if change[0] == "add" else "Removed"} "{change[1]}" {"to" if change[0] == "add" else "from"}')
+            modified |= changed
+        return (modified, str(paths) if modified else pathlist)
+
+    @traced('environment')
+    def commit(self):
+        """ Apply all queued changes. Returns `True` if anything was modified. """
+        modified = False
+
+        if self.process_changes:
+            changed, path = self._apply(os.environ.get('PATH', ''), self.process_changes, log := [])
+            if changed:
+                os.environ['PATH'] = path
+                for message in log:
+                    print(f'{message} process PATH')
+            modified |= changed
+
+        if self.github_changes and (github_path := os.getenv('GITHUB_PATH')) is not None:
+            try:
+                with open(github_path, 'a') as fo:
+                    for instdir in self.github_changes:
+                        fo.write(f'{instdir}\n')
+                        print(f'Added "{instdir}" to GITHUB_PATH')
+                modified = True
+            except Exception as ex:
+                print(f'-- github_path_add({self.github_changes}): {ex}')
+
+        registry_modified = False
+        for (regroot, regpath, regvalue), changes in self.registry_changes.items():
+            try:
+                log = []
+                changed, path = self.registry.update(regroot, regpath, regvalue, lambda data: self._apply(data, changes, log))
+                self.registry_values[(regroot, regpath, regvalue)] = (changed, path)
+                for message in (log if changed else []):
+                    print(f'{message} {"user" if regroot == HKEY_CURRENT_USER else "system"} PATH')
+                registry_modified |= changed
+            except Exception as ex:
+                print(f'-- registry_path_update("{regpath}", {[change[:2] for change in changes]}): {ex}')
+        if registry_modified:
+            self.broadcast('Environment')
+
+        self.process_changes, self.github_changes, self.registry_changes = [], [], {}
+        return modified or registry_modified
+
+
+_ssl_context = None
+_http_pool = {}     # {(scheme, host, port): [idle connections]}
+_http_lock = threading.Lock()
+
+# connections opened, TLS handshakes performed and requests sent by `http_open`
+http_stats = {'connections': 0, 'handshakes': 0, 'requests': 0}
+
+
+def ssl_context():
+    """ Return the shared SSL context, created on first use. """
+    global _ssl_context
+    with _http_lock:
+        if _ssl_context is None:
+            import ssl
+            from pip._vendor import certifi     # use pip certifi to fix (urllib.error.URLError: <urlopen error [SSL: CERTIFICATE_VERIFY_FAILED] certificate verify failed: unable to get local issuer certificate (_ssl.c:1123)>)
+            _ssl_context = ssl.create_default_context(cafile=certifi.where())
+        return _ssl_context
+
+
+def _http_connect(scheme, host, port, timings):
+    """ Open a new connection, recording `connect` and `tls` durations (ms) in `timings`. """
+    import http.client, socket
+    from urllib import request
+
+    t0 = time.perf_counter()
+    if (proxy := request.getproxies().get(scheme)) and not request.proxy_bypass(host):
+        from urllib import parse
+        proxy = parse.urlsplit(proxy if '://' in proxy else f'http://{proxy}')
+        if scheme == 'https':
+            connection = http.client.HTTPSConnection(proxy.hostname, proxy.port or 8080, timeout=http_timeout, context=ssl_context())
+        else:
+            connection = http.client.HTTPConnection(proxy.hostname, proxy.port or 8080, timeout=http_timeout)
+        connection.set_tunnel(host, port)
+        connection.connect()
+        timings['connect'] = (time.perf_counter() - t0) * 1000
+    elif scheme == 'https':
+        connection = http.client.HTTPSConnection(host, port, timeout=http_timeout, context=ssl_context())
+        sock = socket.create_connection((host, port), http_timeout)
+        timings['connect'] = (time.perf_counter() - t0) * 1000
+        t0 = time.perf_counter()
+        connection.sock = ssl_context().wrap_socket(sock, server_hostname=host)
+        timings['tls'] = (time.perf_counter() - t0) * 1000
+    else:
+        connection = http.client.HTTPConnection(host, port, timeout=http_timeout)
+        connection.connect()
+        timings['connect'] = (time.perf_counter() - t0) * 1000
+    with _http_lock:
+        http_stats['connections'] += 1
+        if scheme == 'https':
+            http_stats['handshakes'] += 1
+    return connection
+
+
+@contextlib.contextmanager
+def http_open(url, headers={}, method='GET', max_redirects=5, active=None):
+    """
+    Send an HTTP request on a pooled keep-alive connection, following redirects.
+    Yields the `http.client.HTTPResponse` extended with `url` (the final url) and `timings` (`connect`, `tls`, `ttfb`, `transfer` in ms).
+    The connection returns to the pool if the response body was read completely, otherwise it's closed.
+    The `active` set, if any, holds the connection while it's in use; another thread abandons the request by removing the connection and shutting it down, it isn't retried.
+    Raises `urllib.error.HTTPError` for 4xx and 5xx responses.
+    """
+    import http.client
+    from urllib import error, parse
+
+    headers = {'User-Agent': http_user_agent, **headers}
+    for redirect in range(max_redirects + 1):
+        parts = parse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+        target = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        for attempt in range(2):
+            timings = {'connect': 0, 'tls': 0}
+            with _http_lock:
+                connection = _http_pool.get(key, []).pop() if _http_pool.get(key) else None
+                http_stats['requests'] += 1
+            reused = connection is not None
+            if not reused:
+                connection = _http_connect(*key, timings)
+            if active is not None:
+                active.add(connection)
+            t0 = time.perf_counter()
+            try:
+                connection.request(method, target, headers=headers)
+                response = connection.getresponse()
+                break
+            except (OSError, http.client.HTTPException) as ex:
+                connection.close()
+                if not reused or attempt > 0 or (active is not None and connection not in active):
+                    raise
+                if active is not None:
+                    active.discard(connection)
+                with _http_lock:
+                    stale = _http_pool.pop(key, [])     # the peer probably closed its other idle connections too
+                for idle in stale:
+                    idle.close()
+                if verbose: print(f'-- {method} {url} : stale connection ({ex}), retrying')
+        timings['ttfb'] = (time.perf_counter() - t0) * 1000
+
+        location = response.headers.get('Location')
+        if response.status in (301, 302, 303, 307, 308) and location and redirect < max_redirects:
+            response.read()
+            _http_release(key, connection, response, active)
+            if verbose: print(f'    {method} {url} : {response.status} {response.reason} -> {location}')
+            url = parse.urljoin(url, location)
+            if parse.urlsplit(url).netloc != parts.netloc:
+                headers = {name: value for name, value in headers.items() if name.lower() != 'authorization'}   # don't leak credentials to other hosts
+            if response.status == 303 and method != 'HEAD':
+                method = 'GET'
+            continue
+        break
+
+    if response.status >= 400:
+        response.read()
+        _http_release(key, connection, response, active)
+        raise error.HTTPError(url, response.status, response.reason, response.headers, None)
+
+    response.url = url
+    response.timings = timings
+    t0 = time.perf_counter()
+    try:
+        yield response
+    finally:
+        timings['transfer'] = (time.perf_counter() - t0) * 1000
+        _http_release(key, connection, response, active)
+        if verbose: print(f'    {method} {url} : {response.status} {response.reason}, ' + ', '.join(f'{name} {int(value)} ms' for name, value in timings.items()))
+
+
+def _http_release(key, connection, response, active=None):
+    """ Return a connection to the pool if the response was read completely and the server keeps it alive, and remove it from the `active` set. """
+    if active is not None:
+        active.discard(connection)
+    if response.isclosed() and not response.will_close:
+        with _http_lock:
+            _http_pool.setdefault(key, []).append(connection)
     else:
-        url = f'https://api.github.com/repos/{owner}/{repo}/releases/tags/{tag}'
+        connection.close()
 
-    asset_url = None
-    asset_size = None
-    asset_path = None
+
+@traced()
+def download_json(url, headers={}, ttl=None):
+    """
+    Download a JSON document and cache it in `metadatadir` together with its `ETag` and `Last-Modified` headers.
+    A cached document younger than `ttl` seconds is returned without touching the network, an older one is revalidated with a conditional request.
+    Returns the parsed JSON document.
+    """
+    import hashlib, json
+
+    if ttl is None:
+        ttl = metadata_ttl
+    cache_path = os.path.join(metadatadir, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+
+    cached = None
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as fi:
+            cached = json.load(fi)
+        if cached.get('url') != url:
+            cached = None
+    except (OSError, ValueError):
+        pass
+
+    span_set(url=url, cache='miss')
+    if cached and (age := time.time() - cached['timestamp']) < ttl:
+        span_set(cache='hit')
+        print(f'Reuse cached {url}, {int(age)} s old')
+        return cached['json']
 
     t0 = datetime.datetime.now()
-    ssl_context = ssl.create_default_context(cafile=certifi.where())
-    http_request = request.Request(url)
-    http_request.add_header('Accept', 'application/vnd.github.v3+json')
-    if token:
-        http_request.add_header('Authorization', f'Bearer {token}')
-        if verbose: print(f'Info: Found valid GitHub token ({len(token)} chars)')
+    request_headers = dict(headers)
+    if cached and cached.get('etag'):
+        request_headers['If-None-Match'] = cached['etag']
+    if cached and cached.get('last_modified'):
+        request_headers['If-Modified-Since'] = cached['last_modified']
+    with http_open(url, request_headers) as http:
+        body = http.read()
+        status, reason, response_headers = http.status, http.reason, http.headers
+    if status == 304 and cached:
+        response_json = cached['json']     # not modified, doesn't count against GitHub API rate limit
     else:
-        print('Warning: No GitHub token provided, may run into API rate limits')
-    with request.urlopen(http_request, context=ssl_context) as http:
-        import json
-        response_json = json.loads(http.read().decode('utf-8'))
+        response_json = json.loads(body.decode('utf-8'))
+    print(f'Download {url} : {status} {reason}, {int((datetime.datetime.now()-t0).total_seconds()*1000)} ms')
+    if verbose:
+        print(f'    Request headers {list(request_headers.items())}')
+        print(f'    Response headers {response_headers.items()}')
+
+    cached = {
+        'url': url,
+        'timestamp': time.time(),
+        'etag': response_headers.get('ETag', cached.get('etag') if cached else None),
+        'last_modified': response_headers.get('Last-Modified', cached.get('last_modified') if cached else None),
+        'json': response_json,
+        }
+    try:
+        os.makedirs(metadatadir, exist_ok=True)
+        with open(cache_path + '.tmp', 'w', encoding='utf-8') as fo:
+            json.dump(cached, fo)
+        os.replace(cache_path + '.tmp', cache_path)
+    except OSError as ex:
+        print(f'-- download_json("{url}"): {ex}')
+
+    return response_json
+
+
+@traced()
+def download_file(url, path, size=None, headers={}, digest=None, progress=None, cancel=None):
+    """
+    Download `url` to `path`, hashing the data as it streams to disk.
+    When the server supports `Range` requests the file is split in `download_chunk_size` chunks downloaded concurrently by `download_threads` threads into a pre-allocated `path.part` file.
+    Completed chunks are recorded in `path.part.json` so an interrupted download resumes where it left off.
+    Otherwise the file is downloaded in a single stream.
+    The file is renamed to `path` only after it's complete and matches the expected `digest` (e.g. `"sha256:<hex>"`, optional).
+    `progress(received)` is called with `0` when the first response arrives and then with the number of bytes received by each read; an exception raised by it aborts the download.
+    Setting the `cancel` event (a `threading.Event`) abandons the download: pending chunks are cancelled and the connections of running ones are shut down, so no chunk thread outlives it.
+    Returns the SHA-256 hex digest of the file.
+    """
+    import hashlib, json, socket
+    from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+    from urllib import parse
+
+    part_path = path + '.part'
+    state_path = path + '.part.json'
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    hashers = {'sha256': hashlib.sha256()}
+    if digest:
+        algorithm, expected_hash = digest.split(':', 1)
+        hashers.setdefault(algorithm.lower(), hashlib.new(algorithm.lower()))
+
+    def finalize():
+        for algorithm, hasher in hashers.items():
+            if digest and algorithm == digest.split(':', 1)[0].lower() and hasher.hexdigest() != expected_hash.lower():
+                for file in (part_path, state_path):
+                    if os.path.exists(file):
+                        os.remove(file)
+                raise RuntimeError(f'-- {url} {algorithm} mismatch, expected {expected_hash}, got {hasher.hexdigest()}')
+        os.replace(part_path, path)
+        if verbose: print(f'    {", ".join(f"{algorithm}:{hasher.hexdigest()}" for algorithm, hasher in hashers.items())}')
+        return hashers['sha256'].hexdigest()
+
+    def read(http, amount=None):
+        blocks, received = [], 0
+        while amount is None or received < amount:
+            if not (block := http.read(64 * 1024 if amount is None else min(64 * 1024, amount - received))):
+                break
+            blocks.append(block)
+            received += len(block)
+            if progress: progress(len(block))
+        return b''.join(blocks)
+
+    def stream(http):
+        with open(part_path, 'wb') as file:
+            while data := read(http, download_chunk_size):
+                for hasher in hashers.values():
+                    hasher.update(data)
+                file.write(data)
+        if size is not None and (actual_size := os.path.getsize(part_path)) != size:
+            raise RuntimeError(f'-- {url} size mismatch, expected {size} bytes, got {actual_size}')
+        span_set(url=url, bytes=os.path.getsize(part_path), chunks=1)
         print(f'Download {url} : {http.status} {http.reason}, {int((datetime.datetime.now()-t0).total_seconds()*1000)} ms')
+        return finalize()
+
+    # the first chunk doubles as a probe: `206 Partial Content` means ranges are supported, `200 OK` means they aren't
+    t0 = datetime.datetime.now()
+    request_headers = {**headers, 'Accept': 'application/octet-stream', 'Range': f'bytes=0-{download_chunk_size - 1}'}
+    first_chunk = None
+    with http_open(url, request_headers) as http:
+        if progress: progress(0)
         if verbose:
-            print(f'    Request headers {http_request.header_items()}')
-            print(f'    Response headers {http.getheaders()}')
-            for asset in response_json['assets']:
-                print(f'> asset: "{asset["name"]}", {asset["size"]} bytes, {asset["browser_download_url"]}')
-        for asset in response_json['assets']:
-            if 'name' in asset and re.match(name_regex, asset['name'], re.IGNORECASE):
-                asset_url = asset['browser_download_url']
-                asset_size = asset['size']
-                asset_path = os.path.join(outdir, asset['name'])
+            print(f'    Request headers: {list(request_headers.items())}')
+            print(f'    Response headers: {http.getheaders()}')
+        if http.status != 206:
+            return stream(http)     # single stream
+        content_range = re.match(r'^bytes\s+(\d+)-(\d+)/(\d+)$', http.headers.get('Content-Range', ''))
+        if content_range:
+            first, last, total = map(int, content_range.groups())
+            if first != 0 or last != min(download_chunk_size, total) - 1:
+                raise RuntimeError(f'-- {url} returned range {first}-{last}/{total} for range 0-{download_chunk_size - 1}')
+            if size is not None and total != size:
+                raise RuntimeError(f'-- {url} size mismatch, expected {size} bytes, got {total}')
+            final_url, size = http.url, total
+            first_chunk = read(http)
+    if first_chunk is None:
+        # the total length is unknown (`bytes 0-N/*`) or missing, so the file can't be split: it's requested again without `Range`
+        request_headers = {**headers, 'Accept': 'application/octet-stream'}
+        with http_open(url, request_headers) as http:
+            if http.status != 200:
+                raise RuntimeError(f'-- {url} returned {http.status} {http.reason} without a range')
+            return stream(http)     # single stream
+
+    # the final (redirected) url is requested directly, credentials are only sent to the original host
+    chunk_headers = dict(headers)
+    if parse.urlsplit(final_url).netloc != parse.urlsplit(url).netloc:
+        chunk_headers = {name: value for name, value in headers.items() if name.lower() != 'authorization'}
+    chunks = [(offset, min(offset + download_chunk_size, size) - 1) for offset in range(0, size, download_chunk_size)]
+
+    state = {'url': url, 'size': size, 'chunk_size': download_chunk_size, 'done': []}
+    try:
+        with open(state_path, 'r', encoding='utf-8') as fi:
+            resumed = json.load(fi)
+        if all(resumed.get(key) == state[key] for key in ('url', 'size', 'chunk_size')) and os.path.getsize(part_path) == size:
+            state = resumed
+            print(f'Resume "{part_path}", {len(state["done"])}/{len(chunks)} chunks already downloaded')
+    except (OSError, ValueError):
+        pass
+    if not state['done']:
+        with open(part_path, 'wb') as file:
+            file.truncate(size)     # pre-allocate
+
+    # chunks complete out of order, they're kept in memory until all preceding data is hashed
+    # only chunks downloaded by a previous (interrupted) run are read back from disk
+    resumed_chunks = set(state['done'])
+    pending_chunks = {}
+    hashed_chunks = 0
+    state_lock = threading.Lock()
+
+    def save_state():
+        with open(state_path + '.tmp', 'w', encoding='utf-8') as fo:
+            json.dump(state, fo)
+        os.replace(state_path + '.tmp', state_path)
+
+    def hash_chunks():
+        nonlocal hashed_chunks
+        while hashed_chunks < len(chunks):
+            if hashed_chunks in pending_chunks:
+                data = pending_chunks.pop(hashed_chunks)
+            elif hashed_chunks in resumed_chunks:
+                first, last = chunks[hashed_chunks]
+                with open(part_path, 'rb') as file:
+                    file.seek(first)
+                    data = file.read(last - first + 1)
+            else:
                 break
+            for hasher in hashers.values():
+                hasher.update(data)
+            hashed_chunks += 1
+
+    def write_chunk(index, data):
+        first, last = chunks[index]
+        if len(data) != last - first + 1:
+            raise RuntimeError(f'-- {final_url} returned {len(data)} bytes for range {first}-{last}')
+        with open(part_path, 'r+b') as file:
+            file.seek(first)
+            file.write(data)
+        with state_lock:
+            state['done'].append(index)
+            save_state()
+            pending_chunks[index] = data
+            hash_chunks()
+
+    running = set()     # connections of the chunks being downloaded, see `http_open`
+
+    def download_chunk(index):
+        first, last = chunks[index]
+        if cancel is not None and cancel.is_set():
+            raise RuntimeError(f'-- {final_url} abandoned')
+        with http_open(final_url, {**chunk_headers, 'Accept': 'application/octet-stream', 'Range': f'bytes={first}-{last}'}, active=running) as http:
+            if http.status != 206:
+                raise RuntimeError(f'-- {final_url} returned {http.status} {http.reason} for range {first}-{last}')
+            write_chunk(index, read(http))
+
+    if 0 not in resumed_chunks:
+        write_chunk(0, first_chunk)
+    with state_lock:
+        hash_chunks()
+    pending = [index for index in range(1, len(chunks)) if index not in resumed_chunks]
+    executor = ThreadPoolExecutor(max_workers=download_threads)
+    try:
+        futures = [executor.submit(download_chunk, index) for index in pending]
+        while futures:
+            done, futures = wait(futures, timeout=0.1, return_when=FIRST_EXCEPTION)
+            for future in done:
+                future.result()
+            if cancel is not None and cancel.is_set():
+                raise RuntimeError(f'-- {final_url} abandoned')
+    except BaseException:
+        while cancel is not None and cancel.is_set() and running:
+            connection = running.pop()
+            if connection.sock is not None:
+                with contextlib.suppress(OSError):
+                    socket.socket.shutdown(connection.sock, socket.SHUT_RDWR)    # unblocks reads, TLS sockets included
+            connection.close()
+        raise
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+    assert hashed_chunks == len(chunks), f'-- {hashed_chunks}/{len(chunks)} chunks hashed'
+
+    sha256 = finalize()
+    os.remove(state_path)
+    span_set(url=url, bytes=size, chunks=len(chunks), resumed=len(resumed_chunks))
+    print(f'Download {url} : {len(chunks)} chunks of {download_chunk_size} bytes, {int((datetime.datetime.now()-t0).total_seconds()*1000)} ms')
+    return sha256
+
+
+@traced()
+def download_hedged(urls, path, size=None, headers={}, digest=None):
+    """
+    Download the same file from the first of several candidate `urls` (e.g. GitHub, SourceForge mirrors, an internal mirror) that delivers it.
+    Candidates are tried in order: the next one starts as soon as every running request has failed, waited more than `hedge_ttfb` seconds for its first byte, or is receiving less than `hedge_throughput` bytes/s.
+    The first download that completes and matches `digest` wins; the others are abandoned. `headers` are only sent to the host of the first url.
+    Returns the SHA-256 hex digest of the file.
+    """
+    import queue
+    from urllib import parse
+
+    urls = list(urls)
+    if len(urls) == 1:
+        return download_file(urls[0], path, size, headers, digest)
+
+    finished = threading.Event()
+    results = queue.Queue()
+    attempts = []
+    parent = span_current()
+
+    def attempt(index):
+        span_inherit(parent)
+        state = attempts[index]
+        def progress(received):
+            if finished.is_set():
+                raise RuntimeError('-- abandoned, another source finished first')
+            state['first_byte'] = state['first_byte'] or time.monotonic()
+            state['received'] += received
+        attempt_headers = headers if parse.urlsplit(urls[index]).netloc == parse.urlsplit(urls[0]).netloc else {}
+        try:
+            sha256 = download_file(urls[index], state['path'], size, attempt_headers, digest, progress, cancel=finished)
+            if finished.is_set():
+                os.remove(state['path'])    # finished second
+            results.put((index, sha256, None))
+        except Exception as ex:
+            for file in (state['path'] + '.part', state['path'] + '.part.json'):
+                if finished.is_set() and os.path.exists(file):
+                    os.remove(file)     # abandoned, nothing to resume
+            results.put((index, None, ex))
+
+    def start():
+        attempts.append({'path': f'{path}.{len(attempts)}', 'started': time.monotonic(), 'first_byte': None, 'received': 0, 'running': True})
+        if len(attempts) > 1:
+            print(f'Hedge {urls[len(attempts) - 1]} ({len(attempts)}/{len(urls)})')
+        threading.Thread(target=attempt, args=(len(attempts) - 1,), daemon=True).start()    # a stalled source must not delay the exit
+
+    def slow(state):
+        now = time.monotonic()
+        if state['first_byte'] is None:
+            return now - state['started'] > hedge_ttfb
+        return now - state['first_byte'] > hedge_ttfb and state['received'] / (now - state['first_byte']) < hedge_throughput
+
+    errors = []
+    start()
+    try:
+        while any(state['running'] for state in attempts):
+            try:
+                index, sha256, error = results.get(timeout=0.1)
+            except queue.Empty:
+                pass
+            else:
+                attempts[index]['running'] = False
+                if error is None:
+                    finished.set()
+                    os.replace(attempts[index]['path'], path)
+                    if len(attempts) > 1:
+                        print(f'Hedge winner {urls[index]} ({index + 1}/{len(urls)})')
+                    span_set(sources=len(attempts), winner=index)
+                    return sha256
+                print(error if str(error).startswith('-- ') else f'-- {urls[index]}: {error}')
+                errors.append(error)
+            if len(attempts) < len(urls) and all(slow(state) for state in attempts if state['running']):
+                start()
+    finally:
+        finished.set()
+        while not results.empty():
+            if (result := results.get())[2] is None and os.path.exists(attempts[result[0]]['path']):
+                os.remove(attempts[result[0]]['path'])  # finished second, before the winner was picked
+    raise RuntimeError(f'-- all {len(urls)} sources failed, last error: {errors[-1]}')
+
+
+@traced()
+def download_cached(url, name, outdir, size=None, digest=None, headers={}, mirrors=()):
+    """
+    Download `url` into the content-addressed store `outdir`, as `outdir/<sha256>/<name>`.
+    Alternative `mirrors` of the same file are raced against `url` by `download_hedged`.
+    A file already in the store is reused at the cost of one `stat`, it's found by its SHA-256 `digest`, or by any other digest or url it was downloaded with before.
+    Files modified since they were stored are hashed again, and downloaded again if their content changed.
+    The least recently used files are evicted when the store grows beyond `downloads_cache_size` bytes.
+    Returns the path to the file.
+    """
+    import json, shutil
 
-    if asset_url is None:
-        raise ValueError(f'No asset matching "{name_regex}"')
+    index_path = os.path.join(outdir, 'index.json')
+    try:
+        with open(index_path, 'r', encoding='utf-8') as fi:
+            index = json.load(fi)
+    except (OSError, ValueError):
+        index = {'files': {}, 'aliases': {}}
+
+    def save_index():
+        os.makedirs(outdir, exist_ok=True)
+        with open(index_path + '.tmp', 'w', encoding='utf-8') as fo:
+            json.dump(index, fo, indent=2)
+        os.replace(index_path + '.tmp', index_path)
+
+    if digest and digest.lower().startswith('sha256:'):
+        sha256 = digest.split(':', 1)[1].lower()
+    else:
+        sha256 = index['aliases'].get(digest.lower() if digest else url)
 
-    if os.path.exists(asset_path) and os.path.getsize(asset_path) == asset_size:
-        print(f'Reuse existing "{asset_path}", {asset_size} bytes')
-        return asset_path
+    if sha256 and (entry := index['files'].get(sha256)):
+        file_path = os.path.join(outdir, sha256, entry['name'])
+        try:
+            stat = os.stat(file_path)
+            if stat.st_size == entry['size'] and (size is None or size == entry['size']):
+                if stat.st_mtime_ns != entry.get('mtime') and file_sha256(file_path) != sha256:
+                    print(f'-- "{file_path}" was modified, downloading it again')
+                    raise OSError
+                span_set(name=name, bytes=entry['size'], cache='hit')
+                print(f'Reuse existing "{file_path}", {entry["size"]} bytes')
+                entry['used'], entry['mtime'] = time.time(), stat.st_mtime_ns
+                save_index()
+                return file_path
+        except OSError:
+            pass
+
+    span_set(name=name, cache='miss')
+    incoming_path = os.path.join(outdir, 'incoming', name)
+    sha256 = download_hedged([url, *mirrors], incoming_path, size, headers, digest)
+    file_path = os.path.join(outdir, sha256, name)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    os.replace(incoming_path, file_path)
+
+    stat = os.stat(file_path)
+    index['files'][sha256] = {'name': name, 'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'used': time.time()}
+    span_set(bytes=index['files'][sha256]['size'])
+    index['aliases'][url] = sha256
+    if digest:
+        index['aliases'][digest.lower()] = sha256
+
+    # evict least recently used files
+    total_size = sum(entry['size'] for entry in index['files'].values())
+    for evicted in sorted(index['files'], key=lambda key: index['files'][key]['used']):
+        if total_size <= downloads_cache_size or evicted == sha256:
+            break
+        shutil.rmtree(os.path.join(outdir, evicted), ignore_errors=True)
+        total_size -= index['files'].pop(evicted)['size']
+        index['aliases'] = {alias: key for alias, key in index['aliases'].items() if key != evicted}
+        print(f'Evicted "{os.path.join(outdir, evicted)}" from download cache')
+
+    save_index()
+    return file_path
+
+
+def github_release_asset(owner, repo, tag, name_regex, token):
+    """
+    Find a GitHub release asset matching the specified regex, without downloading it.
+    Release metadata is cached (see `download_json`).
+    Returns a dictionary with the asset `name`, `url`, `size`, `digest` and the `headers` to download it with.
+    """
+    if tag.lower() == 'latest':
+        url = f'{github_api_url}/repos/{owner}/{repo}/releases/latest'
+    else:
+        url = f'{github_api_url}/repos/{owner}/{repo}/releases/tags/{tag}'
 
-    t0 = datetime.datetime.now()
-    http_request = request.Request(asset_url)
-    http_request.add_header('Accept', 'application/octet-stream')
+    headers = {'Accept': 'application/vnd.github.v3+json'}
     if token:
-        http_request.add_header('Authorization', f'Bearer {token}')
-    with request.urlopen(http_request, context=ssl_context) as http:
-        if not os.path.exists(outdir):
-            os.makedirs(outdir, exist_ok=True)
-        with open(asset_path, 'wb') as file:
-            shutil.copyfileobj(http, file)
-            print(f'Download {asset_url} : {http.status} {http.reason}, {int((datetime.datetime.now()-t0).total_seconds()*1000)} ms')
-            if verbose:
-                print(f'    Request headers: {http_request.header_items()}')
-                print(f'    Response headers: {http.getheaders()}')
-        return asset_path
-    return None
+        headers['Authorization'] = f'Bearer {token}'
+        if verbose: print(f'Info: Found valid GitHub token ({len(token)} chars)')
+    else:
+        print('Warning: No GitHub token provided, may run into API rate limits')
+    response_json = download_json(url, headers)
+    if verbose:
+        for asset in response_json['assets']:
+            print(f'> asset: "{asset["name"]}", {asset["size"]} bytes, {asset["browser_download_url"]}')
+    for asset in response_json['assets']:
+        if 'name' in asset and re.match(name_regex, asset['name'], re.IGNORECASE):
+            return {
+                'tag': response_json.get('tag_name', tag),
+                'name': asset['name'],
+                'url': asset['browser_download_url'],
+                'size': asset['size'],
+                'digest': asset.get('digest'),    # "sha256:<hex>", published for assets uploaded since mid 2025
+                'headers': {'Authorization': f'Bearer {token}'} if token else {},
+                }
+
+    raise ValueError(f'No asset matching "{name_regex}"')
+
+
+def github_release_tag(owner, repo, name_regex, token):
+    """
+    Find the most recent GitHub release that has an asset matching the specified regex.
+    Release metadata is cached (see `download_json`).
+    Returns the release tag.
+    """
+    headers = {'Accept': 'application/vnd.github.v3+json'}
+    if token:
+        headers['Authorization'] = f'Bearer {token}'
+    for release in download_json(f'{github_api_url}/repos/{owner}/{repo}/releases?per_page=100', headers):
+        if any(re.match(name_regex, asset.get('name', ''), re.IGNORECASE) for asset in release['assets']):
+            return release['tag_name']
+    raise ValueError(f'No release with an asset matching "{name_regex}"')
 
 
-def download_sourceforge_file(project, outdir, platform='windows'):
-    url = f'https://sourceforge.net/projects/{project}/best_release.json'
-    file_url = None
-    file_size = None
-    file_path = None
+def download_github_asset(owner, repo, tag, name_regex, token, outdir):
+    """
+    Download a GitHub release asset matching the specified regex.
+    Release metadata is cached (see `download_json`).
+    Returns the path to the downloaded file.
+    """
+    asset = github_release_asset(owner, repo, tag, name_regex, token)
+    return download_cached(asset['url'], asset['name'], outdir, asset['size'], asset['digest'], asset['headers'])
 
-    t0 = datetime.datetime.now()
-    ssl_context = ssl.create_default_context(cafile=certifi.where())
-    http_request = request.Request(url)
-    http_request.add_header('Accept', 'application/json')
-    with request.urlopen(http_request, context=ssl_context) as http:
-        import json
-        response_json = json.loads(http.read().decode('utf-8'))
-        # print(response_json)
-        print(f'Download {url} : {http.status} {http.reason}, {int((datetime.datetime.now()-t0).total_seconds()*1000)} ms')
-        if verbose:
-            print(f'    Request headers {http_request.header_items()}')
-            print(f'    Response headers {http.getheaders()}')
-            for release_name in response_json['platform_releases']:
-                release = response_json['platform_releases'][release_name]
-                print(f'> platform: "{release_name}", file: {os.path.basename(release["filename"])}, date: {release["date"]}, bytes: {release["bytes"]}, url: {release["url"]}')
-        file_url = response_json['platform_releases'][platform]['url']
-        file_size = response_json['platform_releases'][platform]['bytes']
-        file_name = os.path.basename(response_json['platform_releases'][platform]['filename'])
-        file_path = os.path.join(outdir, file_name)
-
-    if file_url is None:
+
+def sourceforge_release_file(project, platform='windows'):
+    """
+    Find the best release of a SourceForge project for the specified platform, without downloading it.
+    Release metadata is cached (see `download_json`).
+    Returns a dictionary with the file `name`, `url`, `size`, `digest` and the `headers` to download it with.
+    """
+    url = f'{sourceforge_url}/projects/{project}/best_release.json'
+    response_json = download_json(url, {'Accept': 'application/json'})
+    if verbose:
+        for release_name in response_json['platform_releases']:
+            release = response_json['platform_releases'][release_name]
+            print(f'> platform: "{release_name}", file: {os.path.basename(release["filename"])}, date: {release["date"]}, bytes: {release["bytes"]}, url: {release["url"]}')
+
+    if (release := response_json['platform_releases'].get(platform)) is None or release.get('url') is None:
         raise ValueError(f'No file matching platform "{platform}"')
+    file_url = release['url']
     if file_url.startswith('http://'):
         file_url = file_url.replace('http://', 'https://')
 
-    if os.path.exists(file_path) and os.path.getsize(file_path) == file_size:
-        print(f'Reuse existing "{file_path}", {file_size} bytes')
-        return file_path
+    return {
+        'tag': os.path.basename(os.path.dirname(release['filename'])) or None,     # "/NSIS 3/3.11/nsis-3.11-setup.exe" => "3.11"
+        'name': os.path.basename(release['filename']),
+        'url': file_url,
+        'size': release['bytes'],
+        'digest': f'md5:{md5}' if (md5 := release.get('md5sum')) else None,
+        'headers': {},
+        }
 
-    t0 = datetime.datetime.now()
-    http_request = request.Request(file_url)
-    http_request.add_header('Accept', 'application/octet-stream')
-    with request.urlopen(http_request, context=ssl_context) as http:
-        if not os.path.exists(outdir):
-            os.makedirs(outdir, exist_ok=True)
-        with open(file_path, 'wb') as file:
-            shutil.copyfileobj(http, file)
-            print(f'Download {file_url} : {http.status} {http.reason}, {int((datetime.datetime.now()-t0).total_seconds()*1000)} ms')
-            if verbose:
-                print(f'    Request headers: {http_request.header_items()}')
-                print(f'    Response headers: {http.getheaders()}')
-        return file_path
-    return None
+
+def download_sourceforge_file(project, outdir, platform='windows'):
+    """
+    Download the best release of a SourceForge project for the specified platform.
+    Release metadata is cached (see `download_json`).
+    Returns the path to the downloaded file.
+    """
+    file = sourceforge_release_file(project, platform)
+    return download_cached(file['url'], file['name'], outdir, file['size'], file['digest'], file['headers'])
+
+
+def pe_info(path, arch_only=False):
+    """
+    Read PE file metadata in one pass over a read-only memory map, without copying or executing anything.
+    With `arch_only`, parsing stops after the COFF header, so damaged sections or resources don't matter.
+    Returns a dictionary:
+      `arch`: `x86`, `amd64`, `arm64`, `ia64` or `None`
+      `machine`: COFF machine type
+      `pe32plus`: `True` for 64-bit (PE32+) optional headers
+      `sections`: section names
+      `file_version`, `product_version`: from `VS_FIXEDFILEINFO` (e.g. `"3.11.7461.288"`), `None` without a version resource
+      `strings`: `StringFileInfo` strings (e.g. `{"FileVersion": "...", "ProductName": "..."}`)
+    Raises `ValueError` if the file is not a valid PE file.
+    """
+    import mmap
+    with open(path, "rb") as fi:
+        try:
+            mapping = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise ValueError("Not a valid PE file (empty).")
+        with mapping:
+            data = memoryview(mapping)
+            try:
+                return _pe_parse(data, arch_only)
+            except struct.error as ex:
+                error = f"Truncated PE file ({ex})."
+            except ValueError as ex:
+                error = str(ex)
+            finally:
+                data.release()
+        # raised after the traceback, and the slices its frames hold, are gone; closing the mapping with live slices raises `BufferError`
+        raise ValueError(error)
+
+
+def _pe_parse(data, arch_only=False):
+    # DOS header: e_lfanew (offset to PE header)
+    if len(data) < 0x40:
+        raise ValueError("Not a valid PE file (cannot read e_lfanew).")
+    (e_lfanew,) = struct.unpack_from("<I", data, 0x3C)
+
+    # PE signature + COFF header (IMAGE_FILE_HEADER, 20 bytes)
+    if data[e_lfanew:e_lfanew+4] != b"PE\x00\x00":
+        raise ValueError("PE signature not found.")
+    machine, section_count, _, _, _, optional_size, _ = struct.unpack_from("<HHIIIHH", data, e_lfanew + 4)
+
+    # https://learn.microsoft.com/en-us/windows/win32/sysinfo/image-file-machine-constants
+    machines = {0x014c: 'x86', 0x8664: 'amd64', 0xaa64: 'arm64', 0x0200: 'ia64'}
+    info = {'arch': machines.get(machine, None), 'machine': machine, 'pe32plus': False, 'sections': [], 'file_version': None, 'product_version': None, 'strings': {}}
+    if optional_size == 0 or arch_only:
+        return info     # object file
+
+    # optional header: magic and data directories
+    optional = e_lfanew + 24
+    (magic,) = struct.unpack_from("<H", data, optional)
+    info['pe32plus'] = magic == 0x20b
+    directories = optional + (112 if info['pe32plus'] else 96)
+    (directory_count,) = struct.unpack_from("<I", data, directories - 4)
+    resource_rva, resource_size = struct.unpack_from("<II", data, directories + 2*8) if directory_count > 2 else (0, 0)
+
+    # section table (IMAGE_SECTION_HEADER, 40 bytes each)
+    sections = []
+    for offset in range(optional + optional_size, optional + optional_size + section_count*40, 40):
+        name, virtual_size, virtual_address, raw_size, raw_offset = struct.unpack_from("<8sIIII", data, offset)
+        info['sections'].append(name.rstrip(b'\0').decode('ascii', 'replace'))
+        sections.append((virtual_address, max(virtual_size, raw_size), raw_offset))
+
+    def offset_of(rva):
+        for virtual_address, size, raw_offset in sections:
+            if virtual_address <= rva < virtual_address + size:
+                return rva - virtual_address + raw_offset
+        raise ValueError(f"RVA {hex(rva)} outside of all sections.")
+
+    if not resource_rva or not resource_size:
+        return info
+
+    # resource tree: type RT_VERSION (16) -> first name -> first language -> IMAGE_RESOURCE_DATA_ENTRY
+    resources = offset_of(resource_rva)
+    def first_entry(directory, id=None):
+        named, ids = struct.unpack_from("<HH", data, directory + 12)
+        for entry in range(directory + 16, directory + 16 + (named + ids)*8, 8):
+            name, target = struct.unpack_from("<II", data, entry)
+            if id is None or name == id:
+                return target
+        return None
+    entry = first_entry(resources, 16)
+    for level in range(2):
+        if entry is None or not entry & 0x80000000:
+            return info
+        entry = first_entry(resources + (entry & 0x7FFFFFFF))
+    if entry is None or entry & 0x80000000:
+        return info
+    version_rva, version_size = struct.unpack_from("<II", data, resources + entry)
+    version = data[offset_of(version_rva):offset_of(version_rva) + version_size]
+
+    # VS_VERSIONINFO -> VS_FIXEDFILEINFO + StringFileInfo -> StringTable -> String
+    key, value, children, end = _pe_version_block(version, 0)
+    if key == 'VS_VERSION_INFO' and len(value) >= 52:
+        signature, _, file_ms, file_ls, product_ms, product_ls = struct.unpack_from("<6I", value)
+        if signature == 0xFEEF04BD:
+            info['file_version'] = f'{file_ms >> 16}.{file_ms & 0xFFFF}.{file_ls >> 16}.{file_ls & 0xFFFF}'
+            info['product_version'] = f'{product_ms >> 16}.{product_ms & 0xFFFF}.{product_ls >> 16}.{product_ls & 0xFFFF}'
+    while children < end:
+        key, value, tables, child_end = _pe_version_block(version, children)
+        if key == 'StringFileInfo':
+            while tables < child_end:
+                _, _, strings, table_end = _pe_version_block(version, tables)
+                while strings < table_end:
+                    name, value, _, string_end = _pe_version_block(version, strings)
+                    info['strings'][name] = bytes(value).decode('utf-16-le').rstrip('\0')
+                    strings = (string_end + 3) & ~3
+                tables = (table_end + 3) & ~3
+        children = (child_end + 3) & ~3
+    return info
+
+
+def _pe_version_block(data, offset):
+    """ Parse a `VS_VERSIONINFO` block header at `offset`. Returns `(key, value, children_offset, end_offset)`. """
+    length, value_length, value_type = struct.unpack_from("<HHH", data, offset)
+    if length < 6:
+        raise ValueError(f"Invalid version block at {offset}.")
+    key_end = offset + 6
+    while data[key_end:key_end+2] != b'\0\0':
+        if key_end >= len(data):
+            raise ValueError(f"Unterminated version block key at {offset}.")
+        key_end += 2
+    key = bytes(data[offset+6:key_end]).decode('utf-16-le')
+    value_offset = (key_end + 2 + 3) & ~3
+    value_end = value_offset + (value_length * 2 if value_type == 1 else value_length)     # text values are measured in characters
+    return key, data[value_offset:value_end], (value_end + 3) & ~3, offset + length
 
 
 def pe_architecture(path):
     """ Return the architecture of a PE file (`x86`, `amd64`, `arm64`). """
-    with open(path, "rb") as fi:
-        # Read DOS header to get e_lfanew (offset to PE header)
-        fi.seek(0x3C)
-        data = fi.read(4)
-        if len(data) != 4:
-            raise ValueError("Not a valid PE file (cannot read e_lfanew).")
-        (e_lfanew,) = struct.unpack("<I", data)
-
-        # Read PE signature + COFF header (at e_lfanew)
-        fi.seek(e_lfanew)
-        sig = fi.read(4)
-        if sig != b"PE\x00\x00":
-            raise ValueError("PE signature not found.")
-
-        coff = fi.read(20)  # IMAGE_FILE_HEADER is 20 bytes
-        if len(coff) != 20:
-            raise ValueError("Truncated COFF header.")
-        (machine,) = struct.unpack("<H", coff[:2])
-
-        # https://learn.microsoft.com/en-us/windows/win32/sysinfo/image-file-machine-constants
-        machines = {0x014c: 'x86', 0x8664: 'amd64', 0xaa64: 'arm64', 0x0200: 'ia64'}
-        return machines.get(machine, None)
-    return None
+    return pe_info(path, arch_only=True)['arch']
 
 
-def nsis_version(instdir):
-    """ Query NSIS version by executing `makensis.exe /VERSION` in the specified installation directory. Returns `None` on error. """
+_nsis_versions = None    # {makensis realpath: {'size', 'mtime', 'version'}}, loaded from `versionsfile`
+_nsis_versions_lock = threading.Lock()
+
+def nsis_version(instdir, timeout=None):
+    """
+    Query NSIS version by executing `makensis.exe /VERSION` in the specified installation directory (`PATH` if empty). Returns `None` on error.
+    Results are cached in `versionsfile`, keyed by the executable's real path, size and modification time, so later steps of the same job reuse them.
+    """
+    global _nsis_versions
+    import json, shutil, subprocess
+    name = 'makensis.exe' if os.name == 'nt' else 'makensis'
     try:
-        process = subprocess.Popen([os.path.join(instdir if instdir is not None else '', 'makensis.exe'), '/VERSION'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        cout, cerr = process.communicate()
-        process.wait()
-        if cout != None:
-            for line in cout.decode('utf-8').split("\r\n"):
-                if (matches := re.search(r'^v(\d+\.\d+(\.\d+(\.\d+)?)?)', line)) != None:   # look for "v1.2[.3[.4]]"
-                    return matches.group(1)
+        makensis = os.path.join(instdir, name) if instdir else shutil.which(name)
+        if makensis is None:
+            raise FileNotFoundError(f'{name} not found in PATH')
+        realpath = os.path.realpath(makensis)
+        stat = os.stat(realpath)
+
+        with _nsis_versions_lock:
+            if _nsis_versions is None:
+                try:
+                    with open(versionsfile, 'r', encoding='utf-8') as fi:
+                        _nsis_versions = json.load(fi)
+                except (OSError, ValueError):
+                    _nsis_versions = {}
+            if (cached := _nsis_versions.get(realpath)) and cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime_ns:
+                return cached['version']
+
+        process = subprocess.run([makensis, '/VERSION'], capture_output=True, timeout=timeout or nsis_version_timeout)
+        version = None
+        for line in process.stdout.decode('utf-8').splitlines():
+            if (matches := re.search(r'^v(\d+\.\d+(\.\d+(\.\d+)?)?)', line)) != None:   # look for "v1.2[.3[.4]]"
+                version = matches.group(1)
+                break
+
+        if version:
+            with _nsis_versions_lock:
+                _nsis_versions[realpath] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'version': version}
+                os.makedirs(os.path.dirname(versionsfile), exist_ok=True)
+                with open(versionsfile + '.tmp', 'w', encoding='utf-8') as fo:
+                    json.dump(_nsis_versions, fo, indent=2)
+                os.replace(versionsfile + '.tmp', versionsfile)
+        return version
     except Exception as ex:
         print(f'-- get_nsis_version("{instdir}"): {ex}')
     return None
 
 
-def nsis_list():
-    """
-    List all NSIS installations found in the registry and default locations.
-    Returns:
-      list: `[(makensis1, instdir1), ...]`
-    """
-    installations = []
+@traced()
+def nsis_versions(instdirs, timeout=None):
+    """ Query the versions of multiple NSIS installations concurrently (see `nsis_version`). Returns `{instdir: version}`. """
+    from concurrent.futures import ThreadPoolExecutor
+    instdirs = list(instdirs)
+    if len(instdirs) <= 1:
+        return {instdir: nsis_version(instdir, timeout) for instdir in instdirs}
+    with ThreadPoolExecutor(max_workers=min(len(instdirs), 8)) as executor:
+        return dict(zip(instdirs, executor.map(lambda instdir: nsis_version(instdir, timeout), instdirs)))
 
-    candidate_list = []
-    def candidate_add(path):
-        path = os.path.normpath(os.path.expandvars(path))
-        for candidate in candidate_list:
-            if path.casefold() == candidate.casefold():
-                return
-        candidate_list.append(path)
 
+def nsis_registry_locations():
+    """ Return the `InstallLocation` values of all NSIS installations registered in `HKLM` and `HKCU` (both registry views). """
+    locations = []
     if os.name == 'nt':
         import winreg
-        uninstall_key = r"SOFTWARE\Microsoft\Windows\CurrentVersion\Uninstall\NSIS"
+        uninstall_key = nsis_uninstall_key
         for registry in [
             {'hive': winreg.HKEY_LOCAL_MACHINE, 'hivename': "HKLM", 'view': winreg.KEY_WOW64_64KEY},
             {'hive': winreg.HKEY_LOCAL_MACHINE, 'hivename': "HKLM", 'view': winreg.KEY_WOW64_32KEY},
@@ -321,90 +1288,623 @@ def nsis_list():
                 with winreg.OpenKey(registry['hive'], uninstall_key, access= winreg.KEY_READ|registry['view']) as regkey:
                     if verbose: print(f'>> "{registry["hivename"]}\\{uninstall_key}" ({"wow64" if registry["view"] == winreg.KEY_WOW64_32KEY else "nativ"}): found')
                     dir, regtype = winreg.QueryValueEx(regkey, "InstallLocation")
-                    winreg.CloseKey(regkey)
-                    candidate_add(dir)
+                    locations.append(dir)
             except Exception as ex:
                 if verbose: print(f'-- "{registry["hivename"]}\\{uninstall_key}" ({"wow64" if registry["view"] == winreg.KEY_WOW64_32KEY else "nativ"}): {ex}')
+    return locations
+
+
+_nsis_list_cache = {}   # {fingerprint: installations}
+
+def nsis_list_invalidate():
+    """ Forget cached `nsis_list` results. Called after NSIS is installed or uninstalled. """
+    _nsis_list_cache.clear()
+
+
+@traced()
+def nsis_list(registry=None, probe=None):
+    """
+    List all NSIS installations found in the registry, default locations and `PATH`.
+    Results are cached, keyed by `PATH` and the registry `InstallLocation` values, and recomputed when either changes.
+    Registry and filesystem access can be replaced, e.g. for benchmarking:
+      `registry()` returns the `InstallLocation` values (default `nsis_registry_locations`)
+      `probe(path)` tells whether a file exists (default `os.path.isfile`)
+    Returns:
+      list: `[(makensis1, instdir1), ...]`
+    """
+    registry = registry or nsis_registry_locations
+    probe = probe or os.path.isfile
+
+    locations = registry()
+    fingerprint = (os.environ.get('PATH', ''), tuple(locations), registry, probe)
+    if (installations := _nsis_list_cache.get(fingerprint)) is not None:
+        return list(installations)
+
+    candidate_list = []
+    candidate_keys = set()
+    def candidate_add(path):
+        path = os.path.normpath(os.path.expandvars(path))
+        if (key := path.casefold()) not in candidate_keys:
+            candidate_keys.add(key)
+            candidate_list.append(path)
+
+    for dir in locations:
+        candidate_add(dir)
 
     if os.name == 'nt':
         candidate_add(r'%ProgramFiles%\NSIS')
         candidate_add(r'%ProgramFiles(x86)%\NSIS')
 
-    for path in os.environ.get('PATH', '').split(os.pathsep):
+    for path in fingerprint[0].split(os.pathsep):
         candidate_add(path)
 
+    installations = []
+    installation_keys = set()
     for dir in candidate_list:
         makensis = os.path.join(dir, 'makensis.exe' if os.name == 'nt' else 'makensis')
-        if os.path.exists(makensis):
+        if probe(makensis):
             makensis = os.path.realpath(makensis)   # resolve symlinks
-            instdir =os.path.dirname(makensis)
+            instdir = os.path.dirname(makensis)
             if instdir == '/usr/bin' or instdir == '/usr/local/bin':
                 assert os.name == 'posix'
                 instdir = '/usr/share/nsis'
-                ensure(os.path.exists(instdir) and os.path.isdir(instdir), f'Invalid NSIS share directory: "{instdir}"')
+                if not os.path.isdir(instdir):
+                    raise RuntimeError(f'-- Invalid NSIS share directory: "{instdir}"')
             elif os.path.basename(instdir).casefold() == 'bin' and sys.platform == 'darwin':
                 instdir = os.path.dirname(instdir)  # /opt/homebrew/Cellar/makensis/3.11/bin -> /opt/homebrew/Cellar/makensis/3.11/share/nsis
                 instdir += '/share/nsis'
-                ensure(os.path.exists(instdir) and os.path.isdir(instdir), f'Invalid NSIS share directory: "{instdir}"')
+                if not os.path.isdir(instdir):
+                    raise RuntimeError(f'-- Invalid NSIS share directory: "{instdir}"')
 
-            unique = True
-            for makensis0, instdir0 in installations:
-                if makensis0.casefold() == makensis.casefold():
-                    unique = False
-                    break
-            if unique:
+            if (key := makensis.casefold()) not in installation_keys:
+                installation_keys.add(key)
                 installations.append((makensis, instdir))
 
-    return installations
+    _nsis_list_cache[fingerprint] = installations
+    return list(installations)
+
+
+# files expected in each distro, `{arch}` is replaced with the compiler architecture
+nsis_manifests = {
+    'negrutiu': [
+        {'path': 'makensis.exe', 'arch': '{arch}'},
+        {'path': 'Bin/makensis.exe', 'arch': '{arch}'},
+        *({'path': f'Plugins/{target}/{plugin}', 'arch': target.split('-')[0]} for target in ['x86-unicode', 'x86-ansi', 'amd64-unicode'] for plugin in ['System.dll', 'Math.dll', 'NScurl.dll']),
+        {'path': 'Include/MUI2.nsh'},
+        {'path': 'Include/LogicLib.nsh'},
+        ],
+    'official': [
+        {'path': 'makensis.exe', 'arch': '{arch}'},
+        {'path': 'Bin/makensis.exe', 'arch': '{arch}'},
+        *({'path': f'Plugins/{target}/{plugin}', 'arch': target.split('-')[0]} for target in ['x86-unicode', 'x86-ansi'] for plugin in ['System.dll', 'Math.dll']),
+        {'path': 'Include/MUI2.nsh'},
+        {'path': 'Include/LogicLib.nsh'},
+        ],
+    }
+
+
+def nsis_manifest(distro, arch):
+    """
+    Return the files expected in an NSIS installation.
+    Returns:
+      list: `[{'path': 'Bin/makensis.exe', 'arch': 'x86'}, ...]`
+    """
+    return [{name: value.format(arch=arch) if isinstance(value, str) else value for name, value in entry.items()} for entry in nsis_manifests[distro.lower()]]
 
 
-def nsis_install(arch, distro='negrutiu', instdir=None, register_path=True, github_token=None):
-    """ Download and install the latest [negrutiu/nsis](https://github.com/negrutiu/nsis) release.
-        Returns:
-            `(instdir, version, arch)` or raises on error. """
-    # normalize architecture
-    finalarch = None
+def release_manifest(release):
+    """
+    Load the full manifest (see `manifest_create`) recorded by `nsis_install` after a clean installation of `release`.
+    Manifests are stored next to the installer in the download store, `downloadsdir/<sha256>/manifest.json`, so they are keyed by the installer's content and evicted with it.
+    Returns the manifest, or `None` if the release was never installed from this download store.
+    """
+    import json
+    digest = (release.get('digest') or '').lower()
+    try:
+        if digest.startswith('sha256:'):
+            sha256 = digest.split(':', 1)[1]
+        else:
+            with open(os.path.join(downloadsdir, 'index.json'), 'r', encoding='utf-8') as fi:
+                sha256 = json.load(fi)['aliases'].get(digest or release['url'])
+        with open(os.path.join(downloadsdir, sha256, 'manifest.json'), 'r', encoding='utf-8') as fi:
+            return json.load(fi)
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def file_sha256(path):
+    """ Return the SHA-256 hex digest of a file. """
+    import hashlib
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as fi:
+        while data := fi.read(1024 * 1024):
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
+def manifest_create(instdir, max_workers=None):
+    """
+    Describe every file in `instdir`, e.g. to verify a copy of the same installation later.
+    Returns:
+      list: `[{'path': 'Bin/makensis.exe', 'size': 123, 'sha256': '...', 'arch': 'x86'}, ...]`, `arch` only for PE files
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    files = []
+    for dirpath, _, filenames in os.walk(instdir):
+        files.extend(os.path.join(dirpath, filename) for filename in filenames)
+
+    def describe(file):
+        entry = {'path': os.path.relpath(file, instdir).replace(os.sep, '/'), 'size': os.path.getsize(file)}
+        entry['sha256'] = file_sha256(file)
+        if file.lower().endswith(('.exe', '.dll')):
+            entry['arch'] = pe_architecture(file)
+        return entry
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return sorted(executor.map(describe, files), key=lambda entry: entry['path'])
+
+
+@traced()
+def manifest_verify(instdir, manifest, fail_fast=True, max_workers=None):
+    """
+    Verify the files of `instdir` against a manifest (see `nsis_manifest` and `manifest_create`), concurrently.
+    Each file must exist and match the manifest `size`, `sha256` and PE `arch`, when specified.
+    When `fail_fast` is set, verification stops at the first failure.
+    Returns:
+      list: failures, `[(path, message), ...]`, empty on success
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    def verify(entry):
+        t0 = time.perf_counter()
+        path = os.path.join(instdir, *entry['path'].split('/'))
+        try:
+            if (size := os.stat(path).st_size) != entry.get('size', size):
+                return (path, f'size mismatch, expected {entry["size"]}, got {size}', time.perf_counter() - t0)
+            if 'sha256' in entry and (sha256 := file_sha256(path)) != entry['sha256']:
+                return (path, f'sha256 mismatch, expected {entry["sha256"]}, got {sha256}', time.perf_counter() - t0)
+            if 'arch' in entry and (arch := pe_architecture(path)) != entry['arch']:
+                return (path, f'architecture mismatch, expected {entry["arch"]}, got {arch}', time.perf_counter() - t0)
+        except (OSError, ValueError) as ex:
+            return (path, str(ex), time.perf_counter() - t0)
+        return (path, None, time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    failures = []
+    timings = []
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        for future in as_completed([executor.submit(verify, entry) for entry in manifest]):
+            path, message, duration = future.result()
+            timings.append((duration, path))
+            if message:
+                failures.append((path, message))
+                print(f'-- Verify "{path}" : {message}')
+                if fail_fast:
+                    break
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    span_set(files=len(timings), failures=len(failures))
+    print(f'Verify {len(timings)}/{len(manifest)} files in "{instdir}" : {"PASS" if not failures else "FAIL"}, {int((time.perf_counter() - t0)*1000)} ms')
+    if verbose:
+        for duration, path in sorted(timings, reverse=True)[:10]:
+            print(f'    {duration*1000:.1f} ms "{path}"')
+    return failures
+
+
+def zip_extract(archive, outdir, max_workers=None):
+    """
+    Extract a zip archive into `outdir`, decompressing entries concurrently and streaming them straight to disk.
+    A single top-level directory shared by all entries (e.g. `nsis-3.11/`) is stripped.
+    Returns `(files, bytes)` extracted.
+    """
+    import shutil, zipfile
+    from concurrent.futures import ThreadPoolExecutor
+
+    # entries opened from several threads share one file handle, only their raw reads are serialized, not decompression
+    with zipfile.ZipFile(archive) as zf:
+        infos = zf.infolist()
+        names = [info.filename for info in infos]
+        prefix = names[0].split('/', 1)[0] + '/' if names and '/' in names[0] else ''
+        if not prefix or not all(name.startswith(prefix) for name in names):
+            prefix = ''
+
+        targets = []    # [(info, path)], largest first
+        for info in sorted(infos, key=lambda info: info.file_size, reverse=True):
+            relpath = info.filename[len(prefix):]
+            if not relpath or info.is_dir():
+                continue
+            if relpath.startswith('/') or '..' in relpath.split('/') or re.match(r'^[A-Za-z]:', relpath):
+                raise RuntimeError(f'-- "{archive}" entry "{info.filename}" escapes the extraction directory')
+            targets.append((info, os.path.join(outdir, *relpath.split('/'))))
+        for folder in {os.path.dirname(path) for info, path in targets} | {outdir}:
+            os.makedirs(folder, exist_ok=True)
+
+        # entries are packed into size-balanced batches, so thousands of small files don't cost a task each
+        workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+        batches = [[0, []] for _ in range(min(len(targets), workers * 4))]
+        for target in targets:
+            batch = min(batches, key=lambda batch: batch[0])
+            batch[0] += target[0].compress_size + 4096
+            batch[1].append(target)
+
+        def extract(batch):
+            size = 0
+            for info, path in batch[1]:
+                with zf.open(info) as source, open(path, 'wb') as file:
+                    shutil.copyfileobj(source, file, 1024 * 1024)
+                if os.name != 'nt' and (mode := (info.external_attr >> 16) & 0o777):
+                    os.chmod(path, mode)    # keep executables executable
+                size += info.file_size
+            return size
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            size = sum(executor.map(extract, batches))
+    return (len(targets), size)
+
+
+@traced()
+def zip_install(archive, instdir, registry=None):
+    """
+    Install a portable zip distribution into `instdir`: extract it into the staging directory `instdir.staging`, then swap it in place of `instdir`.
+    The previous content of `instdir`, if any, is removed, so no stale files survive, and so are the registry keys of a previous installer-based installation (see `nsis_unregister`).
+    """
+    import shutil
+    instdir = os.path.normpath(instdir)
+    staging, previous = instdir + '.staging', instdir + '.previous'
+    for folder in (staging, previous):
+        shutil.rmtree(folder, ignore_errors=True)   # leftovers of an interrupted install
+
+    t0 = datetime.datetime.now()
+    files, size = zip_extract(archive, staging)
+    t1 = datetime.datetime.now()
+    if os.path.exists(instdir):
+        nsis_unregister(instdir, registry)     # its uninstaller is about to be deleted
+        os.replace(instdir, previous)
+    try:
+        os.replace(staging, instdir)
+    except OSError:
+        if os.path.exists(previous):
+            os.replace(previous, instdir)   # roll back
+        raise
+    with contextlib.suppress(OSError):
+        tree_remove(previous)
+    span_set(files=files, bytes=size)
+    print(f'Extract "{archive}" to "{instdir}" : {files} files, {size} bytes, {int((t1-t0).total_seconds()*1000)} ms, swap {int((datetime.datetime.now()-t1).total_seconds()*1000)} ms')
+
+
+def arch_normalize(arch):
+    """ Normalize architecture aliases (`Win32`, `i686`, `x64`, `x86_64`, etc.) to `x86` or `amd64`. Raises `ValueError` if unsupported. """
     matrix = {'x86': ['x86', 'win32', 'i[3-6]86'], 'amd64': ['amd64', 'x86(_|-)64', 'x64']}
     for name, values in matrix.items():
         for value in values:
             if re.match(rf'^{value}$', arch, re.IGNORECASE):
-                finalarch = name
-    if finalarch:
-        arch = finalarch
-    else:
-        raise ValueError(f'-- unsupported architecture "{arch}"')
+                return name
+    raise ValueError(f'-- unsupported architecture "{arch}"')
+
+
+def nsis_default_instdir(arch):
+    """ Default NSIS installation directory for the specified (normalized) architecture. """
+    return os.path.normpath(os.path.expandvars(r'%ProgramFiles%\NSIS' if arch == 'amd64' else r'%ProgramFiles(x86)%\NSIS'))
+
 
-    # verify arch
+@traced()
+def nsis_release(distro, arch, github_token=None, version='latest', lockfile=None, portable=False):
+    """
+    Resolve an NSIS release (`latest` or a specific version) from (cached) release metadata, without downloading it.
+    A matching `lockfile` entry resolves it without any network access; with a lockfile, `latest` means the locked version. A missing `lockfile` raises `FileNotFoundError`.
+    With `portable`, the release's `.zip` distribution is resolved instead of its installer.
+    Returns a dictionary with `distro`, `arch`, `version`, `portable` and the installer (or archive) `tag`, `name`, `url`, `size`, `digest` and `headers`.
+    """
+    import json
+    arch = arch_normalize(arch)
+    version = version or 'latest'
+    extension = 'zip' if portable else 'exe'
     if arch != 'x86' and distro.lower() == 'official':
         raise ValueError(f'-- official NSIS releases only support x86 architecture, got "{arch}"')
 
-    # download
+    if lockfile and not os.path.isfile(lockfile):
+        raise FileNotFoundError(f'-- lockfile "{lockfile}" not found')
+    if lockfile:
+        with open(lockfile, 'r', encoding='utf-8') as fi:
+            locked = json.load(fi)['releases'].get(f'{distro.lower()}/{arch}' + ('/portable' if portable else ''))
+        if locked and version.lower() in ('latest', locked['version']):
+            span_set(cache='lockfile')
+            print(f'Resolve nsis/{locked["version"]}-{arch} from "{lockfile}"')
+            return dict(locked, distro=distro.lower(), arch=arch, portable=portable, headers={'Authorization': f'Bearer {github_token}'} if github_token and locked['url'].startswith('https://github.com/') else {})
+        print(f'Warning: "{lockfile}" has no {distro.lower()}/{arch}{"/portable" if portable else ""} entry for version {version}')
+
     if distro.lower() == 'negrutiu':
-        installer = download_github_asset('negrutiu', 'nsis', 'latest', rf'nsis-.*-{arch}\.exe', github_token, downloadsdir)
-        version = re.search(rf'nsis-(.+)-.*-{arch}\.exe', os.path.basename(installer)).group(1)   # "nsis-3.11.7461.288-negrutiu-x86.exe" => "3.11.7461.288"
-        assert version, f'-- failed to parse version from "{installer}"'
+        name_regex = rf'nsis-.*-{arch}\.{extension}' if version.lower() == 'latest' else rf'nsis-{re.escape(version)}-.*-{arch}\.{extension}'
+        tag = 'latest' if version.lower() == 'latest' else github_release_tag('negrutiu', 'nsis', name_regex, github_token)
+        release = github_release_asset('negrutiu', 'nsis', tag, name_regex, github_token)
+        matches = re.search(rf'nsis-(.+)-.*-{arch}\.{extension}', release['name'])     # "nsis-3.11.7461.288-negrutiu-x86.exe" => "3.11.7461.288"
     elif distro.lower() == 'official':
-        installer = download_sourceforge_file('nsis', downloadsdir)
-        version = re.search(r'nsis-(\d+\.\d+(\.\d+(\.\d+)?)?)-setup\.exe', os.path.basename(installer)).group(1)   # "nsis-3.11-setup.exe" => "3.11"
-        assert version, f'-- failed to parse version from "{installer}"'
+        release = sourceforge_release_file('nsis') if version.lower() == 'latest' else None
+        if release and portable:
+            version, release = release['tag'], None    # `best_release.json` only advertises the installer, the zip sits next to it
+        if release is None:
+            name = f'nsis-{version}.zip' if portable else f'nsis-{version}-setup.exe'
+            release = {'tag': version, 'name': name, 'url': f'https://downloads.sourceforge.net/project/nsis/NSIS%20{version.split(".")[0]}/{version}/{name}', 'size': None, 'digest': None, 'headers': {}}
+        matches = re.search(rf'nsis-(\d+\.\d+(\.\d+(\.\d+)?)?)(-setup)?\.{extension}', release['name'])     # "nsis-3.11-setup.exe", "nsis-3.11.zip" => "3.11"
     else:
         raise ValueError(f'-- unsupported distro "{distro}"')
+    if not matches:
+        raise RuntimeError(f'-- failed to parse version from "{release["name"]}"')
+
+    return dict(release, distro=distro.lower(), arch=arch, version=matches.group(1), portable=portable)
+
+
+def nsis_mirrors(release, templates):
+    """
+    Expand mirror url `templates` for a release, e.g. `https://artifacts.example.com/nsis/{name}` or `https://netcologne.dl.sourceforge.net/project/nsis/NSIS%203/{tag}/{name}`.
+    Placeholders: `{distro}`, `{arch}`, `{version}`, `{tag}`, `{name}`. Templates that expand to the release url are skipped.
+    Returns the list of mirror urls.
+    """
+    mirrors = []
+    for template in templates:
+        if (template := template.strip()) and (url := template.format(**{key: release.get(key) or '' for key in ('distro', 'arch', 'version', 'tag', 'name')})) != release['url']:
+            mirrors.append(url)
+    return mirrors
+
+
+def nsis_lock(lockfile, version='latest', targets=(('negrutiu', 'x86'), ('negrutiu', 'amd64'), ('official', 'x86')), github_token=None, portable=False):
+    """
+    Regenerate `lockfile`, pinning `version` of every `(distro, arch)` target, and also of their portable zip distributions with `portable`.
+    Installers are downloaded (into `downloadsdir`) to record their SHA-256, so a pinned run is verified end to end.
+    Returns the lockfile dictionary.
+    """
+    import json
+    releases = {}
+    for distro, arch, zipped in ((distro, arch, zipped) for distro, arch in targets for zipped in ((False, True) if portable else (False,))):
+        release = nsis_release(distro, arch, github_token, version, portable=zipped)
+        installer = download_cached(release['url'], release['name'], downloadsdir, release['size'], release['digest'], release['headers'])
+        releases[f'{release["distro"]}/{release["arch"]}' + ('/portable' if zipped else '')] = {
+            'version': release['version'],
+            'tag': release['tag'],
+            'name': release['name'],
+            'url': release['url'],
+            'size': os.path.getsize(installer),
+            'digest': f'sha256:{os.path.basename(os.path.dirname(installer))}',    # `downloadsdir/<sha256>/<name>`
+            }
+        print(f'Lock {release["distro"]}/{release["arch"]} : nsis/{release["version"]}, {release["name"]}')
+
+    lock = {'version': 1, 'releases': releases}
+    with open(lockfile + '.tmp', 'w', encoding='utf-8') as fo:
+        json.dump(lock, fo, indent=2)
+        fo.write('\n')
+    os.replace(lockfile + '.tmp', lockfile)
+    return lock
+
+
+@traced()
+def nsis_resolve(arch, distro='negrutiu', instdir=None, github_token=None, release=None):
+    """
+    Check whether the NSIS installation in `instdir` (default location if empty) already matches the latest release:
+    same version, same architecture and a passing manifest verification: the size and architecture of every file in the `release_manifest`, if one was recorded, otherwise the `nsis_manifest` files.
+    `release` is the `nsis_release` result, resolved here if `None`.
+    Returns:
+        `(instdir, version, arch)` if the installation is up to date, `None` otherwise. """
+    release = release or nsis_release(distro, arch, github_token)
+    instdir = os.path.normpath(os.path.expandvars(instdir)) if instdir else nsis_default_instdir(release['arch'])
+    makensis = os.path.join(instdir, 'makensis.exe')
+    if not os.path.isfile(makensis):
+        if verbose: print(f'Resolve nsis/{release["version"]}-{release["arch"]} in "{instdir}" : not installed')
+        return None
 
-    # install
     t0 = datetime.datetime.now()
-    commandline = f'"{installer}" /S'
-    if instdir:
-        commandline += f' /D={os.path.normpath(os.path.expandvars(instdir))}'
-    exitcode = os.system(commandline)
-    print(f'Run {commandline} : {"OK" if exitcode == 0 else str(exitcode)}, {int((datetime.datetime.now()-t0).total_seconds()*1000)} ms')
-    if exitcode != 0:
-        raise RuntimeError(f'-- {installer} returned {exitcode}')
-
-    out_instdir = instdir
-    if out_instdir is not None and (out_instdir == '' or not os.path.exists(out_instdir)):
-        out_instdir = None
-    if out_instdir is None:
-        out_instdir = os.path.normpath(os.path.expandvars(r'%ProgramFiles%\NSIS' if arch == 'amd64' else r'%ProgramFiles(x86)%\NSIS'))
+    reason = None
+    if (version := nsis_version(instdir)) != release['version']:
+        reason = f'version {version}'
+    elif (arch := pe_architecture(makensis)) != release['arch']:
+        reason = f'architecture {arch}'
+    elif failures := manifest_verify(instdir, [{name: value for name, value in entry.items() if name != 'sha256'} for entry in release_manifest(release) or nsis_manifest(release['distro'], release['arch'])]):
+        reason = f'"{failures[0][0]}" {failures[0][1]}'
+    span_set(cache='hit' if reason is None else 'miss')
+    print(f'Resolve nsis/{release["version"]}-{release["arch"]} in "{instdir}" : {"up to date" if reason is None else "found " + reason}, {int((datetime.datetime.now()-t0).total_seconds()*1000)} ms')
+    return (instdir, release['version'], release['arch']) if reason is None else None
+
+
+def nsis_register_path(instdir, registry=None, keep_existing=True):
+    """
+    Add NSIS installation directory to the process, `GITHUB_PATH` and system `PATH`, in one transaction. `registry` is the registry backend, `WindowsRegistry` if `None`.
+    Without `keep_existing`, a directory already in `PATH` is moved to the front, ahead of other installations.
+    """
+    with EnvironmentUpdate(registry) as environment:
+        environment.github_path_add(instdir)
+        environment.process_path_add(instdir, keep_existing)
+        environment.registry_path_add(instdir, HKEY_LOCAL_MACHINE, system_environment_key, "Path", keep_existing)
+        # environment.registry_path_add(instdir, HKEY_CURRENT_USER, user_environment_key, "Path")  # HKLM is enough
+
+
+def tree_remove(path, max_workers=None):
+    """
+    Delete a directory tree with a parallel `os.scandir` walker: folders are scanned level by level and their files deleted in batches on a thread pool, then the folders are removed bottom-up.
+    Symbolic links are deleted, not followed. Returns `(files, folders)` removed.
+    """
+    import stat
+    from concurrent.futures import ThreadPoolExecutor
+
+    def scan(folder):
+        files, folders = [], []
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                (folders if entry.is_dir(follow_symlinks=False) else files).append(entry.path)
+        return (files, folders)
+
+    def unlink(files):
+        for file in files:
+            try:
+                os.unlink(file)
+            except PermissionError:
+                os.chmod(file, stat.S_IWRITE)   # read-only files can't be deleted on Windows
+                os.unlink(file)
+        return len(files)
+
+    def rmdir(folder):
+        for retry in range(10):
+            try:
+                return os.rmdir(folder)
+            except OSError:
+                if retry == 9:
+                    raise
+                time.sleep(0.05)    # Windows completes pending deletes asynchronously
+
+    levels, level, removed = [], [path], 0
+    with ThreadPoolExecutor(max_workers=max_workers or min(32, (os.cpu_count() or 1) + 4)) as executor:
+        while level:
+            levels.append(level)
+            scanned = list(executor.map(scan, level))
+            files = [file for found, subfolders in scanned for file in found]
+            removed += sum(executor.map(unlink, (files[i:i+256] for i in range(0, len(files), 256))))
+            level = [subfolder for found, subfolders in scanned for subfolder in subfolders]
+        for level in reversed(levels):  # siblings are independent, parents wait for their children
+            list(executor.map(rmdir, level))
+    return (removed, sum(len(level) for level in levels))
+
+
+@traced()
+def tree_discard(path, max_workers=None):
+    """
+    Rename a directory tree aside, so `path` is free immediately, then delete it with `tree_remove`.
+    If the rename fails (e.g. a file is in use on Windows), the tree is deleted in place.
+    Returns `(files, folders)` removed.
+    """
+    path = os.path.normpath(path)
+    aside = f'{path}.removed-{time.time_ns()}'
+    try:
+        os.rename(path, aside)
+    except OSError:
+        aside = path
+    files, folders = tree_remove(aside, max_workers)
+    span_set(files=files, folders=folders)
+    return (files, folders)
+
+
+def tool_cache_dir(version, arch):
+    """ Tool cache directory of an NSIS installation: `toolcachedir/nsis/<version>/<arch>`, completed by a `<arch>.complete` marker. """
+    return os.path.join(toolcachedir, 'nsis', version, arch)
+
+
+def tool_cache_lookup(instdir):
+    """ Return `True` if the tool cache entry `instdir` is complete, and mark it as recently used. """
+    try:
+        os.utime(instdir + '.complete')
+        return os.path.isdir(instdir)
+    except OSError:
+        return False
+
+
+def tool_cache_complete(instdir):
+    """ Mark the tool cache entry `instdir` as complete, recording its size. """
+    import json
+    size = sum(os.path.getsize(os.path.join(root, file)) for root, _, files in os.walk(instdir) for file in files)
+    with open(instdir + '.complete.tmp', 'w', encoding='utf-8') as fo:
+        json.dump({'size': size}, fo)
+    os.replace(instdir + '.complete.tmp', instdir + '.complete')
+
+
+@traced()
+def tool_cache_prune(keep=None, max_size=None, registry=None):
+    """
+    Remove the least recently used NSIS installations from the tool cache until it fits in `max_size` bytes (default `tool_cache_size`), and from the process, user and system `PATH`.
+    `keep` is never removed. `registry` is the registry backend, `WindowsRegistry` if `None`. Returns the list of removed directories.
+    """
+    import glob, json
+    if max_size is None:
+        max_size = tool_cache_size
+
+    entries = []    # [(last used, size, instdir)]
+    for marker in glob.glob(os.path.join(glob.escape(toolcachedir), 'nsis', '*', '*.complete')):
+        try:
+            with open(marker, 'r', encoding='utf-8') as fi:
+                entries.append((os.stat(marker).st_mtime, json.load(fi)['size'], marker[:-len('.complete')]))
+        except (OSError, ValueError, KeyError):
+            pass
+
+    removed = []
+    total_size = sum(size for used, size, instdir in entries)
+    for used, size, instdir in sorted(entries):
+        if total_size <= max_size:
+            break
+        if keep and os.path.normcase(os.path.abspath(instdir)) == os.path.normcase(os.path.abspath(keep)):
+            continue
+        os.remove(instdir + '.complete')    # incomplete from now on, even if the removal below is interrupted
+        with contextlib.suppress(OSError):
+            tree_discard(instdir)
+        with contextlib.suppress(OSError):
+            os.rmdir(os.path.dirname(instdir))  # no other architectures of this version
+        total_size -= size
+        removed.append(instdir)
+        print(f'Pruned "{instdir}" from tool cache, {size} bytes')
+
+    if removed:
+        with EnvironmentUpdate(registry) as environment:
+            for instdir in removed:
+                environment.process_path_remove(instdir)
+                environment.registry_path_remove(instdir, HKEY_CURRENT_USER, user_environment_key, "Path")
+                environment.registry_path_remove(instdir, HKEY_LOCAL_MACHINE, system_environment_key, "Path")
+    return removed
+
+
+@traced()
+def nsis_install(arch, distro='negrutiu', instdir=None, register_path=True, github_token=None, release=None, mirrors=(), tool_cache=False, force=False, portable=False, registry=None):
+    """ Download and install the latest [negrutiu/nsis](https://github.com/negrutiu/nsis) release.
+        `release` is the `nsis_release` result, resolved here if `None`.
+        `mirrors` are url templates of alternative download sources (see `nsis_mirrors`), raced against the release url.
+        With `tool_cache`, NSIS is installed side by side in `tool_cache_dir(version, arch)` instead of `instdir`, and a complete entry is reused without running the installer unless `force` is set.
+        With `portable`, the release's zip distribution is extracted and swapped into place (see `zip_install`) instead of running the installer; nothing needs to be uninstalled first.
+        The installation is verified against the `release_manifest` recorded by an earlier clean installation of the same release, and a clean installation records it.
+        `registry` is the registry backend used to register `PATH` and unregister a replaced installation, `WindowsRegistry` if `None`.
+        Returns:
+            `(instdir, version, arch)` or raises on error. """
+    release = release or nsis_release(distro, arch, github_token, portable=portable)
+    arch, version = release['arch'], release['version']
+    span_set(version=version, arch=arch)
+
+    if tool_cache:
+        import shutil
+        instdir = tool_cache_dir(version, arch)
+        if not force and tool_cache_lookup(instdir):
+            span_set(cache='hit')
+            print(f'Reuse nsis/{version}-{arch} from tool cache "{instdir}"')
+            if register_path:
+                nsis_register_path(instdir, registry, keep_existing=False)     # ahead of other tool cache versions
+            return (instdir, version, arch)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(instdir + '.complete')    # incomplete from now on, even if the installation below fails
+        shutil.rmtree(instdir, ignore_errors=True)
+        os.makedirs(instdir)
+
+    # download
+    installer = download_cached(release['url'], release['name'], downloadsdir, release['size'], release['digest'], release['headers'], nsis_mirrors(release, mirrors))
+    target = os.path.normpath(os.path.expandvars(instdir)) if instdir else nsis_default_instdir(arch)
+    clean = release.get('portable') or not os.path.isdir(target) or not os.listdir(target)     # nothing left over from other installations
+
+    # install
+    if release.get('portable'):
+        out_instdir = os.path.normpath(os.path.expandvars(instdir)) if instdir else nsis_default_instdir(arch)
+        zip_install(installer, out_instdir, registry)
+        nsis_list_invalidate()
+    else:
+        t0 = datetime.datetime.now()
+        commandline = f'"{installer}" /S'
+        if instdir:
+            commandline += f' /D={os.path.normpath(os.path.expandvars(instdir))}'
+        with span('installer', command=commandline):
+            exitcode = os.system(commandline)
+        print(f'Run {commandline} : {"OK" if exitcode == 0 else str(exitcode)}, {int((datetime.datetime.now()-t0).total_seconds()*1000)} ms')
+        nsis_list_invalidate()
+        if exitcode != 0:
+            raise RuntimeError(f'-- {installer} returned {exitcode}')
+
+        out_instdir = instdir
+        if out_instdir is not None and (out_instdir == '' or not os.path.exists(out_instdir)):
+            out_instdir = None
+        if out_instdir is None:
+            out_instdir = nsis_default_instdir(arch)
 
     # verify
     pe = os.path.join(out_instdir, 'makensis.exe')
@@ -413,89 +1913,497 @@ def nsis_install(arch, distro='negrutiu', instdir=None, register_path=True, gith
     if out_version != version:
         raise RuntimeError(f'-- "{pe}" version mismatch, expected "{version}", got "{out_version}"')
 
-    arch2 = pe_architecture(pe)
-    if verbose: print(f'Verify arch("{pe}") == "{arch}" : {"PASS" if arch2 == arch else "FAIL"}')
-    if arch2 != arch:
-        raise RuntimeError(f'-- "{pe}" architecture mismatch, expected {hex(arch)}, got {hex(arch2)}')
-
-    if distro.lower() == 'negrutiu':
-        targets = ['x86-unicode', 'x86-ansi', 'amd64-unicode']
-        plugins = ['System.dll', 'Math.dll', 'NScurl.dll']
-    elif distro.lower() == 'official':
-        targets = ['x86-unicode', 'x86-ansi']
-        plugins = ['System.dll', 'Math.dll']
-    for target in targets:
-        for plugin in plugins:
-            pe = os.path.join(out_instdir, 'Plugins', target, plugin)
-            if verbose: print(f'Verify exists("{pe}") : {"PASS" if os.path.exists(pe) else "FAIL"}')
-            if not os.path.exists(pe):
-                raise RuntimeError(f'-- "{pe}" is missing after installation')
+    if failures := manifest_verify(out_instdir, nsis_manifest(release['distro'], arch)):
+        path, message = failures[0]
+        raise RuntimeError(f'-- "{path}" {message}')
+
+    import json
+    manifest_path = os.path.join(os.path.dirname(installer), 'manifest.json')    # `downloadsdir/<sha256>/`, see `release_manifest`
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as fi:
+            if failures := manifest_verify(out_instdir, json.load(fi)):
+                path, message = failures[0]
+                raise RuntimeError(f'-- "{path}" {message}')
+    elif clean and os.path.normcase(out_instdir) == os.path.normcase(target):
+        with open(manifest_path + '.tmp', 'w', encoding='utf-8') as fo:
+            json.dump(manifest_create(out_instdir), fo)
+        os.replace(manifest_path + '.tmp', manifest_path)
+        if verbose: print(f'Recorded manifest "{manifest_path}"')
+
+    if tool_cache:
+        tool_cache_complete(out_instdir)
+        tool_cache_prune(keep=out_instdir, registry=registry)
 
     # add instdir to PATH
     if register_path:
-        github_path_add(out_instdir)
-        process_path_add(out_instdir)
-        registry_path_add(out_instdir, winreg.HKEY_LOCAL_MACHINE, r"SYSTEM\CurrentControlSet\Control\Session Manager\Environment", "Path")
-        # registry_path_add(instdir2, winreg.HKEY_CURRENT_USER, r"Environment", "Path")  # HKLM is enough
+        nsis_register_path(out_instdir, registry, keep_existing=not tool_cache)
+
+        # verify
+        pe = 'makensis.exe'
+        version2 = nsis_version('')     # makensis.exe in PATH
+        if verbose: print(f'Verify version("{pe}") == {version} : {"PASS" if version2 == version else "FAIL"}')
+        if version2 != version:
+            raise RuntimeError(f'-- "{pe}" version mismatch, expected "{version}", got "{version2}"')
     else:
         if verbose: print(f'PATH entries left intact')
 
-    # verify
-    pe = 'makensis.exe'
-    version2 = nsis_version('')     # makensis.exe in PATH
-    if verbose: print(f'Verify version("{pe}") == {version} : {"PASS" if version2 == version else "FAIL"}')
-    if version2 != version:
-        raise RuntimeError(f'-- "{pe}" version mismatch, expected "{version}", got "{version2}"')
-
     return (out_instdir, out_version, arch)
 
 
-def nsis_uninstall(instdir, unregister_path=True):
-    """ Uninstall NSIS found in the specified installation directory. Returns uninstaller exit code or `-1` if NSIS not found. """
-    if os.path.exists(os.path.join(instdir, 'Bin', 'makensis.exe')) and os.path.exists(uninst := os.path.join(instdir, 'uninst-nsis.exe')):
-        exitcode = os.system(commandline := f'"{uninst}" /S _?={instdir}')
+@traced()
+def nsis_unregister(instdir, registry=None):
+    """
+    Delete the `Uninstall\\NSIS` and `Software\\NSIS` registry keys (`HKLM` and `HKCU`, both registry views) that point to `instdir`, through a `WindowsRegistry`-like backend.
+    Returns the number of keys deleted.
+    """
+    registry = registry or WindowsRegistry()
+    instdir = os.path.normcase(os.path.normpath(instdir))
+    deleted = 0
+    for root in (HKEY_LOCAL_MACHINE, HKEY_CURRENT_USER):
+        for view in (64, 32):
+            for key, value in ((nsis_uninstall_key, 'InstallLocation'), (nsis_software_key, '')):
+                try:
+                    if (location := registry.query(root, key, value, view)) and os.path.normcase(os.path.normpath(location)) == instdir and registry.delete_key(root, key, view):
+                        print(f'Deleted "{"HKLM" if root == HKEY_LOCAL_MACHINE else "HKCU"}\\{key}" ({view}-bit view)')
+                        deleted += 1
+                except Exception as ex:
+                    print(f'-- nsis_unregister("{key}"): {ex}')
+    return deleted
+
+
+@traced()
+def nsis_uninstall(instdir, unregister_path=True, fast=False, registry=None):
+    """ Uninstall NSIS found in the specified installation directory. Returns uninstaller exit code or `-1` if NSIS not found.
+        With `fast`, the uninstaller doesn't run: the directory is renamed aside and deleted in parallel (see `tree_discard`), and its registry keys are deleted (see `nsis_unregister`).
+        This also removes portable installations, which have no uninstaller. Only directories with an NSIS layout are deleted: `Bin\\makensis.exe` and an `Include` or `Plugins` folder.
+        `registry` is the registry backend, `WindowsRegistry` if `None`. """
+    if fast and os.path.isfile(os.path.join(instdir, 'Bin', 'makensis.exe')) and any(os.path.isdir(os.path.join(instdir, folder)) for folder in ('Include', 'Plugins')):
+        t0 = datetime.datetime.now()
+        files, folders = tree_discard(instdir)
+        nsis_list_invalidate()
+        print(f'Remove "{instdir}" : {files} files, {folders} folders, {int((datetime.datetime.now()-t0).total_seconds()*1000)} ms')
+        nsis_unregister(instdir, registry)
+        exitcode = 0
+    elif os.path.exists(os.path.join(instdir, 'Bin', 'makensis.exe')) and os.path.exists(uninst := os.path.join(instdir, 'uninst-nsis.exe')):
+        with span('uninstaller', command=(commandline := f'"{uninst}" /S _?={instdir}')):
+            exitcode = os.system(commandline)
         print(f'Run {commandline} : {exitcode}')
+        nsis_list_invalidate()
         if exitcode == 0:
-            os.remove(uninst)
-            os.rmdir(instdir)
-            if unregister_path:
-                process_path_remove(instdir)
-                registry_path_remove(instdir, winreg.HKEY_CURRENT_USER, r"Environment", "Path")
-                registry_path_remove(instdir, winreg.HKEY_LOCAL_MACHINE, r"SYSTEM\CurrentControlSet\Control\Session Manager\Environment", "Path")
+            tree_discard(instdir)   # the uninstaller itself, and whatever else it left behind
+    else:
+        print(f'-- uninstall_nsis("{instdir}") did not find NSIS')
+        return -1
+
+    if exitcode == 0:
+        if unregister_path:
+            with EnvironmentUpdate(registry) as environment:
+                environment.process_path_remove(instdir)
+                environment.registry_path_remove(instdir, HKEY_CURRENT_USER, user_environment_key, "Path")
+                environment.registry_path_remove(instdir, HKEY_LOCAL_MACHINE, system_environment_key, "Path")
+        else:
+            if verbose: print(f'PATH entries left intact')
+    return exitcode
+
+
+# compile-time directives whose file arguments are dependencies; other directives are scanned for arguments naming existing files
+_nsis_file_directives = {'!include', 'file', 'reservefile', 'loadlanguagefile', '!addincludedir', '!addplugindir', '!cd', '!getdllversion', '!gettlbversion'}
+_nsis_optional_file_directives = {'!insertmacro', '!define', 'licensedata', 'licenselangstring', 'icon', 'uninstallicon', 'checkbitmap', 'changeui'}
+# compile-time directives with side effects or results that a cached output can't reproduce
+_nsis_uncacheable_directives = {'!system', '!execute', '!makensis', '!packhdr', '!finalize', '!uninstfinalize', '!appendfile', '!delfile', '!tempfile'}
+_nsis_token = re.compile(r'"((?:\$\\"|[^"])*)"|\'([^\']*)\'|`([^`]*)`|([^\s"\'`]+)')
+
+
+def nsis_dependencies(script, defines={}, commands=(), nsisdir=None, nocd=False, noconfig=False):
+    """
+    Find the files an NSIS script depends on at compile time, without running `makensis`: `!include` headers (recursively), `File` and `ReserveFile` sources (wildcards, `/r`),
+    language files, plugin directories (`!addplugindir` and `${NSISDIR}\\Plugins`), `${NSISDIR}\\Stubs`, and files named by `!insertmacro`, `!define`, `LicenseData`, `Icon`, etc. arguments.
+    `defines` (`-D`) and `!define` values are substituted; conditional blocks are not evaluated, so every branch counts (a superset of the real dependencies).
+    Returns a dictionary:
+      `files`: dependency paths
+      `missing`: searched paths that don't exist (e.g. `!include /nonfatal` headers), they matter once created
+      `environment`: `{name: value}` of the `$%NAME%` environment variables and `${__DATE__}` the script references
+      `outputs`: `OutFile` paths, of every branch
+      `uncacheable`: why the output can't be cached (`!system`, `${__TIME__}`, unresolved file names, etc.), `None` if it can
+    """
+    defines = {'NSISDIR': nsisdir or '', **defines}
+    state = {'basedir': os.getcwd() if nocd else os.path.dirname(os.path.abspath(script)), 'macro': 0}
+    includedirs, visited, files, missing, environment, outputs = [], set(), set(), set(), {}, set()
+    uncacheable = []
+
+    def native(path):
+        return path.replace('\\', os.sep) if os.sep == '/' else path
+
+    def substitute(text):
+        for _ in range(16):
+            replaced = re.sub(r'\$\{([^${}]+)\}', lambda matches: defines.get(matches.group(1), matches.group(0)), text)
+            if replaced == text:
+                break
+            text = replaced
+        return re.sub(r'\$%([^%]+)%', lambda matches: environment.get(matches.group(1)) or '', text)
+
+    def resolve(argument, source, required=True):
+        """ Substitute `argument` and make it absolute, or return `None` (and mark the script uncacheable if `required`) if it can't be resolved. """
+        path = substitute(argument)
+        if '${' in path or '$%' in path:
+            if required and not state['macro']:     # macro parameters are resolved by the `!insertmacro` arguments
+                uncacheable.append(f'unresolved "{argument}" in "{source}"')
+            return None
+        return os.path.normpath(os.path.join(state['basedir'], native(path)))
+
+    def add_files(pattern, recursive=False):
+        """ Add the files matching a `File` pattern. """
+        import fnmatch, glob
+        if not recursive:
+            matches = glob.glob(glob.escape(os.path.dirname(pattern)) + os.sep + os.path.basename(pattern)) if glob.has_magic(pattern) else [pattern]
+            for path in matches:
+                if os.path.isdir(path) and not glob.has_magic(pattern):
+                    continue
+                (files if os.path.isfile(path) else missing).add(path)
+            return
+        folder, mask = (pattern, '*') if os.path.isdir(pattern) else os.path.split(pattern)
+        for root, _, names in os.walk(folder):
+            parts = os.path.relpath(root, folder).split(os.sep)
+            matched = any(fnmatch.fnmatch(part, mask) for part in parts if part != '.')
+            files.update(os.path.join(root, name) for name in names if matched or fnmatch.fnmatch(name, mask))
+
+    def scan_file(path):
+        if path in visited:
+            return
+        visited.add(path)
+        files.add(path)
+        with open(path, 'rb') as fi:
+            data = fi.read()
+        text = data.decode('utf-16') if data[:2] in (b'\xff\xfe', b'\xfe\xff') else data.decode('utf-8-sig', errors='replace')
+        text = re.sub(r'/\*.*?\*/', ' ', text, flags=re.DOTALL)
+        text = re.sub(r'\\\r?\n', ' ', text)
+        saved_defines = (defines.get('__FILE__'), defines.get('__FILEDIR__'))
+        defines['__FILE__'], defines['__FILEDIR__'] = os.path.basename(path), os.path.dirname(path)
+        for line in text.splitlines():
+            scan_line(line, path)
+        defines['__FILE__'], defines['__FILEDIR__'] = saved_defines
+
+    def scan_line(line, source):
+        for name in re.findall(r'\$%([^%]+)%', line):
+            environment[name] = os.environ.get(name)
+        if '${__TIME__}' in line or '${__TIMESTAMP__}' in line:
+            uncacheable.append(f'time macro in "{source}"')
+        if '${__DATE__}' in line:
+            environment['${__DATE__}'] = defines['__DATE__'] = datetime.date.today().isoformat()
+
+        tokens = []
+        for matches in _nsis_token.finditer(line):
+            if matches.group(4) is not None and matches.group(4)[0] in ';#':
+                break   # comment
+            tokens.append(next(group for group in matches.groups() if group is not None))
+        if not tokens:
+            return
+        directive, arguments = tokens[0].lower(), tokens[1:]
+        flags = [argument.lower() for argument in arguments if argument.startswith('/')]
+        values = [argument for argument in arguments if not argument.startswith('/')]
+
+        if directive == '!macro':
+            state['macro'] += 1
+        elif directive == '!macroend':
+            state['macro'] = max(state['macro'] - 1, 0)
+        elif directive in _nsis_uncacheable_directives:
+            uncacheable.append(f'{tokens[0]} in "{source}"')
+        elif directive == '!define':
+            if '/date' in flags or '/utcdate' in flags:
+                uncacheable.append(f'{tokens[0]} /date in "{source}"')
+            elif '/file' in flags and values:
+                if (path := resolve(values[-1], source)):
+                    (files if os.path.isfile(path) else missing).add(path)
+            elif values and not any(flag in flags for flag in ('/math', '/intfmt')) and not ('/ifndef' in flags and values[0] in defines):
+                defines[values[0]] = substitute(values[1]) if len(values) > 1 else ''
+            elif values and '/ifndef' not in flags:
+                defines.pop(values[0], None)    # computed, unknown
+            for value in values[1:]:
+                if (path := resolve(value, source, required=False)) and os.path.isfile(path):
+                    files.add(path)
+        elif directive == '!undef' and values:
+            defines.pop(values[0], None)
+        elif directive == 'outfile' and values:
+            if (path := resolve(values[0], source)):
+                outputs.add(path)
+        elif directive == '!searchparse' and '/file' in [argument.lower() for argument in arguments]:
+            if (path := resolve(arguments[[argument.lower() for argument in arguments].index('/file') + 1], source)):
+                (files if os.path.isfile(path) else missing).add(path)
+        elif directive in _nsis_file_directives and values:
+            if directive in ('file', 'reservefile'):
+                skip = set()
+                for i, argument in enumerate(arguments):
+                    if argument.lower() == '/x':
+                        skip.add(i + 1)     # exclusion mask
+                for i, argument in enumerate(arguments):
+                    if i not in skip and not argument.startswith('/') and (path := resolve(argument, source)):
+                        add_files(path, recursive='/r' in flags)
+                return
+            if not (path := resolve(values[0], source)):
+                return
+            if directive == '!include':
+                import glob
+                argument = native(substitute(values[0]))
+                candidates = [path] if os.path.isabs(argument) else [path] + [os.path.join(folder, argument) for folder in (os.path.dirname(source) if source != '-X' else state['basedir'], *includedirs, os.path.join(nsisdir or '', 'Include'))]
+                for candidate in candidates:
+                    if found := sorted(glob.glob(glob.escape(os.path.dirname(candidate)) + os.sep + os.path.basename(candidate)) if glob.has_magic(candidate) else ([candidate] if os.path.isfile(candidate) else [])):
+                        for include in found:
+                            scan_file(os.path.normpath(include))
+                        break
+                    missing.add(os.path.normpath(candidate))
+            elif directive == '!addincludedir':
+                includedirs.append(path)
+            elif directive == '!cd':
+                state['basedir'] = path
+            elif directive == '!addplugindir':
+                if os.path.isdir(path):
+                    files.update(entry.path for entry in os.scandir(path) if entry.is_file())
+                else:
+                    missing.add(path)
             else:
-                if verbose: print(f'PATH entries left intact')
+                (files if os.path.isfile(path) else missing).add(path)
+        elif directive in _nsis_optional_file_directives:
+            for value in values:
+                if (path := resolve(value, source, required=False)) and os.path.isfile(path):
+                    files.add(path)
+
+    if nsisdir:
+        for folder in ('Plugins', 'Stubs'):     # upgraded in place without a new compiler version, e.g. by nsis-install-plugin
+            for root, _, names in os.walk(os.path.join(nsisdir, folder)):
+                files.update(os.path.join(root, name) for name in names)
+    if not noconfig and nsisdir:
+        if os.path.isfile(config := os.path.join(nsisdir, 'nsisconf.nsh')):
+            scan_file(config)
+    for command in commands:
+        scan_line(command, '-X')
+    scan_file(os.path.abspath(script))
+    return {'files': sorted(files), 'missing': sorted(missing - files), 'environment': environment, 'outputs': sorted(outputs), 'uncacheable': uncacheable[0] if uncacheable else None}
+
+
+@traced()
+def nsis_compile(arguments, instdir=None, cachedir=None):
+    """
+    Run `makensis` (from `instdir`, or `PATH` if empty) with the specified command line `arguments`, reusing the outputs of a previous identical compilation.
+    The cache key covers the arguments (`-D` defines, `-X` commands, etc.), the compiler version and architecture, the content of the script and all its dependencies (see `nsis_dependencies`)
+    and the environment variables they reference. Outputs are the `OutFile` paths (see `nsis_dependencies`) written by the compilation, and the files reported by makensis (`Output: "..."`, hidden below `-V3`).
+    They're stored in `cachedir` (default `compilecachedir`) and restored on a hit, and the compiler output is replayed. Scripts that run commands at compile time (`!system`, etc.) are always compiled.
+    The least recently used entries are evicted when the cache grows beyond `compile_cache_size` bytes.
+    Returns the makensis exit code.
+    """
+    import hashlib, json, shutil, subprocess
+    from concurrent.futures import ThreadPoolExecutor
+
+    arguments = list(arguments)
+    cachedir = cachedir or compilecachedir
+    name = 'makensis.exe' if os.name == 'nt' else 'makensis'
+    makensis = os.path.join(instdir, name) if instdir else shutil.which(name)
+    if not makensis or not os.path.isfile(makensis):
+        raise RuntimeError(f'-- {name} not found in "{instdir or "PATH"}"')
+    nsisdir = os.path.dirname(os.path.realpath(makensis))
+    if nsisdir in ('/usr/bin', '/usr/local/bin'):
+        nsisdir = '/usr/share/nsis'
+
+    # command line
+    prefixes = ('-', '/') if os.name == 'nt' else ('-',)
+    script, defines, commands, nocd, noconfig, uncacheable = None, {}, [], False, False, None
+    options = iter(arguments)
+    for argument in options:
+        option = argument[1:].upper() if argument[:1] in prefixes and len(argument) > 1 else None
+        if option is None:
+            script = argument
+            uncacheable = uncacheable or ('script read from stdin' if argument == '-' else None)
+        elif option[:1] == 'D':
+            define, _, value = argument[2:].partition('=')
+            defines[define] = value
+        elif option[:1] == 'X':
+            commands.append(argument[2:])
+        elif option in ('INPUTCHARSET', 'OUTPUTCHARSET', 'NOTIFYHWND'):
+            next(options, None)    # value
+        elif option[:1] == 'O':
+            uncacheable = f'"{argument}", the log file isn\'t restored'
+        elif option in ('NOCD', 'NOCONFIG'):
+            nocd, noconfig = nocd or option == 'NOCD', noconfig or option == 'NOCONFIG'
+        elif option in ('VERSION', 'HDRINFO', 'LICENSE') or option.startswith('CMDHELP'):
+            uncacheable = f'"{argument}"'
+    basedir = os.getcwd() if nocd or not script else os.path.dirname(os.path.abspath(script))
+
+    def fingerprint(path):
+        try:
+            stat = os.stat(path)
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+
+    def run(candidates=()):
+        t0 = datetime.datetime.now()
+        before = {path: fingerprint(path) for path in candidates}
+        process = subprocess.Popen([makensis, *arguments], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        log = []
+        for line in process.stdout:
+            log.append(line := line.decode('utf-8', errors='replace'))
+            sys.stdout.write(line)
+        sys.stdout.flush()
+        exitcode = process.wait()
+        outputs = [os.path.normpath(os.path.join(basedir, matches.group(1))) for line in log if (matches := re.match(r'^Output: "(.+)"\s*$', line))]
+        reported = {os.path.normcase(path) for path in outputs}
+        outputs += [path for path in candidates if os.path.normcase(path) not in reported and (after := fingerprint(path)) and after != before[path]]    # written, whatever the verbosity
+        print(f'Run {name} {" ".join(arguments)} : {exitcode}, {int((datetime.datetime.now()-t0).total_seconds()*1000)} ms')
+        return exitcode, outputs, ''.join(log)
+
+    if uncacheable is None and not script:
+        uncacheable = 'no script'
+    if uncacheable is None:
+        dependencies = nsis_dependencies(script, defines, commands, nsisdir, nocd, noconfig)
+        uncacheable = dependencies['uncacheable']
+    if uncacheable:
+        span_set(cache='off')
+        print(f'Compile without cache : {uncacheable}')
+        return run()[0]
+
+    # cache key
+    t0 = datetime.datetime.now()
+    try:
+        arch = pe_architecture(makensis)
+    except (OSError, ValueError):
+        arch = None
+    def relative(path):
+        for prefix, folder in (('${NSISDIR}', nsisdir), ('.', basedir)):
+            if os.path.normcase(path).startswith(os.path.normcase(os.path.join(folder, ''))):
+                return os.path.join(prefix, os.path.relpath(path, folder)).replace(os.sep, '/')
+        return path
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) + 4)) as executor:
+        hashes = list(executor.map(file_sha256, dependencies['files']))
+    key = hashlib.sha256(json.dumps({
+        'compiler': [nsis_version(os.path.dirname(makensis)), arch],
+        'arguments': [relative(os.path.abspath(argument)) if argument == script else argument for argument in arguments],   # checkouts move between runners
+        'environment': dependencies['environment'],
+        'files': [[relative(path), sha256] for path, sha256 in zip(dependencies['files'], hashes)],
+        'missing': [relative(path) for path in dependencies['missing']],
+        }, sort_keys=True).encode('utf-8')).hexdigest()
+    span_set(files=len(hashes), cache='miss')
+    if verbose: print(f'Compile cache key {key} : {len(hashes)} files, {int((datetime.datetime.now()-t0).total_seconds()*1000)} ms')
+
+    index_path = os.path.join(cachedir, 'index.json')
+    try:
+        with open(index_path, 'r', encoding='utf-8') as fi:
+            index = json.load(fi)
+    except (OSError, ValueError):
+        index = {'entries': {}}
+
+    def save_index():
+        os.makedirs(cachedir, exist_ok=True)
+        with open(index_path + '.tmp', 'w', encoding='utf-8') as fo:
+            json.dump(index, fo, indent=2)
+        os.replace(index_path + '.tmp', index_path)
+
+    # hit
+    if (entry := index['entries'].get(key)) is not None:
+        try:
+            for i, output in enumerate(entry['outputs']):
+                if os.path.getsize(os.path.join(cachedir, key, f'{i}-{os.path.basename(output["path"])}')) != output['size']:
+                    raise OSError(f'"{output["path"]}" size mismatch')
+            for i, output in enumerate(entry['outputs']):
+                path = os.path.normpath(os.path.join(basedir, output['path']))
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                shutil.copyfile(os.path.join(cachedir, key, f'{i}-{os.path.basename(output["path"])}'), path)
+            with open(os.path.join(cachedir, key, 'makensis.log'), 'r', encoding='utf-8') as fi:
+                sys.stdout.write(fi.read())
+            span_set(cache='hit', outputs=len(entry['outputs']), bytes=entry['size'])
+            print(f'Reuse cached compilation {key[:12]} : {len(entry["outputs"])} outputs, {entry["size"]} bytes, {int((datetime.datetime.now()-t0).total_seconds()*1000)} ms')
+            entry['used'] = time.time()
+            save_index()
+            return 0
+        except OSError as ex:
+            print(f'-- compile cache entry {key[:12]}: {ex}')
+            del index['entries'][key]
+
+    # miss
+    exitcode, outputs, log = run(dependencies['outputs'])
+    if exitcode != 0 or not outputs or not all(os.path.isfile(path) for path in outputs):
         return exitcode
-    print(f'-- uninstall_nsis("{instdir}") did not find NSIS')
-    return -1
+    incoming = os.path.join(cachedir, f'{key}.incoming-{os.getpid()}')
+    shutil.rmtree(incoming, ignore_errors=True)
+    os.makedirs(incoming)
+    for i, path in enumerate(outputs):
+        shutil.copyfile(path, os.path.join(incoming, f'{i}-{os.path.basename(path)}'))
+    with open(os.path.join(incoming, 'makensis.log'), 'w', encoding='utf-8') as fo:
+        fo.write(log)
+    shutil.rmtree(os.path.join(cachedir, key), ignore_errors=True)
+    os.replace(incoming, os.path.join(cachedir, key))
+    index['entries'][key] = {
+        'script': script,
+        'outputs': [{'path': os.path.relpath(path, basedir) if relative(path).startswith('./') else path, 'size': os.path.getsize(path)} for path in outputs],
+        'used': time.time(),
+        }
+    index['entries'][key]['size'] = sum(output['size'] for output in index['entries'][key]['outputs'])
+    span_set(outputs=len(outputs), bytes=index['entries'][key]['size'])
+
+    # evict least recently used entries
+    total_size = sum(entry['size'] for entry in index['entries'].values())
+    for evicted in sorted(index['entries'], key=lambda key: index['entries'][key]['used']):
+        if total_size <= compile_cache_size or evicted == key:
+            break
+        shutil.rmtree(os.path.join(cachedir, evicted), ignore_errors=True)
+        total_size -= index['entries'].pop(evicted)['size']
+        print(f'Evicted "{os.path.join(cachedir, evicted)}" from compile cache')
+
+    save_index()
+    return exitcode
 
 
 if __name__ == '__main__':
 
-    from argparse import ArgumentParser
+    from argparse import ArgumentParser, REMAINDER
     parser = ArgumentParser()
     parser.add_argument("-a", "--arch", type=str, default='x86', help='NSIS architecture (install only). Supported values: x86, Win32, i386, i486, i586, i686, amd64, x64, x86_64. All values are converted to "x86" or "amd64"')
-    parser.add_argument("-d", "--dir", type=str, help='NSIS custom installation directory (install only)')
+    parser.add_argument("-d", "--dir", type=str, help='NSIS custom installation directory (install and compile)')
     parser.add_argument("-D", "--distro", type=str, default='negrutiu', help='NSIS fork to install (install only)')
+    parser.add_argument("-f", "--force", action='store_true', help='install NSIS even if the installation directory already holds the latest release (install only)')
     parser.add_argument("-i", "--install", action='store_true', help='install NSIS')
+    parser.add_argument("-m", "--mirror", type=str, action='append', default=[], help='mirror url template, raced against the release url (install only). Placeholders: {distro}, {arch}, {version}, {tag}, {name}')
+    parser.add_argument("-p", "--portable", action='store_true', help='install NSIS from its portable zip distribution, without running the installer (install and lock)')
+    parser.add_argument("-t", "--tool-cache", action='store_true', help='install NSIS side by side in the runner tool cache, reusing complete entries (install only)')
+    parser.add_argument("-l", "--lockfile", type=str, help='lockfile with pinned NSIS releases (install and lock)')
+    parser.add_argument("--lock", action='store_true', help='regenerate the lockfile, pinning --version of every distro and architecture')
+    parser.add_argument("--version", type=str, default='latest', help='NSIS version to install (install and lock). Default: latest')
     parser.add_argument("-u", "--uninstall", action='store_true', help='uninstall all NSIS installations')
+    parser.add_argument("--fast", action='store_true', help='delete installations and their registry keys directly, without running the uninstaller (uninstall only)')
     parser.add_argument("-v", "--verbose", action='store_true', help='more verbose output')
+    parser.add_argument("--trace", type=str, help='write a JSON trace of all phases to this file')
+    parser.add_argument("--chrome", action='store_true', help='write the trace in Chrome trace format (chrome://tracing, Perfetto)')
+    parser.add_argument("--compile", nargs=REMAINDER, help='run makensis with all remaining arguments through the compile cache, e.g. --compile -DARCH=x86 installer.nsi')
     args = parser.parse_args()
 
-    print(f'Arguments: {args.__dict__}')
-
     if args.verbose:
         verbose = True
 
-    for makensis, instdir in (list := nsis_list()):
-        print(f'Found nsis/{nsis_version(instdir)}-{pe_architecture(makensis)} in "{instdir}"')
-    if not list:
-        print('No NSIS installations found')
+    if args.compile is None:    # a compile command prints the makensis output only
+        print(f'Arguments: {args.__dict__}')
+        installations = nsis_list()
+        versions = nsis_versions(instdir for makensis, instdir in installations)
+        for makensis, instdir in installations:
+            print(f'Found nsis/{versions[instdir]}-{pe_architecture(makensis)} in "{instdir}"')
+        if not installations:
+            print('No NSIS installations found')
 
     if args.uninstall:
-        for makensis, instdir in (list := nsis_list()):
-            nsis_uninstall(instdir)
-        if not list:
+        for makensis, instdir in (installations := nsis_list()):
+            nsis_uninstall(instdir, fast=args.fast)
+        if not installations:
             print('No NSIS installations found to uninstall')
 
+    if args.lock:
+        nsis_lock(args.lockfile or 'nsis-lock.json', args.version, portable=args.portable)
+
     if args.install:
-        nsis_install(args.arch, args.distro, args.dir)
+        release = nsis_release(args.distro, args.arch, None, args.version, args.lockfile, args.portable)
+        if args.tool_cache or args.force or not nsis_resolve(release['arch'], release['distro'], args.dir, release=release):
+            nsis_install(args.arch, args.distro, args.dir, release=release, mirrors=args.mirror, tool_cache=args.tool_cache, force=args.force)
+
+    exitcode = 0
+    if args.compile:
+        exitcode = nsis_compile(args.compile, args.dir)
+
+    if args.trace:
+        trace_report(args.trace, args.chrome)
+    sys.exit(exitcode)
@@ -0,0 +1,1475 @@
+"""
+Benchmarks for `action.py`. They run on any OS, without network access.
+
+    python benchmark.py                     # run all benchmarks
+    python benchmark.py import              # run the specified benchmarks
+    python benchmark.py --update-baselines  # run all benchmarks and store their timings as the new baselines
+"""
+import contextlib, os, re, subprocess, sys
+
+scriptdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, scriptdir)
+
+# a phase slower than `baseline * regression_factor + regression_slack` (ms) is reported as a regression, and fails the benchmark only beyond `regression_fatal_factor`
+# the margins absorb the noise of shared CI runners, which are slower than the machine that recorded the baselines
+baselinesfile = os.path.join(scriptdir, 'benchmark.json')
+regression_factor = 3
+regression_fatal_factor = 10    # an order of magnitude
+regression_slack = 200   # ms
+update_baselines = False
+
+
+def pe_fixture(path, arch='x86', version=None, strings={}, dll=False):
+    """ Write a minimal PE file with the specified architecture and, optionally, a `VS_VERSIONINFO` resource. """
+    import struct
+    machine = {'x86': 0x014c, 'amd64': 0x8664, 'arm64': 0xaa64}[arch]
+    pe32plus = arch != 'x86'
+
+    def block(key, value=b'', text=False, children=b''):
+        header_size = 6 + len(key.encode('utf-16-le')) + 2
+        body = key.encode('utf-16-le') + b'\0\0' + b'\0' * (-header_size % 4) + value
+        body += b'\0' * (-(6 + len(body)) % 4) + children
+        return struct.pack('<HHH', 6 + len(body), len(value) // 2 if text else len(value), 1 if text else 0) + body
+
+    resources = b''
+    if version:
+        ms, ls = [int(part) for part in version.split('.')[:2]], [int(part) for part in (version.split('.') + ['0', '0'])[2:4]]
+        fixed = struct.pack('<13I', 0xFEEF04BD, 0x00010000, ms[0] << 16 | ms[1], ls[0] << 16 | ls[1], ms[0] << 16 | ms[1], ls[0] << 16 | ls[1], 0x3F, 0, 0x40004, 2 if dll else 1, 0, 0, 0)
+        table = b''.join(string + b'\0' * (-len(string) % 4) for string in (block(name, (value + '\0').encode('utf-16-le'), text=True) for name, value in strings.items()))
+        versioninfo = block('VS_VERSION_INFO', fixed, children=block('StringFileInfo', children=block('040904b0', children=table)))
+        # resource tree: RT_VERSION (16) -> id 1 -> language 0x409 -> data entry
+        rva = 0x1000
+        resources = struct.pack('<IIHHHHII', 0, 0, 0, 0, 0, 1, 16, 0x80000000 | 24)
+        resources += struct.pack('<IIHHHHII', 0, 0, 0, 0, 0, 1, 1, 0x80000000 | 48)
+        resources += struct.pack('<IIHHHHII', 0, 0, 0, 0, 0, 1, 0x409, 72)
+        resources += struct.pack('<IIII', rva + 88, len(versioninfo), 0, 0)
+        resources += versioninfo
+
+    optional = bytearray(240 if pe32plus else 224)
+    struct.pack_into('<H', optional, 0, 0x20b if pe32plus else 0x10b)
+    struct.pack_into('<I', optional, 108 if pe32plus else 92, 16)
+    if resources:
+        struct.pack_into('<II', optional, (112 if pe32plus else 96) + 2*8, 0x1000, len(resources))
+    sections = struct.pack('<8sIIIIIIHHI', b'.rsrc', len(resources), 0x1000, len(resources) + (-len(resources) % 0x200), 0x400, 0, 0, 0, 0, 0x40000040) if resources else b''
+
+    headers = b'MZ' + b'\0' * 0x3A + struct.pack('<I', 0x40) + b'PE\0\0'
+    headers += struct.pack('<HHIIIHH', machine, 1 if resources else 0, 0, 0, 0, len(optional), 0x2102 if dll else 0x0102)
+    headers += bytes(optional) + sections
+    with open(path, 'wb') as fo:
+        fo.write(headers + b'\0' * (0x400 - len(headers)) + resources + b'\0' * (-len(resources) % 0x200))
+
+
+def nsis_tree(instdir, distro='negrutiu', arch='x86', version='3.11.7461.288', files=2000):
+    """ Write a fake NSIS installation: the files expected by `nsis_manifest` as synthetic PE files, plus `files` filler files under Contrib, Include, Docs, etc. """
+    import action
+    for entry in action.nsis_manifest(distro, arch):
+        path = os.path.join(instdir, *entry['path'].split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if 'arch' in entry:
+            pe_fixture(path, entry['arch'], version, {'FileVersion': version}, dll=path.endswith('.dll'))
+        else:
+            with open(path, 'w') as fo:
+                fo.write(f'; {entry["path"]}\n')
+    folders = ['Contrib/Graphics/Icons', 'Contrib/Language files', 'Contrib/Modern UI 2', 'Include', 'Docs/StrFunc', 'Examples', 'Stubs']
+    for i in range(files):
+        path = os.path.join(instdir, *folders[i % len(folders)].split('/'), f'file{i}.txt')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fo:
+            fo.write(f'{path}\n' * (i % 50))
+    return instdir
+
+
+@contextlib.contextmanager
+def action_globals(**values):
+    """ Set globals of `action.py` (e.g. `downloadsdir=...`) for the duration of a `with` block; on exit, these and any reassigned inside the block are restored. """
+    import action
+    saved = {name: getattr(action, name) for name in values}
+    for name, value in values.items():
+        setattr(action, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(action, name, value)
+
+
+class MemoryRegistry:
+    """ In-memory registry backend, counting the operations performed on it. """
+
+    def __init__(self, values={}):
+        self.values = dict(values)      # {(root, key, value): data}
+        self.operations = []
+
+    def update(self, root, key, value, modify):
+        self.operations.append(('update', root, key, value))
+        modified, data = modify(self.values[(root, key, value)])
+        if modified:
+            self.values[(root, key, value)] = data
+        return (modified, data)
+
+    def query(self, root, key, value, view=64):
+        self.operations.append(('query', root, key, value))
+        return self.values.get((root, key, value))
+
+    def delete_key(self, root, key, view=64):
+        self.operations.append(('delete_key', root, key))
+        deleted = [name for name in self.values if name[:2] == (root, key)]
+        for name in deleted:
+            del self.values[name]
+        return bool(deleted)
+
+
+class LocalServer:
+    """
+    Local HTTP server for download tests: serves `files` (`{path: bytes}`) with `Range` support, after `ttfb` seconds and at most `bandwidth` bytes/s.
+    `etags` adds `ETag` headers and answers matching `If-None-Match` requests with `304`, `redirects` (`{path: location}`) answers with `302`,
+    `certfile` (a PEM file with the key and certificate) serves HTTPS, ranges starting at an offset in `fail_ranges` fail once with `500` and ranges after the first one wait `stall_ranges` seconds.
+`unknown_total` answers ranges with an unknown total length (`bytes 0-N/*`) and `max_range` serves at most that many bytes of a range.
+    Use as a context manager; `url` is the base url, `requests` counts the requests served, `statuses` lists their status codes,
+    `connections` counts the connections accepted, `ranges` lists the ranges served and `user_agents` the `User-Agent` of each request. `drop()` closes all connections server-side.
+    """
+
+    def __init__(self, files, ttfb=0, bandwidth=None, ranges=True, etags=False, redirects={}, certfile=None, fail_ranges=(), stall_ranges=0, unknown_total=False, max_range=None):
+        import http.server, threading
+        self.files, self.ttfb, self.bandwidth, self.accept_ranges, self.etags, self.redirects = files, ttfb, bandwidth, ranges, etags, dict(redirects)
+        self.fail_ranges, self.requests, self.statuses, self.connections, self.ranges, self.sockets = set(fail_ranges), 0, [], 0, [], set()
+        self.user_agents, self.stall_ranges, self.unknown_total, self.max_range = [], stall_ranges, unknown_total, max_range
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            def log_message(self, *args):
+                pass
+            def setup(self):
+                super().setup()
+                server.connections += 1
+                server.sockets.add(self.connection)
+            def finish(self):
+                server.sockets.discard(self.connection)
+                super().finish()
+            def handle_one_request(self):
+                try:
+                    super().handle_one_request()
+                except ConnectionError:
+                    self.close_connection = True     # the client closed an idle keep-alive connection
+            def reply(self, status, headers={}):
+                server.statuses.append(status)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+            def do_GET(self):
+                import hashlib, time
+                server.requests += 1
+                server.user_agents.append(self.headers.get('User-Agent'))
+                time.sleep(server.ttfb)
+                if (location := server.redirects.get(self.path)) is not None:
+                    return self.reply(302, {'Location': location, 'Content-Length': '0'})
+                if (data := server.files.get(self.path)) is None:
+                    return self.reply(404, {'Content-Length': '0'})
+                etag = f'"{hashlib.sha1(data).hexdigest()}"'
+                if server.etags and self.headers.get('If-None-Match') == etag:
+                    return self.reply(304, {'ETag': etag, 'Content-Length': '0'})
+                headers = {'ETag': etag} if server.etags else {}
+                first, last = 0, len(data) - 1
+                if server.accept_ranges and (matches := re.match(r'^bytes=(\d+)-(\d+)$', self.headers.get('Range', ''))):
+                    first, last = int(matches.group(1)), min(int(matches.group(2)), len(data) - 1)
+                    if server.max_range:
+                        last = min(last, first + server.max_range - 1)
+                    if first > 0 and server.stall_ranges:
+                        time.sleep(server.stall_ranges)
+                    if first in server.fail_ranges:
+                        server.fail_ranges.discard(first)
+                        return self.reply(500, {'Content-Length': '0'})
+                    server.ranges.append((first, last))
+                    self.reply(206, {**headers, 'Content-Range': f'bytes {first}-{last}/{"*" if server.unknown_total else len(data)}', 'Content-Length': str(last - first + 1)})
+                else:
+                    self.reply(200, {**headers, 'Content-Length': str(len(data))})
+                block = 16 * 1024
+                try:
+                    for offset in range(first, last + 1, block):
+                        self.wfile.write(data[offset:min(offset + block, last + 1)])
+                        if server.bandwidth:
+                            time.sleep(block / server.bandwidth)
+                except OSError:
+                    pass    # client gave up
+
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        if certfile:
+            import ssl
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile)
+            self.httpd.socket = context.wrap_socket(self.httpd.socket, server_side=True)
+        self.url = f'{"https" if certfile else "http"}://127.0.0.1:{self.httpd.server_port}'
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def drop(self):
+        """ Close all open connections, like a server dropping idle keep-alive connections. """
+        import socket
+        for sock in list(self.sockets):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def bench_import(budget_ms=50, runs=5):
+    """ Measure `import action` with `python -X importtime` and enforce the import-time budget. Network, TLS, registry and process modules must load on first use only. """
+    import py_compile, statistics
+    py_compile.compile(os.path.join(scriptdir, 'action.py'))    # measure the cached bytecode, not the compiler
+
+    lazy = ['ssl', 'pip', 'ctypes', 'winreg', 'subprocess', 'json', 'http.client', 'urllib.request', 'concurrent.futures']
+    samples = []
+    for _ in range(runs):
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import action'], cwd=scriptdir, capture_output=True, text=True, check=True)
+        imported = {}
+        for line in process.stderr.splitlines():
+            if (matches := re.match(r'^import time:\s*(\d+) \|\s*(\d+) \|\s*(\S+)$', line)) != None:
+                imported[matches.group(3)] = int(matches.group(2))
+        samples.append(imported['action'] / 1000)
+        eager = [module for module in lazy if module in imported]
+        assert not eager, f'-- `import action` imported {eager}'
+
+    median = statistics.median(samples)
+    print(f'import action : median {median:.1f} ms, budget {budget_ms} ms, samples {[round(sample, 1) for sample in samples]}')
+    assert median <= budget_ms, f'-- `import action` took {median:.1f} ms, budget is {budget_ms} ms'
+
+
+def bench_nsis_list(entries=5000, budget_ms=100):
+    """ Run `nsis_list` against a synthetic `PATH` with duplicate entries and injected registry/filesystem access. """
+    import time
+    import action
+
+    nsisdir = os.path.normpath('/opt/nsis-3.11')
+    makensis = os.path.join(nsisdir, 'makensis.exe' if os.name == 'nt' else 'makensis')
+    paths = [os.path.normpath(f'/opt/Tool{i % (entries // 2)}/bin') for i in range(entries)]   # each directory twice
+    paths[entries // 3] = nsisdir
+
+    def registry():
+        return [nsisdir]
+
+    probes = []
+    def probe(path):
+        probes.append(path)
+        return path == makensis
+
+    saved_path = os.environ.get('PATH', '')
+    try:
+        os.environ['PATH'] = os.pathsep.join(paths)
+        t0 = time.perf_counter()
+        installations = action.nsis_list(registry, probe)
+        t1 = time.perf_counter()
+        assert action.nsis_list(registry, probe) == installations
+        t2 = time.perf_counter()
+    finally:
+        os.environ['PATH'] = saved_path
+
+    print(f'nsis_list : {entries} PATH entries, {len(probes)} probes, {(t1-t0)*1000:.1f} ms, cached {(t2-t1)*1000:.3f} ms, budget {budget_ms} ms')
+    assert [makensis for makensis, _ in installations] == [os.path.realpath(makensis)], f'-- unexpected installations {installations}'
+    assert len(probes) == len(set(path.casefold() for path in paths)) + (2 if os.name == 'nt' else 0), f'-- {len(probes)} probes'
+    assert (t1-t0)*1000 <= budget_ms, f'-- nsis_list took {(t1-t0)*1000:.1f} ms, budget is {budget_ms} ms'
+
+
+def bench_nsis_version(installations=8, delay=0.2):
+    """ Probe stub `makensis` scripts that count their invocations: concurrently on the first pass, from the cache afterwards. """
+    if os.name == 'nt':
+        print('nsis_version : skipped, the stub makensis is a shell script')
+        return
+    import tempfile, time
+    import action
+
+    with tempfile.TemporaryDirectory() as tempdir, action_globals(versionsfile=os.path.join(tempdir, 'versions.json'), _nsis_versions=None):
+        instdirs = []
+        for i in range(installations):
+            instdirs.append(instdir := os.path.join(tempdir, f'nsis{i}'))
+            os.makedirs(instdir)
+            with open(os.path.join(instdir, 'makensis'), 'w') as fo:
+                fo.write(f'#!/bin/sh\necho >> "{tempdir}/invocations"\nsleep {delay}\nprintf "v3.11.{i}\\r\\n"\n')
+            os.chmod(os.path.join(instdir, 'makensis'), 0o755)
+
+        t0 = time.perf_counter()
+        versions = action.nsis_versions(instdirs)
+        t1 = time.perf_counter()
+        action._nsis_versions = None     # reload from disk, like a later step of the same job
+        assert action.nsis_versions(instdirs) == versions
+        t2 = time.perf_counter()
+        with open(os.path.join(tempdir, 'invocations')) as fi:
+            invocations = len(fi.readlines())
+
+    print(f'nsis_version : {installations} installations, {invocations} invocations, {(t1-t0)*1000:.0f} ms, cached {(t2-t1)*1000:.1f} ms')
+    assert versions == {instdir: f'3.11.{i}' for i, instdir in enumerate(instdirs)}, f'-- unexpected versions {versions}'
+    assert invocations == installations, f'-- {invocations} makensis invocations, expected {installations}'
+    assert t1 - t0 < delay * installations / 2, f'-- probes did not run concurrently'
+
+
+def bench_pe_info(files=500, budget_ms=250):
+    """ Read architecture and version information from synthetic PE files, and reject damaged ones with `ValueError`. """
+    import struct, tempfile, time
+    import action
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        expected = {}
+        for i in range(files):
+            arch = ('x86', 'amd64', 'arm64')[i % 3]
+            version = f'3.11.{i}.{i % 7}' if i % 5 else None
+            pe_fixture(path := os.path.join(tempdir, f'plugin{i}.dll'), arch, version, {'FileVersion': version or '', 'ProductName': 'NSIS'}, dll=True)
+            expected[path] = (arch, version)
+
+        t0 = time.perf_counter()
+        infos = {path: action.pe_info(path) for path in expected}
+        t1 = time.perf_counter()
+
+        # damaged version resources: a StringTable length beyond the resource, and a file truncated inside the resource section
+        pe_fixture(path := os.path.join(tempdir, 'corrupt.dll'), 'amd64', '3.11.1.0', {'FileVersion': '3.11.1.0', 'ProductName': 'NSIS'}, dll=True)
+        with open(path, 'rb') as fi:
+            data = bytearray(fi.read())
+        table = data.find('040904b0'.encode('utf-16-le')) - 6
+        data[table:table+2] = struct.pack('<H', 0xFFF0)
+        with open(path, 'wb') as fo:
+            fo.write(data)
+        with open(truncated := os.path.join(tempdir, 'truncated.dll'), 'wb') as fo:
+            fo.write(data[:0x400 + 120])
+        damaged = {}
+        for path in (path, truncated):
+            try:
+                damaged[path] = action.pe_info(path)
+            except ValueError as ex:
+                damaged[path] = (action.pe_architecture(path), str(ex))
+
+    print(f'pe_info : {files} files, {(t1-t0)*1000:.1f} ms, budget {budget_ms} ms')
+    for path, result in damaged.items():
+        assert isinstance(result, tuple) and result[0] == 'amd64', f'-- "{path}": expected ValueError and a readable architecture, got {result}'
+    for path, (arch, version) in expected.items():
+        info = infos[path]
+        assert (info['arch'], info['file_version']) == (arch, version), f'-- "{path}": expected {(arch, version)}, got {(info["arch"], info["file_version"])}'
+        assert not version or info['strings'] == {'FileVersion': version, 'ProductName': 'NSIS'}, f'-- "{path}": unexpected strings {info["strings"]}'
+    assert (t1-t0)*1000 <= budget_ms, f'-- pe_info took {(t1-t0)*1000:.1f} ms, budget is {budget_ms} ms'
+
+
+def bench_manifest(files=2000, budget_ms=1000):
+    """ Verify a fake installation against the distro manifest and against a full manifest of its tree. """
+    import tempfile, time
+    import action
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        instdir = nsis_tree(os.path.join(tempdir, 'NSIS'), 'negrutiu', 'amd64', files=files)
+        assert not action.manifest_verify(instdir, action.nsis_manifest('negrutiu', 'amd64')), '-- distro manifest verification failed'
+
+        manifest = action.manifest_create(instdir)
+        t0 = time.perf_counter()
+        failures = action.manifest_verify(instdir, manifest)
+        t1 = time.perf_counter()
+        assert not failures, f'-- full manifest verification failed: {failures}'
+
+        with open(os.path.join(instdir, 'Include', 'MUI2.nsh'), 'a') as fo:
+            fo.write('corrupted')
+        pe_fixture(os.path.join(instdir, 'Plugins', 'x86-unicode', 'Math.dll'), 'amd64', dll=True)
+        failures = action.manifest_verify(instdir, manifest, fail_fast=False)
+        assert len(failures) == 2, f'-- expected 2 failures, got {failures}'
+        assert len(action.manifest_verify(instdir, action.nsis_manifest('negrutiu', 'amd64'))) == 1, '-- fail-fast verification failed'
+
+    print(f'manifest : {len(manifest)} files, {(t1-t0)*1000:.0f} ms, budget {budget_ms} ms')
+    assert (t1-t0)*1000 <= budget_ms, f'-- manifest_verify took {(t1-t0)*1000:.0f} ms, budget is {budget_ms} ms'
+
+
+def bench_environment(entries=2000):
+    """ Queue several process, `GITHUB_PATH` and registry `PATH` changes and commit them against an in-memory registry, then registry changes alone. """
+    import io, tempfile, time
+    import action
+
+    paths = [os.path.normpath(f'/opt/tool{i}/bin') for i in range(entries)]
+    system = (action.HKEY_LOCAL_MACHINE, action.system_environment_key, 'Path')
+    user = (action.HKEY_CURRENT_USER, action.user_environment_key, 'Path')
+    registry = MemoryRegistry({system: os.pathsep.join(paths), user: os.pathsep.join(paths[:10])})
+    broadcasts = []
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        saved = {name: os.environ.get(name) for name in ('PATH', 'GITHUB_PATH')}
+        try:
+            os.environ['PATH'] = os.pathsep.join(paths)
+            os.environ['GITHUB_PATH'] = os.path.join(tempdir, 'GITHUB_PATH')
+            t0 = time.perf_counter()
+            with action.EnvironmentUpdate(registry, broadcast=broadcasts.append) as environment:
+                for instdir in (nsisdir := os.path.normpath('/opt/nsis'), os.path.normpath('/opt/nsis-tools')):
+                    environment.github_path_add(instdir)
+                    environment.process_path_add(instdir)
+                    environment.registry_path_add(instdir, *system)
+                environment.process_path_remove(paths[5])
+                environment.registry_path_remove(paths[5], *system)
+                environment.registry_path_remove(paths[5], *user)
+            t1 = time.perf_counter()
+            process_path = os.environ['PATH']
+            with open(os.environ['GITHUB_PATH']) as fi:
+                github_path = fi.read().splitlines()
+
+            # registry changes only, as `nsis_uninstall` queues them for an installation that is no longer in the process PATH
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                with action.EnvironmentUpdate(registry, broadcast=broadcasts.append) as environment:
+                    environment.registry_path_remove(nsisdir, *system)
+                    environment.registry_path_add(nsisdir, *user)
+            registry_only = output.getvalue().splitlines()
+        finally:
+            for name, value in saved.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+
+    print(f'EnvironmentUpdate : {entries} PATH entries, {len(registry.operations)} registry operations, {len(broadcasts)} broadcasts, {(t1-t0)*1000:.1f} ms')
+    assert len(registry.operations) == 4, f'-- expected one update per registry value and transaction, got {registry.operations}'
+    assert broadcasts == ['Environment'] * 2, f'-- expected one broadcast per transaction, got {broadcasts}'
+    expected = os.pathsep.join([os.path.normpath('/opt/nsis-tools'), nsisdir] + paths[:5] + paths[6:])
+    assert process_path == expected, '-- unexpected PATH'
+    assert registry.values[system] == os.pathsep.join([os.path.normpath('/opt/nsis-tools')] + paths[:5] + paths[6:]), '-- unexpected system PATH'
+    assert registry.values[user] == os.pathsep.join([nsisdir] + paths[:5] + paths[6:10]), '-- unexpected user PATH'
+    assert registry_only == [f'Removed "{nsisdir}" from system PATH', f'Added "{nsisdir}" to user PATH'], f'-- unexpected registry-only output {registry_only}'
+    assert github_path == [nsisdir, os.path.normpath('/opt/nsis-tools')], f'-- unexpected GITHUB_PATH {github_path}'
+
+
+def bench_resolve(files=2000, budget_ms=1000):
+    """ Resolve a stubbed release against a fake installation: up to date, then with a different version, architecture, a damaged file and a missing file. """
+    if os.name == 'nt':
+        print('nsis_resolve : skipped, the stub makensis is a shell script')
+        return
+    import json, tempfile, time
+    import action
+
+    release = {'distro': 'negrutiu', 'arch': 'x86', 'version': '3.11.7461.288', 'name': 'nsis-3.11.7461.288-negrutiu-x86.exe'}
+    with tempfile.TemporaryDirectory() as tempdir, action_globals(versionsfile=os.path.join(tempdir, 'versions.json'), _nsis_versions=None, downloadsdir=os.path.join(tempdir, 'downloads')):
+        instdir = nsis_tree(os.path.join(tempdir, 'NSIS'), release['distro'], release['arch'], release['version'], files)
+        with open(makensis := os.path.join(instdir, 'makensis'), 'w') as fo:
+            fo.write(f'#!/bin/sh\nprintf "v{release["version"]}\\r\\n"\n')
+        os.chmod(makensis, 0o755)
+
+        t0 = time.perf_counter()
+        resolved = action.nsis_resolve(release['arch'], release['distro'], instdir, release=release)
+        t1 = time.perf_counter()
+        newer = action.nsis_resolve('x86', 'negrutiu', instdir, release=dict(release, version='3.12.7500.300'))
+        amd64 = action.nsis_resolve('amd64', 'negrutiu', instdir, release=dict(release, arch='amd64'))
+
+        # a file outside the distro manifest is only verified against a recorded release manifest
+        os.makedirs(store := os.path.join(action.downloadsdir, '0' * 64))
+        with open(os.path.join(store, 'manifest.json'), 'w', encoding='utf-8') as fo:
+            json.dump(action.manifest_create(instdir), fo)
+        with open(os.path.join(instdir, 'Examples', 'file5.txt'), 'a') as fo:
+            fo.write('damaged\n')
+        distro_only = action.nsis_resolve(release['arch'], release['distro'], instdir, release=release)
+        recorded = action.nsis_resolve(release['arch'], release['distro'], instdir, release=dict(release, digest=f'sha256:{"0" * 64}'))
+        os.remove(os.path.join(instdir, 'Include', 'MUI2.nsh'))
+        damaged = action.nsis_resolve(release['arch'], release['distro'], instdir, release=release)
+        missing = action.nsis_resolve(release['arch'], release['distro'], os.path.join(tempdir, 'missing'), release=release)
+
+    print(f'nsis_resolve : {files} files, {(t1-t0)*1000:.0f} ms, budget {budget_ms} ms')
+    assert resolved == (instdir, release['version'], release['arch']), f'-- unexpected {resolved}'
+    assert newer is None and amd64 is None and damaged is None and missing is None, '-- outdated installation resolved as up to date'
+    assert distro_only and recorded is None, '-- a damaged file was not found with the release manifest'
+    assert (t1-t0)*1000 <= budget_ms, f'-- nsis_resolve took {(t1-t0)*1000:.0f} ms, budget is {budget_ms} ms'
+
+
+def bench_metadata(ttl=600):
+    """ Fetch release metadata from a local server with `ETag` support: a first download, reuse within the TTL, a `304` revalidation, then a changed document. """
+    import json, tempfile, time
+    import action
+
+    release = {'tag_name': 'v3.11.7461.288', 'assets': []}
+    files = {'/repos/negrutiu/nsis/releases/latest': json.dumps(release).encode()}
+    with tempfile.TemporaryDirectory() as tempdir, action_globals(metadatadir=os.path.join(tempdir, 'metadata')), LocalServer(files, etags=True) as server:
+        url = f'{server.url}/repos/negrutiu/nsis/releases/latest'
+
+        first = action.download_json(url, ttl=ttl)
+        t0 = time.perf_counter()
+        cached = [action.download_json(url, ttl=ttl) for _ in range(10)]
+        t1 = time.perf_counter()
+        within_ttl = server.requests
+        revalidated = action.download_json(url, ttl=0)
+        files['/repos/negrutiu/nsis/releases/latest'] = json.dumps(dict(release, tag_name='v3.12.7500.300')).encode()
+        changed = action.download_json(url, ttl=0)
+        reused = action.download_json(url, ttl=ttl)
+
+    print(f'download_json : {server.requests} requests {server.statuses}, cached {(t1-t0)/len(cached)*1000:.2f} ms')
+    assert first == revalidated == release and all(document == release for document in cached), '-- unexpected cached document'
+    assert within_ttl == 1, f'-- {within_ttl} requests within the TTL, expected 1'
+    assert server.statuses == [200, 304, 200], f'-- unexpected statuses {server.statuses}'
+    assert server.user_agents == [action.http_user_agent] * server.requests, f'-- unexpected User-Agent headers {set(server.user_agents)}'
+    assert changed['tag_name'] == reused['tag_name'] == 'v3.12.7500.300', '-- changed document not downloaded'
+
+
+def bench_download(size=5 * 1024 * 1024 + 123, chunk_size=256 * 1024):
+    """
+    Download from local servers: a chunk failing once (the download is resumed from `.part.json`), a server without `Range` support,
+    a `206` of unknown total length, a `206` shorter than requested and a digest mismatch.
+    """
+    import hashlib, json, tempfile, time
+    import action
+
+    data = os.urandom(size)
+    files = {'/nsis.exe': data}
+    digest = f'sha256:{hashlib.sha256(data).hexdigest()}'
+    failed = 3 * chunk_size
+    with action_globals(download_chunk_size=chunk_size):
+        with tempfile.TemporaryDirectory() as tempdir, LocalServer(files, fail_ranges={failed}) as server:
+            path = os.path.join(tempdir, 'nsis.exe')
+            try:
+                action.download_file(f'{server.url}/nsis.exe', path, size, digest=digest)
+                interrupted = None
+            except Exception as ex:
+                interrupted = ex
+            with open(path + '.part.json') as fi:
+                done = json.load(fi)['done']
+            incomplete = not os.path.exists(path)
+
+            served = len(server.ranges)
+            t0 = time.perf_counter()
+            sha256 = action.download_file(f'{server.url}/nsis.exe', path, size, digest=digest)
+            t1 = time.perf_counter()
+            resumed_ranges = server.ranges[served:]
+            with open(path, 'rb') as fi:
+                resumed = fi.read()
+            leftovers = [name for name in os.listdir(tempdir) if name != 'nsis.exe']
+
+        with tempfile.TemporaryDirectory() as tempdir, LocalServer(files, ranges=False) as server:
+            sha256_stream = action.download_file(f'{server.url}/nsis.exe', path := os.path.join(tempdir, 'nsis.exe'), size, digest=digest)
+            with open(path, 'rb') as fi:
+                streamed = fi.read()
+            statuses = list(server.statuses)
+
+        with tempfile.TemporaryDirectory() as tempdir, LocalServer(files, unknown_total=True) as server:
+            sha256_unknown = action.download_file(f'{server.url}/nsis.exe', path := os.path.join(tempdir, 'nsis.exe'), size, digest=digest)
+            with open(path, 'rb') as fi:
+                unknown = fi.read()
+            unknown_statuses = list(server.statuses)
+
+        with tempfile.TemporaryDirectory() as tempdir, LocalServer(files, max_range=chunk_size // 2) as server:
+            try:
+                action.download_file(f'{server.url}/nsis.exe', path := os.path.join(tempdir, 'nsis.exe'), digest=digest)
+                short = None
+            except RuntimeError as ex:
+                short = ex
+            short_exists = os.path.exists(path)
+
+        with tempfile.TemporaryDirectory() as tempdir, LocalServer({'/nsis.exe': data[::-1]}) as server:
+            try:
+                action.download_file(f'{server.url}/nsis.exe', path := os.path.join(tempdir, 'nsis.exe'), size, digest=digest)
+                mismatch = None
+            except RuntimeError as ex:
+                mismatch = ex
+            mismatch_leftovers = os.listdir(tempdir)
+
+    chunks = (size + chunk_size - 1) // chunk_size
+    print(f'download_file : {size} bytes, {chunks} chunks, resumed {len(done)} chunks in {(t1-t0)*1000:.0f} ms, {len(resumed_ranges)} ranges requested')
+    assert interrupted is not None and incomplete, f'-- a failed chunk did not fail the download'
+    assert 3 not in done and {0, 1, 2} <= set(done), f'-- unexpected completed chunks {sorted(done)}'
+    assert resumed == data and sha256 == digest.split(':')[1], '-- unexpected resumed download'
+    missing = [(index * chunk_size, min((index + 1) * chunk_size, size) - 1) for index in range(1, chunks) if index not in done]
+    assert resumed_ranges[0] == (0, chunk_size - 1) and sorted(resumed_ranges[1:]) == missing, f'-- resumed download requested {resumed_ranges}'     # the probe, then the missing chunks only
+    assert not leftovers, f'-- leftover files {leftovers}'
+    assert streamed == data and sha256_stream == sha256 and statuses == [200], f'-- unexpected single stream download, statuses {statuses}'
+    assert unknown == data and sha256_unknown == sha256 and unknown_statuses == [206, 200], f'-- unexpected download of unknown total length, statuses {unknown_statuses}'
+    assert short is not None and 'range' in str(short) and not short_exists, f'-- a short range was accepted: {short}'
+    assert mismatch is not None and 'mismatch' in str(mismatch) and not mismatch_leftovers, f'-- digest mismatch: {mismatch}, leftovers {mismatch_leftovers}'
+
+
+def bench_tls(requests=10, size=3 * 1024 * 1024):
+    """ Fetch metadata and a redirected asset from a local HTTPS server with a self-signed certificate, counting TLS handshakes; then drop the idle connections to exercise the stale-connection retry. """
+    import shutil, ssl, tempfile, time
+    import action
+
+    if not shutil.which('openssl'):
+        print('tls : skipped, openssl not found')
+        return
+    data = os.urandom(size)
+    files = {'/metadata.json': b'{"tag_name": "v3.11.7461.288"}', '/asset.bin': data}
+    with tempfile.TemporaryDirectory() as tempdir:
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=127.0.0.1', '-addext', 'subjectAltName=IP:127.0.0.1',
+                        '-keyout', key := os.path.join(tempdir, 'key.pem'), '-out', cert := os.path.join(tempdir, 'cert.pem')], capture_output=True, check=True)
+        with open(pem := os.path.join(tempdir, 'server.pem'), 'w') as fo:
+            fo.write(open(key).read() + open(cert).read())
+
+        saved_stats = dict(action.http_stats)
+        action._http_pool.clear()
+        try:
+            with action_globals(_ssl_context=ssl.create_default_context(cafile=cert), metadatadir=os.path.join(tempdir, 'metadata')), \
+                 LocalServer(files, redirects={'/download/asset.bin': '/asset.bin'}, certfile=pem) as server:
+                t0 = time.perf_counter()
+                action.download_json(f'{server.url}/metadata.json', ttl=0)
+                for _ in range(requests):
+                    with action.http_open(f'{server.url}/download/asset.bin', {'Range': 'bytes=0-1023'}) as http:
+                        assert http.read() == data[:1024] and http.url == f'{server.url}/asset.bin', '-- unexpected redirected response'
+                t1 = time.perf_counter()
+                sequential = (action.http_stats['handshakes'] - saved_stats['handshakes'], server.connections)
+
+                action.download_file(f'{server.url}/download/asset.bin', path := os.path.join(tempdir, 'asset.bin'), size)
+                with open(path, 'rb') as fi:
+                    downloaded = fi.read()
+                concurrent = action.http_stats['handshakes'] - saved_stats['handshakes']
+
+                server.drop()
+                time.sleep(0.1)
+                handshakes = action.http_stats['handshakes']
+                with action.http_open(f'{server.url}/metadata.json') as http:
+                    retried = http.read()
+                reconnected = action.http_stats['handshakes'] - handshakes
+        finally:
+            action._http_pool.clear()
+            action.http_stats.update({name: action.http_stats[name] for name in saved_stats})
+
+    print(f'tls : {requests + 1} sequential requests in {(t1-t0)*1000:.0f} ms with {sequential[0]} handshakes, {concurrent} handshakes after a {action.download_threads}-thread download, {reconnected} after dropped connections')
+    assert sequential == (1, 1), f'-- {sequential[0]} handshakes and {sequential[1]} connections for sequential requests, redirects included'
+    assert downloaded == data and concurrent <= 1 + action.download_threads, f'-- {concurrent} handshakes for a chunked download'
+    assert retried == files['/metadata.json'] and reconnected == 1, f'-- stale connection not retried, {reconnected} handshakes'
+    assert set(server.user_agents) == {action.http_user_agent}, f'-- unexpected User-Agent headers {set(server.user_agents)}'   # redirected requests included
+
+
+def bench_hedged(size=3 * 1024 * 1024):
+    """ Race local servers with injected delays: a stalled primary, a slow mirror, a corrupt mirror and a fast one. """
+    import hashlib, tempfile, time
+    import action
+
+    data = os.urandom(size)
+    files = {'/nsis.exe': data}
+    digest = f'sha256:{hashlib.sha256(data).hexdigest()}'
+
+    with tempfile.TemporaryDirectory() as tempdir, action_globals(hedge_ttfb=0.2, hedge_throughput=1024 * 1024), contextlib.ExitStack() as stack:
+        stalled = stack.enter_context(LocalServer(files, ttfb=30))
+        slow = stack.enter_context(LocalServer(files, bandwidth=64 * 1024))
+        corrupt = stack.enter_context(LocalServer({'/nsis.exe': data[::-1]}, ranges=False))
+        fast = stack.enter_context(LocalServer(files))
+        urls = [f'{server.url}/nsis.exe' for server in (stalled, slow, corrupt, fast)]
+
+        t0 = time.perf_counter()
+        sha256 = action.download_hedged(urls, path := os.path.join(tempdir, 'nsis.exe'), size, digest=digest)
+        t1 = time.perf_counter()
+        with open(path, 'rb') as fi:
+            downloaded = fi.read()
+        leftovers = sorted(name for name in os.listdir(tempdir) if name != 'nsis.exe')
+
+        t2 = time.perf_counter()
+        action.download_hedged([f'{fast.url}/nsis.exe', f'{stalled.url}/nsis.exe'], os.path.join(tempdir, 'primary.exe'), size, digest=digest)
+        t3 = time.perf_counter()
+        primary_only = stalled.requests == 1
+
+    print(f'download_hedged : {size} bytes, {len(urls)} sources, {(t1-t0)*1000:.0f} ms, healthy primary {(t3-t2)*1000:.0f} ms')
+    assert downloaded == data and sha256 == digest.split(':')[1], '-- unexpected download'
+    assert fast.requests > 0 and corrupt.requests == 1, '-- hedged requests were not started in order'
+    assert t1 - t0 < 5, f'-- hedging took {t1-t0:.1f} s, the stalled source was waited for'
+    assert primary_only, '-- hedged a healthy primary'
+    assert not leftovers, f'-- leftover files {leftovers}'
+
+    # a losing primary stalled on its range requests must not delay the process exit
+    with tempfile.TemporaryDirectory() as tempdir, LocalServer(files, stall_ranges=30) as stalled, LocalServer(files) as fast:
+        process = subprocess.run([sys.executable, '-c', '\n'.join([
+            'import sys, time',
+            f'sys.path.insert(0, {scriptdir!r})',
+            'import action',
+            'action.hedge_ttfb, action.hedge_throughput, action.http_timeout = 0.2, 1024 * 1024, 8',
+            f'action.download_hedged([{stalled.url + "/nsis.exe"!r}, {fast.url + "/nsis.exe"!r}], {os.path.join(tempdir, "nsis.exe")!r}, {size}, digest={digest!r})',
+            'print(f"returned {time.time()}")',
+            ])], capture_output=True, text=True)
+        exited = time.time()
+        returned = re.search(r'^returned ([\d.]+)$', process.stdout, re.MULTILINE)
+    assert process.returncode == 0 and returned, f'-- hedged download failed: {process.stdout}{process.stderr}'
+    print(f'download_hedged : process exit {(exited - float(returned.group(1)))*1000:.0f} ms after a stalled primary lost')
+    assert exited - float(returned.group(1)) < 2, f'-- the process exited {exited - float(returned.group(1)):.1f} s after the download, the stalled primary was waited for'
+
+
+def bench_store(size=256 * 1024):
+    """ Exercise the content-addressed download store: a hit costs one `stat`, modified files and digest mismatches are never reused or stored, least recently used files are evicted. """
+    import builtins, hashlib, json, tempfile, time
+    import action
+
+    files = {f'/{name}.exe': os.urandom(size) for name in 'abcd'}
+    files['/bad.exe'] = os.urandom(size)
+    digests = {path: hashlib.sha256(data).hexdigest() for path, data in files.items()}
+    saved_stat, saved_open = os.stat, builtins.open
+
+    with tempfile.TemporaryDirectory() as outdir, LocalServer(files) as server:
+        def download(path, digest=None):
+            return action.download_cached(f'{server.url}{path}', path[1:], outdir, size, digest or f'sha256:{digests[path]}', {})
+
+        stored = download('/a.exe')
+        requests = server.requests
+        calls = []
+        os.stat = lambda path, *args, **kwargs: calls.append(('stat', path)) or saved_stat(path, *args, **kwargs)
+        builtins.open = lambda path, *args, **kwargs: calls.append(('open', path)) or saved_open(path, *args, **kwargs)
+        try:
+            t0 = time.perf_counter()
+            hit = download('/a.exe')
+            t1 = time.perf_counter()
+        finally:
+            os.stat, builtins.open = saved_stat, saved_open
+        hit_calls = [call for call, path in calls if path == stored]
+        hit_requests = server.requests - requests
+
+        with open(stored, 'r+b') as fo:
+            fo.write(b'\0' * 16)      # same size, different content
+        os.utime(stored, ns=(time.time_ns(), time.time_ns() + 10**9))
+        requests = server.requests
+        with open(download('/a.exe'), 'rb') as fi:
+            repaired = fi.read() == files['/a.exe'] and server.requests > requests
+
+        try:
+            download('/bad.exe', f'sha256:{digests["/a.exe"][::-1]}')
+            rejected = False
+        except Exception as ex:
+            rejected = True
+            print(f'download_cached : rejected, {ex}')
+        with open(os.path.join(outdir, 'index.json'), 'r', encoding='utf-8') as fi:
+            index = json.load(fi)
+        bad_stored = digests['/bad.exe'] in index['files'] or os.path.exists(os.path.join(outdir, digests['/bad.exe'])) or any(os.scandir(os.path.join(outdir, 'incoming')))
+
+        with action_globals(downloads_cache_size=3 * size):
+            for path in ('/b.exe', '/c.exe', '/a.exe', '/d.exe'):   # `b` becomes the least recently used
+                download(path)
+        with open(os.path.join(outdir, 'index.json'), 'r', encoding='utf-8') as fi:
+            index = json.load(fi)
+        kept = sorted(entry['name'] for entry in index['files'].values())
+        evicted = not os.path.exists(os.path.join(outdir, digests['/b.exe']))
+
+    print(f'download_cached : hit {(t1-t0)*1000:.2f} ms with {hit_calls}, modified file downloaded again: {repaired}, kept {kept} after eviction')
+    assert hit == stored and hit_calls == ['stat'] and hit_requests == 0, f'-- store hit cost {hit_calls} and {hit_requests} requests'
+    assert repaired, '-- a modified file of the same size was reused'
+    assert rejected and not bad_stored, '-- a download with the wrong digest was stored'
+    assert kept == ['a.exe', 'c.exe', 'd.exe'] and evicted, f'-- unexpected eviction, kept {kept}'
+
+
+def fake_installer(path, template, log, padding=0):
+    """
+    Write a shell script that behaves like a silent NSIS installer: copies `template` to its `/D=` directory and logs its arguments to `log`.
+    `padding` random bytes are appended after its last command, to download as much as a real installer.
+    """
+    with open(path, 'wb') as fo:
+        fo.write(f'#!/bin/sh\necho "$@" >> "{log}"\nfor arg; do case "$arg" in /D=*) dir="${{arg#/D=}}";; esac; done\nmkdir -p "$dir" && cp -R "{template}/." "$dir"\nexit $?\n'.encode())
+        fo.write(os.urandom(padding))
+    os.chmod(path, 0o755)
+    return path
+
+
+def fake_release(tempdir, server_files, version, arch, log, files=200, padding=0):
+    """ Build a fake NSIS release: an installation template with a stub `makensis`, and a fake installer added to `server_files`. Returns the `nsis_release` dictionary, without url. """
+    import hashlib
+    template = nsis_tree(os.path.join(tempdir, 'templates', version, arch), 'negrutiu', arch, version, files)
+    with open(os.path.join(template, 'makensis'), 'w') as fo:
+        fo.write(f'#!/bin/sh\nprintf "v{version}\\r\\n"\n')
+    os.chmod(os.path.join(template, 'makensis'), 0o755)
+    name = f'nsis-{version}-negrutiu-{arch}.exe'
+    with open(fake_installer(os.path.join(tempdir, name), template, log, padding), 'rb') as fi:
+        server_files[f'/{name}'] = data = fi.read()
+    return {'distro': 'negrutiu', 'arch': arch, 'version': version, 'tag': f'v{version}', 'name': name, 'size': len(data), 'digest': f'sha256:{hashlib.sha256(data).hexdigest()}', 'headers': {}}
+
+
+def bench_tool_cache(files=200):
+    """ Install fake NSIS releases into a temporary tool cache: first install, instant reuse, side-by-side versions and architectures, pruning, forced reinstalls, PATH order. """
+    if os.name == 'nt':
+        print('tool_cache : skipped, the fake installer is a shell script')
+        return
+    import glob, tempfile, time
+    import action
+
+    with tempfile.TemporaryDirectory() as tempdir, action_globals(toolcachedir=(toolcachedir := os.path.join(tempdir, 'toolcache')), downloadsdir=os.path.join(tempdir, 'downloads'),
+                                                                  versionsfile=os.path.join(tempdir, 'versions.json'), _nsis_versions=None, tool_cache_size=action.tool_cache_size):
+        log = os.path.join(tempdir, 'installs')
+        server_files = {}
+        releases = [fake_release(tempdir, server_files, version, arch, log, files) for version, arch in (('3.10.7408.253', 'x86'), ('3.11.7461.288', 'x86'), ('3.11.7461.288', 'amd64'))]
+
+        with LocalServer(server_files) as server:
+            for release in releases:
+                release['url'] = f'{server.url}/{release["name"]}'
+                os.chmod(action.download_cached(release['url'], release['name'], action.downloadsdir, release['size'], release['digest']), 0o755)    # the executable bit doesn't survive a download
+
+            system = (action.HKEY_LOCAL_MACHINE, action.system_environment_key, 'Path')
+            user = (action.HKEY_CURRENT_USER, action.user_environment_key, 'Path')
+            registry = MemoryRegistry({system: '', user: ''})
+
+            def install(release, force=False, register_path=False):
+                t0 = time.perf_counter()
+                result = action.nsis_install(release['arch'], release['distro'], register_path=register_path, release=release, tool_cache=True, force=force, registry=registry)
+                return result, time.perf_counter() - t0
+
+            first, first_time = install(releases[1])
+            reused, reused_time = install(releases[1])
+            side_by_side = [install(release)[0] for release in (releases[2], releases[0])]
+            with open(log) as fi:
+                installs = len(fi.readlines())
+
+            entry_size = sum(os.path.getsize(os.path.join(root, file)) for root, _, files in os.walk(first[0]) for file in files)
+            action.tool_cache_size = entry_size * 2 + 1
+            os.utime(first[0] + '.complete', (time.time() + 10,) * 2)   # most recently used
+            pruned = action.tool_cache_prune(registry=registry)
+            remaining = sorted(os.path.relpath(path, toolcachedir) for path in glob.glob(os.path.join(glob.escape(toolcachedir), 'nsis', '*', '*.complete')))
+
+            # a forced reinstall that fails (here, a corrupt download) leaves an incomplete entry, a successful one completes it again
+            try:
+                install(dict(releases[1], digest=f'sha256:{"0" * 64}'), force=True)
+                failed = False
+            except Exception as ex:
+                failed = True
+                print(f'tool_cache : forced reinstall failed, {ex}')
+            incomplete = not action.tool_cache_lookup(first[0])
+            forced = install(releases[1], force=True)[0]
+            completed = action.tool_cache_lookup(first[0])
+
+            # another cached version ahead in PATH: a hit moves the requested one to the front, pruning removes the other one from PATH
+            older = action.tool_cache_dir('3.10.7408.253', 'x86')
+            saved = {name: os.environ.get(name) for name in ('PATH', 'GITHUB_PATH')}
+            try:
+                os.environ['PATH'] = registry.values[system] = registry.values[user] = os.pathsep.join([older, first[0], saved['PATH'] or ''])
+                os.environ['GITHUB_PATH'] = os.path.join(tempdir, 'GITHUB_PATH')
+                install(releases[1], register_path=True)
+                registered = [os.environ['PATH'].split(os.pathsep)[0], registry.values[system].split(os.pathsep)[0]]
+                action.tool_cache_prune(keep=first[0], max_size=0, registry=registry)
+                unregistered = [older in paths.split(os.pathsep) for paths in (os.environ['PATH'], registry.values[system], registry.values[user])]
+            finally:
+                for name, value in saved.items():
+                    if value is None:
+                        os.environ.pop(name, None)
+                    else:
+                        os.environ[name] = value
+
+    print(f'tool_cache : install {first_time*1000:.0f} ms, reuse {reused_time*1000:.2f} ms, {installs} installer runs')
+    assert first == reused == (os.path.join(toolcachedir, 'nsis', '3.11.7461.288', 'x86'), '3.11.7461.288', 'x86'), f'-- unexpected {first}, {reused}'
+    assert installs == 3, f'-- {installs} installer runs, expected 3'
+    assert side_by_side[0][2] == 'amd64' and side_by_side[1][1] == '3.10.7408.253', f'-- unexpected {side_by_side}'
+    assert pruned == [os.path.join(toolcachedir, 'nsis', '3.11.7461.288', 'amd64')], f'-- unexpected pruned {pruned}'
+    assert remaining == [os.path.join('nsis', '3.10.7408.253', 'x86.complete'), os.path.join('nsis', '3.11.7461.288', 'x86.complete')], f'-- unexpected {remaining}'
+    assert failed and incomplete, '-- a failed forced reinstall left the entry marked complete'
+    assert forced == first and completed, f'-- unexpected forced reinstall {forced}'
+    assert registered == [first[0]] * 2, f'-- {registered} ahead of the requested version in PATH'
+    assert unregistered == [False] * 3, f'-- pruned "{older}" left in PATH'
+
+
+def bench_portable(files=3000, large_files=8, large_size=4 * 1024 * 1024):
+    """ Extract a large synthetic NSIS zip distribution, serially with `zipfile` and concurrently with `zip_extract`, then install it over an existing installer-based installation. """
+    if os.name == 'nt':
+        print('portable : skipped, the stub makensis is a shell script')
+        return
+    import hashlib, shutil, tempfile, time, zipfile
+    import action
+
+    version = '3.11.7461.288'
+    with tempfile.TemporaryDirectory() as tempdir, action_globals(downloadsdir=os.path.join(tempdir, 'downloads'), versionsfile=os.path.join(tempdir, 'versions.json'), _nsis_versions=None):
+        template = nsis_tree(os.path.join(tempdir, 'template'), 'negrutiu', 'x86', version, files)
+        with open(os.path.join(template, 'makensis'), 'w') as fo:
+            fo.write(f'#!/bin/sh\nprintf "v{version}\\r\\n"\n')
+        os.chmod(os.path.join(template, 'makensis'), 0o755)
+        for i in range(large_files):
+            with open(os.path.join(template, 'Stubs', f'large{i}.bin'), 'wb') as fo:
+                fo.write((os.urandom(1024) + bytes(3 * 1024)) * (large_size // 4096))    # compressible, not trivially
+
+        archive = os.path.join(tempdir, name := f'nsis-{version}-negrutiu-x86.zip')
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for root, _, names in os.walk(template):
+                for file in names:
+                    zf.write(os.path.join(root, file), os.path.join('nsis-' + version, os.path.relpath(os.path.join(root, file), template)))
+
+        t0 = time.perf_counter()
+        with zipfile.ZipFile(archive) as zf:
+            zf.extractall(os.path.join(tempdir, 'serial'))
+        t1 = time.perf_counter()
+        count, size = action.zip_extract(archive, os.path.join(tempdir, 'concurrent'))
+        t2 = time.perf_counter()
+        identical = all(
+            open(os.path.join(root, file), 'rb').read() == open(os.path.join(tempdir, 'serial', 'nsis-' + version, os.path.relpath(os.path.join(root, file), os.path.join(tempdir, 'concurrent'))), 'rb').read()
+            for root, _, names in os.walk(os.path.join(tempdir, 'concurrent')) for file in names)
+
+        instdir = shutil.copytree(template, os.path.join(tempdir, 'NSIS'))
+        with open(stale := os.path.join(instdir, 'Plugins', 'stale.dll'), 'w') as fo:
+            fo.write('left behind by a previous installation\n')
+        registry = MemoryRegistry({
+            (action.HKEY_LOCAL_MACHINE, action.nsis_uninstall_key, 'InstallLocation'): instdir,
+            (action.HKEY_LOCAL_MACHINE, action.nsis_uninstall_key, 'UninstallString'): os.path.join(instdir, 'uninst-nsis.exe'),
+            (action.HKEY_LOCAL_MACHINE, action.nsis_software_key, ''): instdir,
+            (action.HKEY_CURRENT_USER, action.nsis_uninstall_key, 'InstallLocation'): os.path.join(tempdir, 'other'),
+            })
+        with open(archive, 'rb') as fi:
+            data = fi.read()
+        with LocalServer({f'/{name}': data}) as server:
+            release = {'distro': 'negrutiu', 'arch': 'x86', 'version': version, 'tag': f'v{version}', 'name': name, 'url': f'{server.url}/{name}',
+                       'size': len(data), 'digest': f'sha256:{hashlib.sha256(data).hexdigest()}', 'headers': {}, 'portable': True}
+            t3 = time.perf_counter()
+            result = action.nsis_install('x86', 'negrutiu', instdir, register_path=False, release=release, registry=registry)
+            t4 = time.perf_counter()
+        leftovers = [folder for folder in os.listdir(tempdir) if folder.startswith('NSIS.')]
+        stale_exists = os.path.exists(stale)
+
+    print(f'portable : {count} files, {size} bytes, zipfile.extractall {(t1-t0)*1000:.0f} ms, zip_extract {(t2-t1)*1000:.0f} ms, nsis_install {(t4-t3)*1000:.0f} ms')
+    assert count == files + large_files + 14 and identical, '-- zip_extract output differs from zipfile.extractall'
+    assert result == (instdir, version, 'x86'), f'-- unexpected {result}'
+    assert not stale_exists and not leftovers, f'-- stale files left behind {leftovers}'
+    assert list(registry.values) == [(action.HKEY_CURRENT_USER, action.nsis_uninstall_key, 'InstallLocation')], f'-- unexpected registry keys {list(registry.values)}'
+
+
+def bench_teardown(files=10000):
+    """ Remove a synthetic NSIS tree with `shutil.rmtree`, then with `nsis_uninstall(fast=True)` against an in-memory registry that denies one query; other trees with a `makensis.exe` are kept. """
+    import shutil, tempfile, time
+    import action
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        nsis_tree(baseline := os.path.join(tempdir, 'baseline'), files=files)
+        instdir = nsis_tree(os.path.join(tempdir, 'NSIS'), files=files)
+        other = os.path.join(tempdir, 'other')
+        system = (action.HKEY_LOCAL_MACHINE, action.system_environment_key, 'Path')
+        user = (action.HKEY_CURRENT_USER, action.user_environment_key, 'Path')
+
+        class DeniedRegistry(MemoryRegistry):
+            """ Denies the first query, like a key without read access. """
+            def query(self, root, key, value, view=64):
+                if not any(operation[0] == 'query' for operation in self.operations):
+                    self.operations.append(('query', root, key, value))
+                    raise PermissionError('access denied')
+                return super().query(root, key, value, view)
+
+        registry = DeniedRegistry({
+            (action.HKEY_LOCAL_MACHINE, action.nsis_uninstall_key, 'InstallLocation'): instdir,
+            (action.HKEY_LOCAL_MACHINE, action.nsis_uninstall_key, 'UninstallString'): os.path.join(instdir, 'uninst-nsis.exe'),
+            (action.HKEY_LOCAL_MACHINE, action.nsis_software_key, ''): instdir,
+            (action.HKEY_CURRENT_USER, action.nsis_uninstall_key, 'InstallLocation'): other,     # another installation, kept
+            system: os.pathsep.join([other, instdir]),
+            user: other,
+            })
+
+        t0 = time.perf_counter()
+        shutil.rmtree(baseline)
+        t1 = time.perf_counter()
+        saved = os.environ.get('PATH', '')
+        try:
+            os.environ['PATH'] = os.pathsep.join([instdir, saved])
+            exitcode = action.nsis_uninstall(instdir, unregister_path=True, fast=True, registry=registry)
+            process_path = os.environ['PATH']
+        finally:
+            os.environ['PATH'] = saved
+        t2 = time.perf_counter()
+        leftovers = os.listdir(tempdir)
+
+        # directories with a `makensis.exe` but without an NSIS layout are kept
+        for folder in ('tools/bin/makensis.exe', 'sdk/Bin/makensis.exe'):
+            os.makedirs(os.path.dirname(path := os.path.join(tempdir, *folder.split('/'))), exist_ok=True)
+            open(path, 'w').close()
+        kept = [action.nsis_uninstall(os.path.join(tempdir, *folder.split('/')), fast=True, registry=MemoryRegistry()) for folder in ('tools/bin', 'sdk')]
+        kept_files = sorted(os.path.relpath(os.path.join(root, file), tempdir).replace(os.sep, '/') for root, _, names in os.walk(tempdir) for file in names)
+
+    print(f'teardown : {files + 13} files, shutil.rmtree {(t1-t0)*1000:.0f} ms, nsis_uninstall(fast) {(t2-t1)*1000:.0f} ms')
+    assert exitcode == 0 and not leftovers, f'-- exit code {exitcode}, leftovers {leftovers}'
+    assert kept == [-1, -1] and kept_files == ['sdk/Bin/makensis.exe', 'tools/bin/makensis.exe'], f'-- deleted a directory that is not an NSIS installation: {kept}, {kept_files}'
+    assert sorted(registry.values) == sorted([(action.HKEY_CURRENT_USER, action.nsis_uninstall_key, 'InstallLocation'), system, user]), f'-- unexpected registry {registry.values}'
+    assert registry.values[system] == other and process_path == saved, '-- PATH not unregistered'
+
+
+def bench_trace(spans=100000, budget_us=10):
+    """ Measure the cost of a span, then trace nested phases across threads and write the JSON trace, the Chrome trace and the job summary. """
+    import json, tempfile, threading, time
+    import action
+
+    saved = list(action.trace_spans)
+    t0 = time.perf_counter()
+    for i in range(spans):
+        with action.span('empty'):
+            pass
+    t1 = time.perf_counter()
+    del action.trace_spans[:]
+
+    @action.traced()
+    def phase(size):
+        action.span_set(bytes=size, cache='miss')
+
+    with action.span('install', version='3.11') as attributes:
+        phase(1234)
+        parent = action.span_current()
+        def worker():
+            action.span_inherit(parent)
+            with action.span('worker'):
+                pass
+        (thread := threading.Thread(target=worker)).start()
+        thread.join()
+        attributes['instdir'] = 'C:|NSIS'
+    try:
+        with action.span('failing'):
+            raise ValueError('expected')
+    except ValueError:
+        pass
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        saved_summary = os.environ.get('GITHUB_STEP_SUMMARY')
+        os.environ['GITHUB_STEP_SUMMARY'] = os.path.join(tempdir, 'summary.md')
+        try:
+            duration = action.trace_report(os.path.join(tempdir, 'trace.json'), summary=True)
+            action.trace_report(os.path.join(tempdir, 'chrome.json'), chrome=True)
+        finally:
+            if saved_summary is None:
+                os.environ.pop('GITHUB_STEP_SUMMARY')
+            else:
+                os.environ['GITHUB_STEP_SUMMARY'] = saved_summary
+        with open(os.path.join(tempdir, 'trace.json')) as fi:
+            trace = json.load(fi)
+        with open(os.path.join(tempdir, 'chrome.json')) as fi:
+            chrome = json.load(fi)
+        with open(os.path.join(tempdir, 'summary.md')) as fi:
+            summary = fi.read()
+    action.trace_spans[:] = saved
+
+    print(f'trace : {(t1-t0)/spans*1e6:.2f} us per span, budget {budget_us} us')
+    names = {record['name']: record for record in trace['spans']}
+    assert list(names) == ['install', 'phase', 'worker', 'failing'], f'-- unexpected spans {list(names)}'
+    assert names['phase']['parent'] == names['worker']['parent'] == names['install']['id'] and names['install']['parent'] is None, '-- unexpected nesting'
+    assert names['phase']['attributes'] == {'bytes': 1234, 'cache': 'miss'} and names['failing']['attributes']['error'] == 'ValueError: expected', '-- unexpected attributes'
+    assert trace['duration'] == duration and [event['ph'] for event in chrome['traceEvents']] == ['X'] * 4, '-- unexpected trace'
+    assert '| &nbsp;&nbsp;phase | ' in summary and '| 1234 | miss |' in summary and 'C:&#124;NSIS' in summary, f'-- unexpected summary\n{summary}'
+    assert (t1-t0)/spans*1e6 <= budget_us, f'-- a span costs {(t1-t0)/spans*1e6:.1f} us, budget is {budget_us} us'
+
+
+def legacy_path_add(pathlist, path, keep_existing=True, front=True):
+    """ `path_add` as it was before `PathList`, for comparison. """
+    path = os.path.normpath(path)
+    paths = []
+    for entry in pathlist.split(os.pathsep):
+        if os.path.normpath(os.path.expandvars(entry)).casefold() == path.casefold():
+            if keep_existing:
+                return (False, pathlist)
+        else:
+            paths.append(entry)
+    pathlist = ''
+    for entry in paths:
+        pathlist += (os.pathsep if pathlist != "" else "") + entry
+    if front:
+        pathlist = path + (os.pathsep if pathlist != "" else "") + pathlist
+    else:
+        pathlist = pathlist + (os.pathsep if pathlist != "" else "") + path
+    return (True, pathlist)
+
+def legacy_path_remove(pathlist, path):
+    """ `path_remove` as it was before `PathList`, for comparison. """
+    path = os.path.normpath(os.path.expandvars(path))
+    modified = False
+    paths = []
+    for entry in pathlist.split(os.pathsep):
+        if os.path.normpath(os.path.expandvars(entry)).casefold() == path.casefold():
+            modified = True
+        else:
+            paths.append(entry)
+    if modified:
+        pathlist = ''
+        for entry in paths:
+            pathlist += (os.pathsep if pathlist != "" else "") + entry
+    return (modified, pathlist)
+
+
+def bench_pathlist(entries=10000, changes=20):
+    """ Add and remove `changes` directories on a `PATH` of `entries` entries, one by one with the legacy functions and in bulk with `PathList`. """
+    import time
+    import action
+
+    paths = [os.path.normpath(f'/opt/tool{i}/bin') for i in range(entries)]
+    paths[1] = os.path.normpath('$HOME/bin')
+    pathlist = os.pathsep.join(paths)
+    added = [os.path.normpath(f'/opt/new{i}/bin') for i in range(changes)]
+    removed = paths[::entries // changes]
+
+    t0 = time.perf_counter()
+    legacy = pathlist
+    for path in reversed(added):
+        legacy = legacy_path_add(legacy, path)[1]
+    for path in removed:
+        legacy = legacy_path_remove(legacy, path)[1]
+    t1 = time.perf_counter()
+    pathlist2 = action.PathList(pathlist)
+    pathlist2.add(added)
+    pathlist2.remove(removed)
+    result = str(pathlist2)
+    t2 = time.perf_counter()
+
+    print(f'PathList : {entries} entries, {changes} additions + {len(removed)} removals, legacy {(t1-t0)*1000:.1f} ms, bulk {(t2-t1)*1000:.1f} ms ({(t1-t0)/(t2-t1):.0f}x)')
+    assert result == legacy, '-- PathList and legacy functions disagree'
+    assert str(action.PathList(pathlist)) == pathlist, '-- PathList is not lossless'
+    assert t2-t1 < t1-t0, '-- PathList is slower than the legacy functions'
+
+    front = action.PathList(pathlist)
+    assert front.move_to_front([paths[-1], paths[1]]) and list(front)[:3] == [paths[-1], paths[1], paths[0]], '-- unexpected move_to_front'
+    assert paths[1] in front and os.path.normpath(f'{os.environ.get("HOME", "")}/bin') in front, '-- unexpected membership'
+
+
+def stub_makensis(path, log, version='3.11.7461.288', delay=0.5, size=1024 * 1024):
+    """ Write a stub `makensis` that logs its arguments to `log`, takes `delay` seconds to "compile" and writes a deterministic `OutFile` of `size` bytes. Like makensis, `-V2` and lower hide the info lines. """
+    with open(path, 'w') as fo:
+        fo.write(f'''#!{sys.executable}
+import hashlib, os, re, sys, time
+arguments = sys.argv[1:]
+if arguments == ['/VERSION']:
+    sys.exit(print('v{version}'))
+with open({log!r}, 'a') as fo:
+    fo.write(' '.join(arguments) + '\\n')
+defines = dict(argument[2:].partition('=')[::2] for argument in arguments if argument.startswith('-D'))
+script = [argument for argument in arguments if not argument.startswith('-')][-1]
+with open(script) as fi:
+    text = fi.read()
+os.chdir(os.path.dirname(os.path.abspath(script)))
+outfile = re.sub(r'\\$\\{{(\\w+)\\}}', lambda matches: defines.get(matches.group(1), ''), re.search(r'^OutFile\\s+"(.+)"', text, re.MULTILINE).group(1))
+time.sleep({delay})
+with open(outfile, 'wb') as fo:
+    fo.write(hashlib.sha256((' '.join(arguments) + text).encode()).digest() * ({size} // 32))
+if int(([argument[2:] for argument in arguments if argument.startswith('-V')] or ['4'])[-1]) >= 3:
+    print(f'Processing script file: "{{script}}"')
+    print(f'Output: "{{os.path.abspath(outfile)}}"')
+''')
+    os.chmod(path, 0o755)
+    return path
+
+
+def bench_compile(payload=200, delay=0.5):
+    """ Compile a script with `include`, `File` and `!insertmacro` dependencies through `nsis_compile` and a stub makensis: hits, misses after each kind of change, a relocated checkout, an uncacheable script, eviction. """
+    if os.name == 'nt':
+        print('compile : skipped, the stub makensis is a python script')
+        return
+    import shutil, tempfile, time
+    import action
+
+    with tempfile.TemporaryDirectory() as tempdir, action_globals(versionsfile=os.path.join(tempdir, 'versions.json'), _nsis_versions=None):
+        cachedir = os.path.join(tempdir, 'cache')
+        nsisdir = os.path.join(tempdir, 'nsis')
+        stub_makensis(os.path.join(os.makedirs(nsisdir) or nsisdir, 'makensis'), log := os.path.join(tempdir, 'invocations'), delay=delay)
+        project = os.path.join(tempdir, 'project')
+        sources = {
+            os.path.join(nsisdir, 'nsisconf.nsh'): '; global configuration\n',
+            os.path.join(nsisdir, 'Include', 'LogicLib.nsh'): '!include "Util.nsh"\n',
+            os.path.join(nsisdir, 'Include', 'Util.nsh'): '!macro CallArtificialFunction NAME\n!macroend\n',
+            os.path.join(nsisdir, 'Contrib', 'Graphics', 'Icons', 'nsis-menu.ico'): 'icon\n',
+            os.path.join(nsisdir, 'Plugins', 'x86-unicode', 'System.dll'): 'plugin\n',
+            os.path.join(nsisdir, 'Stubs', 'zlib-x86-unicode'): 'stub\n',
+            os.path.join(project, 'installer.nsi'): '\n'.join([
+                '!define /ifndef SUFFIX ""',
+                '!define VERSION "$%BUILD_NUMBER%"',
+                'Name "Setup${SUFFIX}"',
+                'OutFile "Setup${SUFFIX}.exe"',
+                '!include /nonfatal "Optional.nsh"',
+                '!include "LogicLib.nsh"',
+                '!addincludedir "include"',
+                '!include "common.nsh"',
+                '!define MUI_ICON "${NSISDIR}\\Contrib\\Graphics\\Icons\\nsis-menu.ico"',
+                '!insertmacro LICENSE_PAGE "license.txt"',
+                '/* File "ignored\\*.*" */',
+                'Section',
+                '    SetOutPath $INSTDIR',
+                '    File "payload\\*.dll" ; comment',
+                '    File /r /x *.pdb "data"',
+                'SectionEnd', ''
+                ]),
+            os.path.join(project, 'include', 'common.nsh'): '!macro LICENSE_PAGE FILE\n    LicenseData "${FILE}"\n!macroend\n',
+            os.path.join(project, 'license.txt'): 'MIT\n',
+            os.path.join(project, 'uncacheable.nsi'): '!system "echo hello"\nOutFile "Uncacheable.exe"\n',
+            **{os.path.join(project, 'payload', f'plugin{i}.dll'): f'{i}'.ljust(64 * 1024) for i in range(payload)},
+            **{os.path.join(project, 'data', f'folder{i % 4}', f'data{i}.txt'): f'{i}\n' for i in range(20)},
+            }
+        for path, text in sources.items():
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as fo:
+                fo.write(text)
+
+        def invocations():
+            with open(log) as fi:
+                return len(fi.readlines())
+        def compile(*arguments, directory=project):
+            t0 = time.perf_counter()
+            assert action.nsis_compile([*arguments, os.path.join(directory, 'installer.nsi')], nsisdir, cachedir) == 0, '-- compilation failed'
+            return time.perf_counter() - t0
+        def modify(path, text, directory=project):
+            with open(os.path.join(directory, path), 'w') as fo:
+                fo.write(text)
+
+        saved = os.environ.get('BUILD_NUMBER')
+        os.environ['BUILD_NUMBER'] = '1'
+        try:
+            dependencies = action.nsis_dependencies(os.path.join(project, 'installer.nsi'), {}, (), nsisdir)
+            miss = compile('-V4')
+            with open(output := os.path.join(project, 'Setup.exe'), 'rb') as fi:
+                compiled = fi.read()
+            os.remove(output)
+            hit = compile('-V4')
+            with open(output, 'rb') as fi:
+                restored = fi.read()
+            assert invocations() == 1 and restored == compiled, f'-- {invocations()} invocations, restored output differs: {restored != compiled}'
+
+            changes = [
+                ('payload', lambda: modify(os.path.join('payload', 'plugin7.dll'), 'changed'), ()),
+                ('reverted payload', lambda: modify(os.path.join('payload', 'plugin7.dll'), '7'.ljust(64 * 1024)), ()),
+                ('define', lambda: None, ('-DSUFFIX=_amd64',)),
+                ('environment', lambda: os.environ.update(BUILD_NUMBER='2'), ()),
+                ('new header', lambda: modify('Optional.nsh', '; created\n'), ()),
+                ('macro argument', lambda: modify('license.txt', 'GPL\n'), ()),
+                ('recursive file', lambda: modify(os.path.join('data', 'folder1', 'new.txt'), 'new\n'), ()),
+                ('upgraded plugin', lambda: modify(os.path.join('Plugins', 'x86-unicode', 'System.dll'), 'plugin v2\n', nsisdir), ()),
+                ]
+            for change, apply, arguments in changes:
+                before = invocations()
+                apply()
+                compile('-V4', *arguments)
+                expected = before + (0 if change.startswith('reverted') else 1)
+                assert invocations() == expected, f'-- {change}: {invocations() - before} compilations'
+            assert os.path.exists(os.path.join(project, 'Setup_amd64.exe')), '-- define not applied'
+
+            # `-V2` hides the `Output:` line, the output is found from the scanned `OutFile`
+            before = invocations()
+            compile('-V2')
+            os.remove(output)
+            compile('-V2')
+            assert invocations() == before + 1 and os.path.exists(output), f'-- -V2: {invocations() - before} compilations'
+
+            # the compile command of `action.yml` runs makensis only, without discovering installations
+            shutil.copy(action.__file__, cli := os.path.join(os.makedirs(os.path.join(tempdir, 'cli')) or os.path.join(tempdir, 'cli'), 'action.py'))
+            os.remove(output)
+            process = subprocess.run([sys.executable, cli, '--dir', nsisdir, '--compile', '-V2', os.path.join(project, 'installer.nsi')], capture_output=True, text=True, env=dict(os.environ, NSIS_INSTALL_COMPILE_CACHE=cachedir))
+            assert process.returncode == 0 and os.path.exists(output), f'-- compile command failed: {process.stdout}{process.stderr}'
+            assert not re.search(r'^(Arguments|Found nsis|No NSIS)', process.stdout, re.MULTILINE), f'-- compile command discovered installations: {process.stdout}'
+            assert invocations() == before + 1, '-- compile command missed the cache'
+
+            relocated = shutil.copytree(project, os.path.join(tempdir, 'relocated'))
+            os.remove(os.path.join(relocated, 'Setup.exe'))
+            before = invocations()
+            compile('-V4', directory=relocated)
+            assert invocations() == before and os.path.exists(os.path.join(relocated, 'Setup.exe')), '-- relocated checkout not reused'
+
+            before = invocations()
+            for _ in range(2):
+                assert action.nsis_compile([os.path.join(project, 'uncacheable.nsi')], nsisdir, cachedir) == 0, '-- compilation failed'
+            assert invocations() == before + 2, '-- uncacheable script was cached'
+            for _ in range(2):
+                compile('-V4', f'-O{os.path.join(tempdir, "makensis.log")}')
+            assert invocations() == before + 4, '-- compilation with a log file was cached'
+
+            with action_globals(compile_cache_size=1):
+                modify('license.txt', 'BSD\n')
+                compile('-V4')
+            remaining = [name for name in os.listdir(cachedir) if name != 'index.json']
+            compilations = invocations()
+        finally:
+            if saved is None:
+                os.environ.pop('BUILD_NUMBER', None)
+            else:
+                os.environ['BUILD_NUMBER'] = saved
+
+    print(f'compile : {len(dependencies["files"])} dependencies, miss {miss*1000:.0f} ms, hit {hit*1000:.0f} ms, {compilations} compilations')
+    assert dependencies['uncacheable'] is None and len(dependencies['files']) == payload + 20 + 9 and len(dependencies['missing']) >= 1, f'-- unexpected dependencies {dependencies}'
+    assert dependencies['outputs'] == [os.path.join(project, 'Setup.exe')], f'-- unexpected outputs {dependencies["outputs"]}'
+    assert len(remaining) == 1, f'-- compile cache not evicted: {remaining}'
+    assert hit < miss / 2, f'-- a hit took {hit*1000:.0f} ms, a miss {miss*1000:.0f} ms'
+
+
+def baseline_check(name, timings):
+    """
+    Compare `timings` (`{phase: ms}`) with the baselines of benchmark `name` stored in `baselinesfile`, or store them with `update_baselines`.
+    Regressions are reported (as warning annotations on GitHub Actions), only those beyond `regression_fatal_factor` are returned.
+    Returns the list of fatal regressions, `[(phase, ms, baseline)]`.
+    """
+    import json
+    try:
+        with open(baselinesfile, 'r', encoding='utf-8') as fi:
+            baselines = json.load(fi)
+    except (OSError, ValueError):
+        baselines = {}
+
+    if update_baselines:
+        baselines[name] = {phase: round(ms, 1) for phase, ms in timings.items()}
+        with open(baselinesfile, 'w', encoding='utf-8') as fo:
+            json.dump(baselines, fo, indent=2)
+            fo.write('\n')
+        print(f'{name} : stored {len(timings)} baselines in "{baselinesfile}"')
+        return []
+
+    regressions = []
+    for phase, ms in timings.items():
+        baseline = baselines.get(name, {}).get(phase)
+        regressed = baseline is not None and ms > baseline * regression_factor + regression_slack
+        fatal = baseline is not None and ms > baseline * regression_fatal_factor + regression_slack
+        print(f'{name} : {phase:<20} {ms:8.1f} ms, baseline {"none" if baseline is None else f"{baseline:.1f} ms"}{", REGRESSION" if regressed else ""}')
+        if regressed and os.environ.get('GITHUB_ACTIONS') == 'true':
+            print(f'::warning title=benchmark {name}::{phase} took {ms:.0f} ms, baseline {baseline:.0f} ms')
+        if fatal:
+            regressions.append((phase, ms, baseline))
+    return regressions
+
+
+def bench_e2e(files=2000, padding=2 * 1024 * 1024, ttfb=0.02, bandwidth=16 * 1024 * 1024, entries=5000):
+    """
+    Run the action's install flow end to end, offline: a local server with latency and limited bandwidth stands in for the GitHub API and release downloads,
+    fake installers write realistic trees with a stub `makensis`, and an in-memory registry replaces the Windows registry.
+    Scenarios: cold install, warm re-run, version pin (downgrade), portable upgrade and fast teardown. Phase timings are compared with the stored baselines.
+    """
+    if os.name == 'nt':
+        print('e2e : skipped, the fake installer is a shell script')
+        return
+    import glob, hashlib, json, tempfile, time, zipfile
+    import action
+
+    latest, previous = '3.11.7461.288', '3.10.7408.253'
+    timings = {}
+
+    @contextlib.contextmanager
+    def phase(name):
+        t0 = time.perf_counter()
+        with action.span(name):
+            yield
+        timings[name] = timings.get(name, 0) + (time.perf_counter() - t0) * 1000
+
+    with tempfile.TemporaryDirectory() as tempdir, LocalServer({}, ttfb=ttfb, bandwidth=bandwidth) as server, \
+         action_globals(github_api_url=server.url, metadatadir=os.path.join(tempdir, 'runtime', 'metadata'), downloadsdir=os.path.join(tempdir, 'runtime', 'downloads'),
+                        versionsfile=os.path.join(tempdir, 'runtime', 'versions.json'), _nsis_versions=None):
+
+        # release assets and GitHub API documents
+        log = os.path.join(tempdir, 'installs')
+        assets = {version: [fake_release(tempdir, server.files, version, arch, log, files, padding) for arch in ('x86', 'amd64')] for version in (latest, previous)}
+        name = f'nsis-{latest}-negrutiu-x86.zip'
+        with zipfile.ZipFile(archive := os.path.join(tempdir, name), 'w', zipfile.ZIP_DEFLATED) as zf:
+            template = os.path.join(tempdir, 'templates', latest, 'x86')
+            for root, _, names in os.walk(template):
+                for file in names:
+                    zf.write(os.path.join(root, file), os.path.join(f'nsis-{latest}', os.path.relpath(os.path.join(root, file), template)))
+        with open(archive, 'rb') as fi:
+            server.files[f'/{name}'] = data = fi.read()
+        assets[latest].append({'name': name, 'size': len(data), 'digest': f'sha256:{hashlib.sha256(data).hexdigest()}'})
+        releases = [{'tag_name': f'v{version}', 'assets': [{'name': asset['name'], 'size': asset['size'], 'digest': asset['digest'], 'browser_download_url': f'{server.url}/{asset["name"]}'} for asset in assets[version]]} for version in (latest, previous)]
+        server.files['/repos/negrutiu/nsis/releases/latest'] = json.dumps(releases[0]).encode()
+        server.files['/repos/negrutiu/nsis/releases?per_page=100'] = json.dumps(releases).encode()
+        for release in releases:
+            server.files[f'/repos/negrutiu/nsis/releases/tags/{release["tag_name"]}'] = json.dumps(release).encode()
+
+        # runner: a long PATH, an empty GITHUB_PATH and a registry with the system PATH
+        instdir = os.path.join(tempdir, 'ProgramFiles', 'NSIS')    # no spaces, `/D=` is unquoted
+        paths = [os.path.normpath(f'/opt/tool{i}/bin') for i in range(entries)]
+        system = (action.HKEY_LOCAL_MACHINE, action.system_environment_key, 'Path')
+        user = (action.HKEY_CURRENT_USER, action.user_environment_key, 'Path')
+        location = (action.HKEY_LOCAL_MACHINE, action.nsis_uninstall_key, 'InstallLocation')
+        registry = MemoryRegistry({system: os.pathsep.join(paths), user: ''})
+        def locations():
+            return [registry.values[location]] if location in registry.values else []
+
+        def install(version='latest', portable=False, force=False):
+            """ The steps of `action.yml`. """
+            with phase('list'):
+                installations = action.nsis_list(locations)
+                action.nsis_versions(instdir for makensis, instdir in installations)
+            with phase('release'):
+                release = action.nsis_release('negrutiu', 'x86', 'token', version, portable=portable)
+            with phase('resolve'):
+                resolved = None if force else action.nsis_resolve(release['arch'], release['distro'], instdir, release=release)
+            if resolved:
+                with phase('register'):
+                    action.nsis_register_path(instdir, registry)
+                return resolved
+            if not portable and os.path.exists(os.path.join(instdir, 'makensis.exe')):
+                with phase('uninstall'):
+                    action.nsis_uninstall(instdir, fast=True, registry=registry)
+            with phase('download'):
+                # the executable bit doesn't survive a download, `nsis_install` finds the installer in the download store
+                os.chmod(action.download_cached(release['url'], release['name'], action.downloadsdir, release['size'], release['digest'], release['headers']), 0o755)
+            with phase('install'):
+                result = action.nsis_install('x86', 'negrutiu', instdir, github_token='token', release=release, portable=portable, registry=registry)
+                if not portable:
+                    registry.values[location] = instdir     # written by the installer
+            return result
+
+        saved = {name: os.environ.get(name) for name in ('PATH', 'GITHUB_PATH')}
+        saved_spans = list(action.trace_spans)
+        results = {}
+        try:
+            os.environ['PATH'] = os.pathsep.join(paths + [saved['PATH'] or ''])
+            os.environ['GITHUB_PATH'] = os.path.join(tempdir, 'GITHUB_PATH')
+            for scenario, kwargs in (('cold', {}), ('warm', {}), ('pin', {'version': previous}), ('portable', {'portable': True})):
+                timings.clear()
+                t0 = time.perf_counter()
+                with action.span(scenario):
+                    results[scenario] = install(**kwargs)
+                results[scenario] += ((time.perf_counter() - t0) * 1000, dict(timings))
+            requests = server.requests
+            try:
+                action.nsis_release('negrutiu', 'x86', 'token', lockfile=os.path.join(tempdir, 'nsis-lock.json'))
+                missing_lockfile = None
+            except FileNotFoundError as ex:
+                missing_lockfile = ex
+
+            timings.clear()
+            with phase('path'):
+                pathlist = os.pathsep.join(paths)
+                for i in range(20):
+                    pathlist = action.path_add(pathlist, instdir)[1]
+                    pathlist = action.path_remove(pathlist, instdir)[1]
+            with phase('uninstall'):
+                exitcode = action.nsis_uninstall(instdir, fast=True, registry=registry)
+            results['teardown'] = (exitcode, time.perf_counter(), dict(timings))
+            process_path = os.environ['PATH']
+            with open(os.environ['GITHUB_PATH']) as fi:
+                github_path = fi.read().splitlines()
+            with open(log) as fi:
+                installs = len(fi.readlines())
+            leftovers = os.listdir(os.path.dirname(instdir))
+            manifests = len(glob.glob(os.path.join(action.downloadsdir, '*', 'manifest.json')))
+        finally:
+            for name, value in saved.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+            action.trace_spans[:] = saved_spans
+
+    phases = {}
+    for scenario, result in results.items():
+        phases.update({f'{scenario}/{name}': ms for name, ms in result[-1].items()})
+    print(f'e2e : {files} files, {padding} bytes installers, {requests} requests, ' + ', '.join(f'{scenario} {result[3]:.0f} ms' for scenario, result in results.items() if scenario != 'teardown'))
+    assert results['cold'][:3] == results['warm'][:3] == results['portable'][:3] == (instdir, latest, 'x86'), f'-- unexpected {results}'
+    assert results['pin'][:3] == (instdir, previous, 'x86'), f'-- unexpected {results["pin"]}'
+    assert 'install' not in results['warm'][-1] and 'uninstall' in results['pin'][-1] and 'uninstall' not in results['portable'][-1], '-- unexpected install steps'
+    assert installs == 2 and results['teardown'][0] == 0 and not leftovers, f'-- {installs} installer runs, exit code {results["teardown"][0]}, leftovers {leftovers}'
+    assert missing_lockfile is not None and server.requests == requests, '-- a missing lockfile was ignored'
+    assert manifests == 3, f'-- {manifests} release manifests recorded, expected one per clean installation'
+    assert registry.values[system] == os.pathsep.join(paths) and location not in registry.values and instdir not in process_path.split(os.pathsep), '-- installation not unregistered'
+    assert github_path == [instdir] * 4, f'-- unexpected GITHUB_PATH {github_path}'
+    regressions = baseline_check('e2e', phases)
+    assert not regressions, f'-- e2e regressions: ' + ', '.join(f'{phase} {ms:.0f} ms, baseline {baseline:.0f} ms' for phase, ms, baseline in regressions)
+
+
+benchmarks = {
+    'import': bench_import,
+    'nsis_list': bench_nsis_list,
+    'nsis_version': bench_nsis_version,
+    'pe_info': bench_pe_info,
+    'manifest': bench_manifest,
+    'environment': bench_environment,
+    'pathlist': bench_pathlist,
+    'resolve': bench_resolve,
+    'metadata': bench_metadata,
+    'download': bench_download,
+    'tls': bench_tls,
+    'hedged': bench_hedged,
+    'store': bench_store,
+    'tool_cache': bench_tool_cache,
+    'portable': bench_portable,
+    'teardown': bench_teardown,
+    'trace': bench_trace,
+    'compile': bench_compile,
+    'e2e': bench_e2e,
+    }
+
+
+if __name__ == '__main__':
+
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('names', nargs='*', help=f'benchmarks to run. Available: {", ".join(benchmarks)}. Default: all')
+    parser.add_argument('--update-baselines', action='store_true', help=f'store the measured timings as the new baselines in "{os.path.basename(baselinesfile)}"')
+    args = parser.parse_args()
+    update_baselines = args.update_baselines
+
+    failed = []
+    for name in (args.names or benchmarks):
+        try:
+            benchmarks[name]()
+        except AssertionError as ex:
+            print(ex)
+            failed.append(name)
+    if failed:
+        sys.exit(f'-- failed benchmarks: {failed}')